@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""Animation clips sliced from a sheet once and shared, frame by frame, between every sprite that uses them
+
+StateMachine compiles a declarative table of states and event transitions into index tables, so an input
+event costs two dict lookups and a tuple index. Animator advances the frame of every sprite on a loop in one
+NumPy pass and only touches the sprites whose frame actually changes.
+"""
+
+from collections import namedtuple
+from hashlib import blake2b
+
+import numpy as np
+
+from texture_cache import get_pix
+
+Clip = namedtuple('Clip', ['frames', 'delay'])
+
+
+class ClipRegistry:
+    def __init__(self):
+        self.frames = {}    # (sheet, x, y, w, h) -> QPixmap
+        self.pixels = {}    # digest of the frame's pixels -> QPixmap, so identical frames share one pixmap
+        self.clips = {}     # (sheet, w, h, cells, delay) -> Clip
+        self.sets = {}      # (sheet, w, h, definition) -> {name: Clip}
+
+    def frame(self, sheet, x, y, w, h):
+        key = (sheet, x, y, w, h)
+        pix = self.frames.get(key)
+        if pix is None:
+            pix = get_pix(sheet, x, y, w, h)
+            image = pix.toImage()
+            digest = blake2b(image.constBits().asstring(image.sizeInBytes()), digest_size=16).digest()
+            pix = self.pixels.setdefault((w, h, digest), pix)
+            self.frames[key] = pix
+        return pix
+
+    def clip(self, sheet, w, h, cells, delay):
+        """cells are (column, row) positions on a sheet cut into w x h frames"""
+        key = (sheet, w, h, tuple(cells), delay)
+        clip = self.clips.get(key)
+        if clip is None:
+            clip = Clip(tuple(self.frame(sheet, w * col, h * row, w, h) for col, row in cells), delay)
+            self.clips[key] = clip
+        return clip
+
+    def clip_set(self, sheet, w, h, definition):
+        """definition maps state name -> (cells, delay), returns name -> Clip, built once per sheet"""
+        key = (sheet, w, h, tuple((name, tuple(cells), delay) for name, (cells, delay) in definition.items()))
+        clips = self.sets.get(key)
+        if clips is None:
+            clips = {name: self.clip(sheet, w, h, cells, delay) for name, (cells, delay) in definition.items()}
+            self.sets[key] = clips
+        return clips
+
+    def stats(self):
+        return {'frames': len(self.frames), 'unique': len(self.pixels), 'clips': len(self.clips)}
+
+
+CLIPS = ClipRegistry()
+
+
+class StateMachine:
+    def __init__(self, states, transitions):
+        """transitions maps event -> {from state: to state}, '*' matches any state not listed, states with no
+        match keep their state"""
+        self.names = tuple(states)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.events = {}
+        self.table = []     # event id -> next state id, indexed by current state id
+        for event, rules in transitions.items():
+            for name in list(rules) + list(rules.values()):
+                if name != '*' and name not in self.ids:
+                    raise ValueError('Unknown state %r in event %r' % (name, event))
+            default = rules.get('*')
+            row = tuple(self.ids[rules.get(name, default)] if rules.get(name, default) is not None else i
+                        for i, name in enumerate(self.names))
+            self.events[event] = len(self.table)
+            self.table.append(row)
+
+    def next(self, state, event):
+        return self.names[self.table[self.events[event]][self.ids[state]]]
+
+
+class Animator:
+    """Frame timers for every sprite on one loop, the loop animates it every frame as a single object"""
+
+    delay = 0   # ms, so the loop calls animate() every frame
+
+    def __init__(self, loop, capacity=64):
+        self.loop = loop
+        self.sprites = []
+        self.free = []
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.step = np.zeros(capacity, dtype=np.int32)
+        self.frames = np.ones(capacity, dtype=np.int32)
+        self.elapsed = np.zeros(capacity)
+        self.delays = np.full(capacity, np.inf)     # seconds per frame, inf for single frame states
+        loop.add_animation(self)
+
+    def _grow(self):
+        size = len(self.alive) * 2
+        for name, fill in (('alive', False), ('step', 0), ('frames', 1), ('elapsed', 0), ('delays', np.inf)):
+            old = getattr(self, name)
+            new = np.full(size, fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, sprite):
+        if self.free:
+            row = self.free.pop()
+            self.sprites[row] = sprite
+        else:
+            row = len(self.sprites)
+            if row == len(self.alive):
+                self._grow()
+            self.sprites.append(sprite)
+        self.alive[row] = True
+        self.set_clip(row, 1, 1000)
+        return row
+
+    def remove(self, row):
+        self.alive[row] = False
+        self.delays[row] = np.inf
+        self.sprites[row] = None
+        self.free.append(row)
+
+    def set_clip(self, row, frames, delay):
+        """Start row over on a clip of frames frames, delay ms apart"""
+        self.step[row] = 0
+        self.elapsed[row] = 0
+        self.frames[row] = max(frames, 1)
+        self.delays[row] = delay / 1000 if frames > 1 else np.inf
+
+    def animate(self):
+        n = len(self.sprites)
+        elapsed = self.elapsed[:n]
+        elapsed += self.loop.frame_time
+        due = np.flatnonzero(elapsed >= self.delays[:n])
+        if not len(due):
+            return
+        delay = self.delays[due]
+        late = elapsed[due]
+        # Same catch up rule as the loop, a long stall drops frames instead of fast forwarding through them
+        elapsed[due] = np.where(late < 2 * delay, late - delay, 0)
+        steps = (self.step[due] + 1) % self.frames[due]
+        self.step[due] = steps
+        for row, step in zip(due.tolist(), steps.tolist()):
+            self.sprites[row].show_step(step)
+
+
+_animators = {}
+
+
+def get_animator(loop):
+    """The Animator for loop, created on first use"""
+    animator = _animators.get(loop)
+    if animator is None:
+        animator = _animators[loop] = Animator(loop)
+    return animator
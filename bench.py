@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""Repeatable benchmarks for level load/draw, player simulation, sprite animation, pathfinding and Position math
+
+Runs headless on Qt's offscreen platform. Results go out as JSON and, when a baseline exists, every result is
+compared against it and anything more than --tolerance worse is flagged (exit status 1).
+
+    python bench.py                     # run, compare against bench_baseline.json if present
+    python bench.py --save-baseline     # run and store the results as the new baseline
+    python bench.py --quick             # skip the 1024x1024 map
+"""
+
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+from PyQt5.QtWidgets import QApplication, QGraphicsScene
+
+BASELINE = 'bench_baseline.json'
+MAP_SIZES = [128, 512, 1024]
+ENTITIES = [100, 1000, 10000]
+SPRITES = [10, 100, 500]
+
+
+def timed(fn, repeat=3):
+    """Best of repeat runs, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def make_level(size, seed=0):
+    rng = random.Random(seed)
+    grass = ['assets/grass.png', 0, 0, 128, 128]
+    tree = ['assets/tree.png', 0, 0, 128, 128]
+    ore = [['assets/ore.png', 0, 0, 128, 128]]
+    return {'base': [[grass for _ in range(size)] for _ in range(size)],
+            'foliage': [[tree if rng.random() >= .75 else 0 for _ in range(size)] for _ in range(size)],
+            'object': [[ore if rng.random() >= .9 else 0 for _ in range(size)] for _ in range(size)],
+            'tilted': [[0 for _ in range(size)] for _ in range(size)],
+            'walkable': [[True for _ in range(size)] for _ in range(size)]}
+
+
+class View:
+    """Just enough of a Demo view for Level.draw"""
+
+    def __init__(self, width=1200, height=800):
+        self.m_scene = QGraphicsScene()
+        self.w = width
+        self.h = height
+
+    def width(self):
+        return self.w
+
+    def height(self):
+        return self.h
+
+
+def bench_levels(results, sizes, directory):
+    from level import Level, TILE_SIZE
+    from texture_cache import TEXTURES
+
+    for size in sizes:
+        level = make_level(size)
+        for ext in ('.txt', '.lvl'):
+            fp = os.path.join(directory, 'level_%d%s' % (size, ext))
+            Level(fp=fp, level=level)
+            results['level_load_%d%s' % (size, ext.replace('.', '_'))] = \
+                (timed(lambda: Level(fp=fp).level) * 1000, 'ms', 'lower')
+        center = size * TILE_SIZE / 2
+
+        def draw():
+            TEXTURES.clear()
+            view = View()
+            Level(view, level=level).update_view(center, center)
+
+        results['level_draw_%d' % size] = (timed(draw) * 1000, 'ms', 'lower')
+
+
+def bench_players(results, counts):
+    from entities import EntityStore
+    from game_loop import Scheduler
+    from player import Player
+    from position import Position
+
+    for n in counts:
+        store = EntityStore()
+        scheduler = Scheduler()
+        players = [Player(None, random.uniform(0, 8000), random.uniform(0, 8000), loop=scheduler, store=store)
+                   for _ in range(min(n, 1000))]
+        for player in players:
+            player.vel = Position(1, 1)
+        while store.count < n:
+            row = store.add(random.uniform(0, 8000), random.uniform(0, 8000), (600, 400), (7000, 7400))
+            store.vel[row] = (1, -1)
+        ticks = 100
+        results['store_step_%d' % n] = (ticks * n / timed(lambda: scheduler.simulate(ticks)), 'entity ticks/s', 'higher')
+        if n <= 1000:
+            def mov():
+                for player in players:
+                    player.mov()
+            results['player_mov_%d' % n] = (n / timed(mov), 'movs/s', 'higher')
+
+
+def bench_sprites(results, counts):
+    from game_loop import Scheduler
+    from sprite import Link
+
+    for n in counts:
+        view = View()
+        scheduler = Scheduler()
+        links = [Link(parent=view, loop=scheduler) for _ in range(n)]
+        for link in links:
+            link.set_state('down')
+
+        def animate():
+            for _ in range(10):
+                for link in links:
+                    link.animate()
+
+        results['sprite_animate_%d' % n] = (timed(animate) / 10 * 1000, 'ms/frame', 'lower')
+
+        # Every sprite due every frame, through the loop's one batched update
+        scheduler.frame_time = 1.0
+
+        def batched():
+            for _ in range(10):
+                links[0].animator.animate()
+
+        results['sprite_batch_%d' % n] = (timed(batched) / 10 * 1000, 'ms/frame', 'lower')
+
+
+def bench_paths(results, size=256, n=50):
+    from game_loop import Scheduler
+    from generator import generate
+    from level import Level
+    from pathfinding import Pathfinder
+
+    index = Level(level=generate(size, seed=0).to_dict()).index
+    rng = random.Random(0)
+    tiles = list(zip(*index.walkable.nonzero()))
+    points = [((j + .5) * index.tile_size, (i + .5) * index.tile_size) for i, j in rng.sample(tiles, 2 * n)]
+
+    def paths():
+        finder = Pathfinder(index, Scheduler())
+        for k in range(n):
+            finder.find_path(*points[k], *points[n + k])
+        finder.close()
+
+    def field():
+        finder = Pathfinder(index, Scheduler())
+        finder.flow_field(*points[0])
+        finder.close()
+
+    results['path_astar_%d' % size] = (timed(paths) / n * 1000, 'ms/path', 'lower')
+    results['path_flow_field_%d' % size] = (timed(field) * 1000, 'ms', 'lower')
+
+
+def bench_position(results, n=200000):
+    from position import Position
+
+    a = Position(1.0, 2.0)
+    b = Position(3.0, 5.0)
+
+    def add():
+        for _ in range(n):
+            a + b
+
+    def iadd():
+        c = Position(0.0, 0.0)
+        for _ in range(n):
+            c.iadd(b)
+
+    def get_unit():
+        for _ in range(n):
+            a.get_unit(b, 3)
+
+    def direction():
+        for _ in range(n):
+            a.direction(b)
+
+    results['position_add'] = (n / timed(add), 'ops/s', 'higher')
+    results['position_iadd'] = (n / timed(iadd), 'ops/s', 'higher')
+    results['position_get_unit'] = (n / timed(get_unit), 'ops/s', 'higher')
+    results['position_direction'] = (n / timed(direction), 'ops/s', 'higher')
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, (value, unit, better) in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]['value']
+        change = (value - base) / base if base else 0.0
+        if (better == 'lower' and change > tolerance) or (better == 'higher' and -change > tolerance):
+            regressions.append('%s: %.4g -> %.4g %s (%+.0f%%)' % (name, base, value, unit, change * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--output', help='also write the JSON results here')
+    parser.add_argument('--quick', action='store_true', help='skip the largest map, entity and sprite counts')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    random.seed(0)
+    results = {}
+    sizes = MAP_SIZES[:-1] if args.quick else MAP_SIZES
+    with tempfile.TemporaryDirectory() as directory:
+        bench_levels(results, sizes, directory)
+    bench_players(results, ENTITIES[:-1] if args.quick else ENTITIES)
+    bench_sprites(results, SPRITES[:-1] if args.quick else SPRITES)
+    bench_paths(results)
+    bench_position(results)
+
+    report = {name: {'value': value, 'unit': unit, 'better': better}
+              for name, (value, unit, better) in results.items()}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            file.write(text)
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
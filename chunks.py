@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""Bakes NxN blocks of level tiles into one pixmap per layer and keeps only the chunks around the camera in the scene
+
+Zoomed out the renderer switches to mip levels, at level L one item covers 2^L x 2^L chunks with an image made
+by halving its four level L - 1 children, so the number of items and pixels in the scene stays about the same
+at any zoom.
+"""
+
+from collections import OrderedDict
+from math import ceil, floor, log2
+
+from PyQt5.QtCore import QRectF, Qt
+from PyQt5.QtGui import QImage, QPainter, QPixmap
+from texture_cache import get_image, get_pix
+
+TILE_SIZE = 64
+CHUNK_SIZE = 16
+LOD_BIAS = 0.0      # Negative picks sharper mip levels sooner
+LAYERS = [('base', 0), ('foliage', 1), ('object', 2)]
+
+
+def cell_tiles(layer, cell):
+    """The object layer stores a list of tiles per cell, the others a single tile, 0 means empty"""
+    if not isinstance(cell, list):
+        return []
+    if layer == 'object':
+        return cell
+    return [cell]
+
+
+class ChunkRenderer:
+    def __init__(self, scene, source, chunk_size=CHUNK_SIZE, tile_size=TILE_SIZE, view_width=800, view_height=600,
+                 margin=1, cache_chunks=128, cache_mips=96):
+        self.scene = scene
+        self.source = source
+        self.chunk_size = chunk_size
+        self.tile_size = tile_size
+        self.chunk_px = chunk_size * tile_size
+        self.view_width = view_width
+        self.view_height = view_height
+        self.margin = margin
+        self.cache_chunks = cache_chunks
+        self.chunk_rows = -(-source.rows() // chunk_size)
+        self.chunk_cols = -(-source.cols() // chunk_size)
+        self.cache_mips = cache_mips
+        self.baked = OrderedDict()  # (layer, ci, cj) -> QPixmap or None when the chunk is empty
+        self.mips = OrderedDict()   # (layer, lod, ti, tj) -> (QImage, QPixmap) or None, lod >= 1
+        self.live = {}              # (ti, tj) at the current lod -> list of QGraphicsPixmapItem
+        self.center = None
+        self.scale = 1.0
+        self.lod = 0
+        self.max_lod = max(ceil(log2(max(self.chunk_rows, self.chunk_cols, 1))), 0)
+
+    def chunk_of(self, x, y):
+        return floor(y / self.chunk_px), floor(x / self.chunk_px)
+
+    def tile_of(self, x, y):
+        return floor(y / (self.chunk_px << self.lod)), floor(x / (self.chunk_px << self.lod))
+
+    def tile_rows(self):
+        return -(-self.chunk_rows >> self.lod)
+
+    def tile_cols(self):
+        return -(-self.chunk_cols >> self.lod)
+
+    def wanted(self, ci, cj):
+        # Sized from the view so the live set is the same wherever the camera sits inside the centre chunk
+        tile_px = (self.chunk_px << self.lod) * self.scale
+        ri = ceil(self.view_height / 2 / tile_px) + self.margin
+        rj = ceil(self.view_width / 2 / tile_px) + self.margin
+        return {(i, j) for i in range(max(ci - ri, 0), min(ci + ri, self.tile_rows() - 1) + 1)
+                for j in range(max(cj - rj, 0), min(cj + rj, self.tile_cols() - 1) + 1)}
+
+    def set_scale(self, scale):
+        """View scale, 0.5 is zoomed out to half size. Picks the mip level whose texels are closest to pixels"""
+        self.scale = scale
+        lod = min(max(floor(log2(1 / scale) - LOD_BIAS), 0), self.max_lod)
+        if lod != self.lod:
+            for key in list(self.live):
+                self.page_out(*key)
+            self.lod = lod
+        self.center = None
+
+    def update(self, x, y, scale=None):
+        if scale is not None and scale != self.scale:
+            self.set_scale(scale)
+        center = self.tile_of(x, y)
+        if center == self.center:
+            return
+        self.center = center
+        wanted = self.wanted(*center)
+        for key in [key for key in self.live if key not in wanted]:
+            self.page_out(*key)
+        for key in sorted(wanted - self.live.keys(), key=lambda k: abs(k[0] - center[0]) + abs(k[1] - center[1])):
+            self.page_in(*key)
+
+    def page_in(self, ti, tj):
+        items = []
+        # Tiles overhang into the next chunk, later chunks are stacked on top like the old per tile items were
+        order = (ti * self.tile_cols() + tj) / (self.tile_rows() * self.tile_cols() + 1) / 2
+        tile_px = self.chunk_px << self.lod
+        for layer, z in LAYERS:
+            pix = self.chunk(layer, ti, tj) if self.lod == 0 else self.mip(layer, self.lod, ti, tj)
+            if pix is None:
+                continue
+            item = self.scene.addPixmap(pix)
+            item.setPos(tj * tile_px, ti * tile_px)
+            item.setScale(1 << self.lod)
+            item.setZValue(z + order)
+            items.append(item)
+        self.live[(ti, tj)] = items
+
+    def page_out(self, ci, cj):
+        for item in self.live.pop((ci, cj)):
+            self.scene.removeItem(item)
+
+    def chunk(self, layer, ci, cj):
+        key = (layer, ci, cj)
+        if key in self.baked:
+            self.baked.move_to_end(key)
+            return self.baked[key]
+        pix = self.bake(layer, ci, cj)
+        self.keep(key, pix)
+        return pix
+
+    def mip(self, layer, lod, ti, tj):
+        """Pixmap of a lod >= 1 tile, drawn at 2^lod scale"""
+        image = self.mip_image(layer, lod, ti, tj)
+        return None if image is None else self.mips[(layer, lod, ti, tj)][1]
+
+    def mip_image(self, layer, lod, ti, tj):
+        if lod == 0:
+            pix = self.chunk(layer, ti, tj)
+            return None if pix is None else pix.toImage()
+        key = (layer, lod, ti, tj)
+        if key in self.mips:
+            self.mips.move_to_end(key)
+            entry = self.mips[key]
+            return None if entry is None else entry[0]
+        children = []
+        extent = self.chunk_px
+        half = self.chunk_px // 2
+        for di in (0, 1):
+            for dj in (0, 1):
+                i, j = 2 * ti + di, 2 * tj + dj
+                if i >= -(-self.chunk_rows >> (lod - 1)) or j >= -(-self.chunk_cols >> (lod - 1)):
+                    continue
+                child = self.mip_image(layer, lod - 1, i, j)
+                if child is None:
+                    continue
+                children.append((dj * half, di * half, child))
+                extent = max(extent, dj * half + ceil(child.width() / 2), di * half + ceil(child.height() / 2))
+        image = None
+        if children:
+            image = QImage(extent, extent, QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            for x, y, child in children:
+                painter.drawImage(QRectF(x, y, child.width() / 2, child.height() / 2), child)
+            painter.end()
+        self.mips[key] = None if image is None else (image, QPixmap.fromImage(image))
+        while len(self.mips) > self.cache_mips:
+            self.mips.popitem(last=False)
+        return image
+
+    def keep(self, key, pix):
+        self.baked[key] = pix
+        self.baked.move_to_end(key)
+        while len(self.baked) > self.cache_chunks:
+            self.baked.popitem(last=False)
+
+    def tiles(self, layer, ci, cj):
+        """Tiles of one chunk layer as (x, y, tile) relative to the chunk, and the pixel extent they cover"""
+        tiles = []
+        extent = self.chunk_px
+        for i in range(ci * self.chunk_size, min((ci + 1) * self.chunk_size, self.source.rows())):
+            for j in range(cj * self.chunk_size, min((cj + 1) * self.chunk_size, self.source.cols())):
+                for tile in cell_tiles(layer, self.source.cell(layer, i, j)):
+                    x = (j - cj * self.chunk_size) * self.tile_size
+                    y = (i - ci * self.chunk_size) * self.tile_size
+                    extent = max(extent, x + tile[3], y + tile[4])
+                    tiles.append((x, y, tile))
+        return tiles, extent
+
+    def bake(self, layer, ci, cj):
+        tiles, extent = self.tiles(layer, ci, cj)
+        if not tiles:
+            return None
+        pix = QPixmap(extent, extent)
+        pix.fill(Qt.transparent)
+        painter = QPainter(pix)
+        for x, y, tile in tiles:
+            painter.drawPixmap(x, y, get_pix(*tile))
+        painter.end()
+        return pix
+
+    def bake_images(self, ci, cj):
+        """Every layer of a chunk as QImages, safe to call off the GUI thread as long as the source is"""
+        images = {}
+        for layer, _ in LAYERS:
+            tiles, extent = self.tiles(layer, ci, cj)
+            if not tiles:
+                images[layer] = None
+                continue
+            image = QImage(extent, extent, QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            painter = QPainter(image)
+            for x, y, tile in tiles:
+                painter.drawImage(x, y, get_image(*tile))
+            painter.end()
+            images[layer] = image
+        return images
+
+    def provide(self, ci, cj, images):
+        """Take a chunk baked elsewhere by bake_images(), it goes straight into the scene if it is around the centre"""
+        for layer, _ in LAYERS:
+            image = images.get(layer)
+            self.keep((layer, ci, cj), None if image is None else QPixmap.fromImage(image))
+        if self.lod == 0 and self.center is not None and (ci, cj) not in self.live and \
+                (ci, cj) in self.wanted(*self.center):
+            self.page_in(ci, cj)
+
+    def invalidate(self, i0, j0, i1, j1):
+        """Drop baked chunks and mips touching the tile rect [i0, i1) x [j0, j1) and rebake the live ones"""
+        ci0, cj0 = i0 // self.chunk_size, j0 // self.chunk_size
+        ci1, cj1 = (i1 - 1) // self.chunk_size, (j1 - 1) // self.chunk_size
+        for ci in range(ci0, ci1 + 1):
+            for cj in range(cj0, cj1 + 1):
+                for layer, _ in LAYERS:
+                    self.baked.pop((layer, ci, cj), None)
+        for layer, lod, ti, tj in list(self.mips):
+            if ci0 >> lod <= ti <= ci1 >> lod and cj0 >> lod <= tj <= cj1 >> lod:
+                del self.mips[(layer, lod, ti, tj)]
+        for ti in range(ci0 >> self.lod, (ci1 >> self.lod) + 1):
+            for tj in range(cj0 >> self.lod, (cj1 >> self.lod) + 1):
+                if (ti, tj) in self.live:
+                    self.page_out(ti, tj)
+                    self.page_in(ti, tj)
+
+    def clear(self):
+        for key in list(self.live):
+            self.page_out(*key)
+        self.baked.clear()
+        self.mips.clear()
+        self.center = None
+
+    def item_count(self):
+        return sum(len(items) for items in self.live.values())
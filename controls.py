@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""Player input coalesced into one command per simulation tick
+
+Key and mouse handlers only record what is held and where the pointer is, which is all a high rate mouse
+then costs. Once a tick the buffer turns that into a Command and a Controller applies it to a Player, so the
+velocity and animation state are worked out at most once per tick whatever the event rate. Held movement keys
+add up, two of them walk diagonally. Commands can be written to a file as they are applied, nothing is held
+on to, and fed back through a Replay in place of the live buffer. A right click walks to the spot, along a path when there is a Pathfinder.
+The path is searched off the simulation thread but always taken up PATH_DELAY ticks after the click, waiting on
+the search if it is not done by then, so a replay walks off on the same tick as the session it recorded.
+"""
+
+import json
+from collections import namedtuple
+from math import hypot, sqrt
+
+from PyQt5.QtCore import Qt
+from position import Position
+from sprite import KEY_WAYS
+
+WAYS = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+WALK_SPEED = 1
+SPRINT_SPEED = 3
+SPRINT_FADE = -.1   # Stamina per tick while sprinting, and the recovery rate (negated) after
+ACTIONS = {Qt.Key_Space: 'blink'}
+PATH_DELAY = 3      # Ticks from a right click to the player setting off along the path
+
+# ways: held movement keys, oldest first. pointer: scene position, or None when it has not moved since the last
+# command. drag: the left button is held. actions: one shot state machine events pressed during the tick.
+# goal: scene position right clicked during the tick, to walk to along a path
+Command = namedtuple('Command', ['tick', 'ways', 'pointer', 'drag', 'sprint', 'actions', 'goal'], defaults=[None])
+
+
+class InputBuffer:
+    def __init__(self, view):
+        self.view = view
+        self.ways = []
+        self.pointer = None     # Viewport position of the last mouse event not yet sampled
+        self.drag = False
+        self.sprint = False
+        self.actions = []
+        self.goal = None
+
+    def key_press(self, key):
+        """True if the key is a player control"""
+        way = KEY_WAYS.get(key)
+        if way is not None:
+            if way not in self.ways:
+                self.ways.append(way)
+        elif key == Qt.Key_Shift:
+            self.sprint = True
+        elif key in ACTIONS:
+            self.actions.append(ACTIONS[key])
+        else:
+            return False
+        return True
+
+    def key_release(self, key):
+        way = KEY_WAYS.get(key)
+        if way is not None:
+            if way in self.ways:
+                self.ways.remove(way)
+        elif key == Qt.Key_Shift:
+            self.sprint = False
+
+    def mouse_press(self, pos, button=Qt.LeftButton):
+        if button == Qt.RightButton:
+            self.goal = pos
+        else:
+            self.drag = True
+        self.pointer = pos
+
+    def mouse_move(self, pos):
+        self.pointer = pos
+
+    def mouse_release(self, pos, button=Qt.LeftButton):
+        if button != Qt.RightButton:
+            self.drag = False
+        self.pointer = pos
+
+    def clear(self):
+        """Drop everything held, for when the view loses focus and would never see the releases"""
+        self.ways.clear()
+        self.drag = False
+        self.sprint = False
+
+    def scene(self, pos):
+        # Mapped here rather than per event, the view may have scrolled since the mouse last moved
+        if pos is None:
+            return None
+        pos = self.view.mapToScene(pos)
+        return pos.x(), pos.y()
+
+    def sample(self, tick):
+        pointer, goal = self.scene(self.pointer), self.scene(self.goal)
+        self.pointer = self.goal = None
+        actions = tuple(self.actions)
+        self.actions.clear()
+        return Command(tick, tuple(self.ways), pointer, self.drag, self.sprint, actions, goal)
+
+
+class Replay:
+    """Plays back a command log in place of an InputBuffer, one command per tick"""
+
+    def __init__(self, commands):
+        self.commands = list(commands)
+        self.position = 0
+
+    def done(self):
+        return self.position >= len(self.commands)
+
+    def sample(self, tick):
+        if self.done():
+            return Command(tick, (), None, False, False, (), None)
+        command = self.commands[self.position]
+        self.position += 1
+        return command
+
+
+class Controller:
+    def __init__(self, player, source, loop=None, record=None, pathfinder=None):
+        self.player = player
+        self.source = source    # anything with sample(tick) -> Command
+        self.loop = player.loop if loop is None else loop
+        self.record = record    # Text file every command is written to in save_log's format, or None
+        self.pathfinder = pathfinder    # Routes goals around obstacles, without one the player heads straight there
+        self.aim = None         # Last scene position the pointer was seen at
+        self.route = []         # Waypoints left to the last goal
+        self.pending = None     # (tick the route is due, future of the path) for the last goal
+        self.moving = False
+        self.sprint = False
+        # Ahead of the entity store so this tick's command moves the player this tick
+        self.loop.add_simulation(self.tick, first=True)
+
+    def stop(self):
+        self.loop.remove_simulation(self.tick)
+
+    def tick(self):
+        command = self.source.sample(self.loop.ticks)
+        if self.record is not None:
+            self.record.write(encode_command(command) + '\n')
+        self.apply(command)
+
+    def go_to(self, x, y):
+        if self.pathfinder is None:
+            self.pending = None
+            self.route = [(x, y)]
+            return
+        pos = self.player.pos
+        self.pending = (self.loop.ticks + PATH_DELAY, self.pathfinder.request_path(pos.x(), pos.y(), x, y))
+
+    def routed(self):
+        """Take up the pending path once it is due, whenever the search happened to finish"""
+        if self.pending is not None and self.loop.ticks >= self.pending[0]:
+            self.route = self.pending[1].result() or []
+            self.pending = None
+
+    def apply(self, command):
+        player = self.player
+        if command.pointer is not None:
+            self.aim = Position(*command.pointer)
+        if command.goal is not None:
+            self.go_to(*command.goal)
+        if command.ways or command.drag:
+            # Taking over by hand drops the route, and one still being searched for
+            self.pending = None
+            self.route = []
+        self.routed()
+        if command.sprint != self.sprint:
+            self.sprint = command.sprint
+            player.speed = SPRINT_SPEED if command.sprint else WALK_SPEED
+            player.stamina_fade = SPRINT_FADE if command.sprint else -SPRINT_FADE
+
+        event = None
+        dx = sum(WAYS[way][0] for way in command.ways)
+        dy = sum(WAYS[way][1] for way in command.ways)
+        if command.ways:
+            # Opposite keys cancel out, the walk animation follows the newest key still held
+            length = sqrt(dx * dx + dy * dy)
+            k = player.speed / length if length else 0
+            player.vel = Position(dx * k, dy * k)
+            event = 'walk_' + command.ways[-1]
+        elif command.drag and self.aim is not None:
+            pos = player.pos
+            player.vel = pos.get_unit(self.aim, player.speed)
+            event = 'walk_' + pos.direction(self.aim)
+        elif self.follow():
+            target = Position(*self.route[0])
+            pos = player.pos
+            player.vel = pos.get_unit(target, player.speed)
+            event = 'walk_' + pos.direction(target)
+        elif self.moving:
+            player.vel = Position(0, 0)
+            event = 'stop'
+        elif command.pointer is not None:
+            event = 'face_' + player.pos.direction(self.aim)
+        self.moving = bool(command.ways) or (command.drag and self.aim is not None) or bool(self.route)
+
+        if player.sprite is not None:
+            if event is not None:
+                player.send(event)
+            for action in command.actions:
+                player.send(action)
+
+
+    def follow(self):
+        """Drop the waypoints already reached, True while some are left"""
+        x, y = self.player.store.pos[self.player.row].tolist()
+        reach = self.player.speed
+        while self.route and hypot(self.route[0][0] - x, self.route[0][1] - y) <= reach:
+            self.route.pop(0)
+        return bool(self.route)
+
+
+def encode_command(command):
+    return json.dumps(command)
+
+
+def decode_command(line):
+    return Command(*[tuple(value) if isinstance(value, list) else value for value in json.loads(line)])
+
+
+def save_log(fp, commands):
+    with open(fp, 'w') as file:
+        for command in commands:
+            file.write(encode_command(command) + '\n')
+
+
+def load_log(fp):
+    with open(fp, 'r') as file:
+        return [decode_command(line) for line in file]
@@ -8,6 +8,8 @@ from PyQt5.QtGui import (QBrush, QColor, QLinearGradient, QPen, QPainter,
 from PyQt5.QtWidgets import (QLabel, QGraphicsItem, QApplication, QFrame, QGraphicsDropShadowEffect,
                              QGraphicsEllipseItem, QGraphicsRectItem, QGraphicsScene, QGraphicsView,
                              QGraphicsPixmapItem)
+from game_loop import get_loop
+from lighting import Light, LightMap
 
 
 class ProtoObj(object):
@@ -23,10 +25,8 @@ class ProtoObj(object):
         self.stand = []
         self.step = 0
         self.state = 0
-        self.animation_timer = QTimer()
-        self.animation_timer.timeout.connect(self.animate)
-        self.animation_timer.setInterval(1000)
-        self.animation_timer.start()
+        self.delay = 1000
+        get_loop().add_animation(self)
 
     def initObj(self):
         self.ellipse.setPos(self.posX, self.posY)
@@ -34,10 +34,6 @@ class ProtoObj(object):
         self.ellipse.setBrush(QBrush(Qt.darkGreen))
         self.ellipse.setZValue(0)
         self.ellipse.setOpacity(1)
-        effect = QGraphicsDropShadowEffect(self.parent)
-        effect.setBlurRadius(15)
-        effect.setColor(Qt.black)
-        self.ellipse.setGraphicsEffect(effect)
         self.stand.append(self.sheet.copy(10, 15, 100, 120))
         self.stand.append(self.sheet.copy(130, 15, 100, 120))
         self.stand.append(self.sheet.copy(250, 15, 100, 120))
@@ -50,6 +46,11 @@ class ProtoObj(object):
     def getObj(self):
         return [self.ellipse]
 
+    def occluder(self):
+        # Shadow blob for the light map, sized to the ellipse
+        rect = self.ellipse.sceneBoundingRect()
+        return rect.center().x(), rect.center().y(), rect.width() / 2
+
     def moveObj(self, velX, velY):
         self.posX += velX
         self.posY += velY
@@ -82,13 +83,14 @@ class Lighting(QGraphicsView):
 
         self.setupScene()
 
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.animate)
-        self.timer.setInterval(30)
-        self.timer.start()
+        self.loop = get_loop()
+        self.loop.add_render(self.animate)
+        self.light_map.toggle()     # After animate so it lights this frame's positions
 
         self.setRenderHint(QPainter.Antialiasing)
         self.setFrameStyle(QFrame.NoFrame)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setCacheMode(QGraphicsView.CacheBackground)
 
     def setupScene(self):
         self.m_scene.setSceneRect(-300, -200, 600, 460)
@@ -122,26 +124,23 @@ class Lighting(QGraphicsView):
         self.m_scene.addItem(self.proto.getObj()[0])
         #self.m_scene.addItem(self.proto.getObj()[1])
 
-    def animate(self):
-        self.angle += (math.pi / 30)
+        # Shadows come from the light map now, one multiply pass instead of a graphics effect per item
+        self.light_map = LightMap(self)
+        self.light = self.light_map.add_light(Light(radius=320, colour=(255, 255, 160)))
+        self.light_map.add_occluder(self.proto.occluder)
+
+    def animate(self, alpha=1.0):
+        # The light used to turn pi/30 every 30 ms, keep that speed whatever the frame rate is
+        self.angle += (math.pi / 30) * self.loop.frame_time / 0.03
         xs = 200 * math.sin(self.angle) - 40 + 25
         ys = 200 * math.cos(self.angle) - 40 + 25
         self.m_lightSource.setPos(xs, ys)
 
+        self.light.move(xs + 30, ys + 30)
         item = self.proto.getObj()[0]
-        effect = item.graphicsEffect()
-
-        delta = QPointF(item.x() - xs, item.y() - ys)
-        effect.setOffset(QPointF(delta.toPoint() / 30))
-
-        dd = math.hypot(delta.x(), delta.y())
-        color = effect.color()
-        color.setAlphaF(max(0.4, min(1 - dd / 200.0, 0.7)))
-        effect.setColor(color)
         item.setPos(self.proto.posX, self.proto.posY)
         #self.proto.animate(0)
         #self.proto.pix.setPos(self.proto.posX, self.proto.posY)
-        self.m_scene.update()
 
     def keyPressEvent(self, event):
         key = event.key()
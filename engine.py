@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""Headless engine, the level as plain data, players and NPCs in an EntityStore and time that only moves on step()
+
+Nothing here needs a QApplication, a display or a running event loop, so it runs on a bare Linux box and as
+fast as the simulation allows. Rendering hooks in as an observer when there is something to draw on.
+"""
+
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from entities import EntityStore
+from game_loop import SIM_RATE, Scheduler
+from level import Level
+from logs import configure_logging, get_log
+from player import Player
+from sharding import CAPACITY, ShardedStore, worth_sharding
+
+LOG = get_log('engine')
+
+
+class HeadlessWorld:
+    def __init__(self, fp=None, level=None, sim_rate=SIM_RATE, scheduler=None, workers=0, capacity=CAPACITY):
+        """workers > 0 simulates up to capacity entities in that many processes
+
+        Warns when sharding.worth_sharding(workers, capacity) is false, one process is likely faster then.
+        """
+        self.scheduler = Scheduler(sim_rate) if scheduler is None else scheduler
+        self.level = Level(fp=fp, level=level)
+        if workers:
+            if not worth_sharding(workers, capacity):
+                LOG.warning('sharding', '%d workers for %d entities on %d cores, one process is likely faster',
+                            workers, capacity, os.cpu_count() or 1)
+            self.store = ShardedStore(capacity, workers, index=self.level.index)
+            self.level.listeners.append(self.store.invalidate)
+        else:
+            self.store = EntityStore()
+        self.store.index = self.level.index
+        self.store.attach(self.scheduler)
+        self.players = []
+        self.observers = []     # observer(world), called after every simulation tick
+        self.scheduler.add_simulation(self.notify)
+
+    def width(self):
+        return self.level.width()
+
+    def height(self):
+        return self.level.height()
+
+    def add_player(self, x, y, sprite=None):
+        player = Player(None, x, y, sprite, level_max_x=self.width(), level_max_y=self.height(),
+                        level_min_x=0, level_min_y=0, loop=self.scheduler, store=self.store)
+        self.players.append(player)
+        return player
+
+    def spawn(self, n, seed=None):
+        """n NPC rows on walkable tiles with random headings, no Player objects needed for them
+
+        A streamed world has not loaded its tiles yet, its NPCs go anywhere.
+        """
+        rng = np.random.default_rng(seed)
+        if self.level.world is not None:
+            points = rng.uniform((0, 0), (self.width(), self.height()), (n, 2))
+        else:
+            index = self.level.index
+            tiles = np.flatnonzero(index.walkable)
+            if not len(tiles):
+                raise ValueError('No walkable tile to spawn on')
+            i, j = np.divmod(rng.choice(tiles, n), index.cols)
+            points = (np.stack([j, i], axis=1) + rng.uniform(0, 1, (n, 2))) * index.tile_size
+        rows = []
+        for x, y in points.tolist():
+            row = self.store.add(x, y, min_pos=(0, 0), max_pos=(self.width(), self.height()))
+            self.store.vel[row] = rng.uniform(-1, 1, 2)
+            rows.append(row)
+        return rows
+
+    def close(self):
+        if isinstance(self.store, ShardedStore):
+            self.store.close()
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self):
+        if self.level.world is not None:
+            # Keep the regions around every player streamed in
+            for player in self.players:
+                pos = self.store.pos[player.row]
+                self.level.update_view(pos[0], pos[1])
+        for observer in self.observers:
+            observer(self)
+
+    def step(self, dt=None):
+        """One simulation tick, or as many fixed ticks as fit in dt seconds"""
+        if dt is None:
+            self.scheduler.simulate(1)
+        else:
+            self.scheduler.step(dt)
+
+    def run(self, ticks):
+        """Run ticks as fast as possible and return the achieved ticks per second"""
+        start = perf_counter()
+        self.scheduler.simulate(ticks)
+        elapsed = perf_counter() - start
+        return ticks / elapsed if elapsed else float('inf')
+
+
+def main():
+    configure_logging()
+    fp = sys.argv[1] if len(sys.argv) > 1 else 'assets/level_test.lvl'
+    entities = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    ticks = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    world = HeadlessWorld(fp=fp, workers=workers, capacity=max(CAPACITY, entities + 1))
+    world.add_player(world.width() / 2, world.height() / 2)
+    world.spawn(entities, seed=0)
+    rate = world.run(ticks)
+    print('%d entities, %d ticks, %.0f ticks/s (%.1fx real time)' % (entities, ticks, rate, rate / SIM_RATE))
+    world.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""Array backed entity store, motion, stamina and bounds for every entity are integrated in one vectorized step"""
+
+import numpy as np
+
+MAX_STAMINA = 100
+BASE_SPEED = 1
+
+
+class EntityStore:
+    def __init__(self, capacity=64):
+        self.count = 0              # Rows handed out so far, live or not
+        self.free = []
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.pos = np.zeros((capacity, 2))
+        self.prev_pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity)
+        self.stamina = np.zeros(capacity)
+        self.stamina_fade = np.zeros(capacity)
+        self.min_pos = np.zeros((capacity, 2))
+        self.max_pos = np.zeros((capacity, 2))
+        self.loop = None
+        self.index = None           # Optional SpatialIndex, blocks moves into unwalkable tiles and tracks rows
+
+    def capacity(self):
+        return len(self.alive)
+
+    def _grow(self):
+        size = self.capacity() * 2
+        for name in ('alive', 'pos', 'prev_pos', 'vel', 'speed', 'stamina', 'stamina_fade', 'min_pos', 'max_pos'):
+            old = getattr(self, name)
+            new = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def reserve(self, n):
+        while self.capacity() < n:
+            self._grow()
+
+    def add(self, x=0.0, y=0.0, min_pos=(-np.inf, -np.inf), max_pos=(np.inf, np.inf), speed=BASE_SPEED,
+            stamina=MAX_STAMINA):
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.count == self.capacity():
+                self._grow()
+            row = self.count
+            self.count += 1
+        self.alive[row] = True
+        self.pos[row] = self.prev_pos[row] = (x, y)
+        self.vel[row] = 0
+        self.speed[row] = speed
+        self.stamina[row] = stamina
+        self.stamina_fade[row] = 0
+        self.min_pos[row] = min_pos
+        self.max_pos[row] = max_pos
+        return row
+
+    def remove(self, row):
+        self.alive[row] = False
+        self.vel[row] = 0
+        self.stamina_fade[row] = 0
+        self.free.append(row)
+
+    def attach(self, loop):
+        """Step the whole store once per simulation tick of loop"""
+        if self.loop is None:
+            self.loop = loop
+            loop.add_simulation(self.simulate)
+
+    def simulate(self):
+        n = self.count
+        self.prev_pos[:n] = self.pos[:n]
+        self.step()
+        if self.index is not None:
+            self.index.sync(self)
+
+    def step(self, rows=None):
+        """Same rules Player.mov used to apply one object at a time, for rows (default all) in one pass"""
+        if rows is None:
+            rows = slice(0, self.count)
+        elif isinstance(rows, int):
+            rows = slice(rows, rows + 1)
+        stamina = self.stamina[rows] + self.stamina_fade[rows]
+        speed = self.speed[rows]
+        np.minimum(stamina, MAX_STAMINA, out=stamina)
+        exhausted = stamina < 0
+        stamina[exhausted] = 0
+        speed[exhausted] = BASE_SPEED
+        self.stamina[rows] = stamina
+        self.speed[rows] = speed
+
+        pos = self.pos[rows] + self.vel[rows]
+        low = self.min_pos[rows]
+        high = self.max_pos[rows]
+        offset = speed[..., None]
+        pos = np.where(pos < low, low + offset, pos)
+        pos = np.where(pos > high, high - offset, pos)
+        if self.index is not None:
+            pos = self.index.resolve_moves(self.pos[rows], pos)
+        self.pos[rows] = pos
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = EntityStore()
+    return _store
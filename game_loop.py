@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""One fixed timestep loop driving every simulation, animation and render callback from a single QTimer
+
+Scheduler is the loop without the timer, it only moves when step() is called so headless code can run it
+as fast as it likes. GameLoop drives a Scheduler from a QTimer in real time.
+"""
+
+from time import perf_counter
+
+from PyQt5.QtCore import Qt, QTimer
+from profiler import PROFILER
+
+SIM_RATE = 125      # Hz, the old 8 ms Player timer
+RENDER_RATE = 60    # Hz
+MAX_FRAME = 0.25    # Seconds of simulation we are willing to catch up on after a stall
+
+
+class Scheduler:
+    def __init__(self, sim_rate=SIM_RATE, render_rate=RENDER_RATE):
+        self.sim_dt = 1.0 / sim_rate
+        self.render_dt = 1.0 / render_rate
+        self.simulations = []
+        self.animations = {}    # obj -> seconds since its last frame, obj needs .delay (ms) and .animate()
+        self.renders = []
+        self.accumulator = 0.0
+        self.alpha = 0.0
+        self.ticks = 0
+        self.frames = 0
+        self.frame_time = 0.0       # Seconds between the last two frames
+        self.frame_time_avg = 0.0
+        self.work_time = 0.0        # Seconds spent inside the last frame
+        self.profiler = PROFILER
+
+    def set_rates(self, sim_rate=None, render_rate=None):
+        if sim_rate is not None:
+            self.sim_dt = 1.0 / sim_rate
+        if render_rate is not None:
+            self.render_dt = 1.0 / render_rate
+
+    def add_simulation(self, callback, first=False):
+        """first puts callback ahead of the ones already added, for input that the rest of the tick should see"""
+        if first:
+            self.simulations.insert(0, callback)
+        else:
+            self.simulations.append(callback)
+
+    def remove_simulation(self, callback):
+        self.simulations.remove(callback)
+
+    def add_animation(self, obj):
+        self.animations[obj] = 0.0
+
+    def remove_animation(self, obj):
+        self.animations.pop(obj, None)
+
+    def add_render(self, callback):
+        """callback(alpha) runs once per frame, alpha is how far we are between the last two simulation steps"""
+        self.renders.append(callback)
+
+    def remove_render(self, callback):
+        self.renders.remove(callback)
+
+    def simulate(self, ticks=1):
+        """Run simulation callbacks only, as fast as they go, for bots, replays and load tests"""
+        for _ in range(ticks):
+            with self.profiler.phase('simulate'):
+                for callback in self.simulations:
+                    callback()
+            self.ticks += 1
+
+    def step(self, frame):
+        self.frame_time = frame
+        self.frame_time_avg += (frame - self.frame_time_avg) * 0.1
+        self.frames += 1
+
+        self.accumulator += min(frame, MAX_FRAME)
+        while self.accumulator >= self.sim_dt:
+            with self.profiler.phase('simulate'):
+                for callback in self.simulations:
+                    callback()
+            self.accumulator -= self.sim_dt
+            self.ticks += 1
+        self.alpha = self.accumulator / self.sim_dt
+
+        with self.profiler.phase('animate'):
+            for obj, elapsed in list(self.animations.items()):
+                elapsed += frame
+                delay = obj.delay / 1000
+                if elapsed >= delay:
+                    obj.animate()
+                    elapsed = elapsed - delay if elapsed < 2 * delay else 0.0
+                if obj in self.animations:
+                    self.animations[obj] = elapsed
+
+        with self.profiler.phase('render'):
+            for callback in list(self.renders):
+                callback(self.alpha)
+        self.profiler.count('frame ms', round(frame * 1000, 2))
+
+    def fps(self):
+        return 1.0 / self.frame_time_avg if self.frame_time_avg else 0.0
+
+
+class GameLoop(Scheduler):
+    def __init__(self, sim_rate=SIM_RATE, render_rate=RENDER_RATE, start=True):
+        super().__init__(sim_rate, render_rate)
+        self.last = None
+        self.timer = QTimer()
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.timer.setInterval(round(self.render_dt * 1000))
+        if start:
+            self.start()
+
+    def set_rates(self, sim_rate=None, render_rate=None):
+        super().set_rates(sim_rate, render_rate)
+        self.timer.setInterval(round(self.render_dt * 1000))
+
+    def start(self):
+        self.last = None
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def tick(self):
+        now = perf_counter()
+        frame = self.render_dt if self.last is None else now - self.last
+        self.last = now
+        self.step(frame)
+        self.work_time = perf_counter() - now
+
+
+_loop = None
+
+
+def get_loop():
+    """The shared loop, created on first use so a QApplication exists by then"""
+    global _loop
+    if _loop is None:
+        _loop = GameLoop()
+    return _loop
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""Seeded procedural levels, every layer is a NumPy array built with whole map operations
+
+Biomes come from a couple of octaves of value noise, each biome sets which tiles it uses and how dense its
+foliage and objects are. The result keeps tile ids in arrays against one shared tile table, the same way the
+binary level format stores them, so it can be written as a .lvl or as world regions without ever building
+the nested list dict. to_dict() is still there for the in memory Level format.
+
+    python generator.py out.lvl 1024 [seed]     # one binary level
+    python generator.py out_dir 4096 [seed]     # a region directory for WorldStore
+"""
+
+import json
+import os
+import sys
+from collections import namedtuple
+from time import perf_counter
+
+import numpy as np
+
+import level_format
+from world import META, REGION_SIZE, region_path
+
+GRASS = ['assets/grass.png', 0, 0, 128, 128]
+TREE = ['assets/tree.png', 0, 0, 128, 128]
+ORE = ['assets/ore.png', 0, 0, 128, 128]
+
+# foliage and objects are (tile, probability per cell), objects block movement
+Biome = namedtuple('Biome', ['name', 'base', 'foliage', 'objects'])
+
+BIOMES = [Biome('meadow', GRASS, (TREE, .08), (ORE, .02)),
+          Biome('forest', GRASS, (TREE, .55), (ORE, .01)),
+          Biome('quarry', GRASS, (TREE, .03), (ORE, .25))]
+THRESHOLDS = [.45, .6]      # biome noise cut points, below the first is BIOMES[0] and so on
+
+
+def value_noise(rng, rows, cols, scale, octaves=4, persistence=.5):
+    """Smoothed value noise in [0, 1), scale is the size of the largest features in cells"""
+    total = np.zeros((rows, cols), np.float32)
+    low = np.empty((rows, cols), np.float32)
+    high = np.empty((rows, cols), np.float32)
+    amplitude = 1.0
+    norm = 0.0
+    for octave in range(octaves):
+        cell = max(scale / 2 ** octave, 1.0)
+        grid = rng.random((int(rows / cell) + 2, int(cols / cell) + 2), dtype=np.float32)
+        y = np.arange(rows, dtype=np.float32) / cell
+        x = np.arange(cols, dtype=np.float32) / cell
+        y0 = y.astype(np.intp)
+        x0 = x.astype(np.intp)
+        ty = y - y0
+        tx = x - x0
+        ty = (ty * ty * (3 - 2 * ty))[:, None]
+        tx = tx * tx * (3 - 2 * tx)
+        # Blend across the small grid's columns first, then spread its rows out into reused full size buffers
+        blended = grid[:, x0] * (1 - tx) + grid[:, x0 + 1] * tx
+        with np.errstate(invalid='ignore'):
+            # take() reports FPU flags it did not clear itself, Qt painting on the same loader thread leaves some set
+            np.take(blended, y0, axis=0, out=low, mode='clip')
+            np.take(blended, y0 + 1, axis=0, out=high, mode='clip')
+        high -= low
+        high *= ty
+        low += high
+        low *= amplitude
+        total += low
+        norm += amplitude
+        amplitude *= persistence
+    total /= norm
+    return total
+
+
+class GeneratedLevel:
+    """Tile ids per layer in arrays plus the tables they index, readable by anything that takes a level source"""
+
+    def __init__(self, tiles, stacks, base, foliage, objects, walkable, tilted, biome):
+        self.tiles = tiles          # id -> [sheet, x, y, w, h], id 0 is the empty cell
+        self.stacks = stacks        # id -> list of tiles, for the object layer
+        self.ids = {'base': base, 'foliage': foliage, 'object': objects}
+        self.bits = {'walkable': walkable, 'tilted': tilted}
+        self.biome = biome          # index into the biome list per cell
+
+    def rows(self):
+        return self.ids['base'].shape[0]
+
+    def cols(self):
+        return self.ids['base'].shape[1]
+
+    def cell(self, layer, i, j):
+        if layer in self.bits:
+            value = self.bits[layer][i, j]
+            return bool(value) if layer == 'walkable' else int(value)
+        values = self.stacks if layer in level_format.STACK_LAYERS else self.tiles
+        return values[self.ids[layer][i, j]]
+
+    def to_dict(self):
+        """The nested list format Level keeps in memory, cells that share a tile share one list"""
+        level = {}
+        for layer, ids in self.ids.items():
+            values = self.stacks if layer in level_format.STACK_LAYERS else self.tiles
+            level[layer] = [[values[k] for k in row] for row in ids.tolist()]
+        level['walkable'] = self.bits['walkable'].tolist()
+        level['tilted'] = self.bits['tilted'].astype(int).tolist()
+        return level
+
+    def encode(self, i0=0, j0=0, i1=None, j1=None):
+        """Binary level bytes for the [i0, i1) x [j0, j1) block, ids keep pointing at the full tables"""
+        i1 = self.rows() if i1 is None else i1
+        j1 = self.cols() if j1 is None else j1
+        typecode = 'H' if max(len(self.tiles), len(self.stacks)) < 0xFFFF else 'I'
+        dtype = '<u2' if typecode == 'H' else '<u4'
+        ids = {layer: np.ascontiguousarray(values[i0:i1, j0:j1], dtype=dtype).tobytes()
+               for layer, values in self.ids.items()}
+        bits = {layer: np.packbits(values[i0:i1, j0:j1].ravel().astype(bool), bitorder='little').tobytes()
+                for layer, values in self.bits.items()}
+        stacks = [[self.tiles.index(tile) for tile in stack] for stack in self.stacks[1:]]
+        return level_format.pack(i1 - i0, j1 - j0, typecode, self.tiles[1:], stacks, ids, bits)
+
+    def save(self, fp):
+        with open(fp, 'wb') as file:
+            file.write(self.encode())
+
+    def write_world(self, directory, region_size=REGION_SIZE):
+        """Same layout as world.write_world, sliced straight out of the arrays"""
+        os.makedirs(directory, exist_ok=True)
+        rows, cols = self.rows(), self.cols()
+        for ri in range(-(-rows // region_size)):
+            for rj in range(-(-cols // region_size)):
+                i0, j0 = ri * region_size, rj * region_size
+                with open(region_path(directory, ri, rj), 'wb') as file:
+                    file.write(self.encode(i0, j0, min(i0 + region_size, rows), min(j0 + region_size, cols)))
+        with open(os.path.join(directory, META), 'w') as file:
+            json.dump({'rows': rows, 'cols': cols, 'region_size': region_size}, file)
+
+
+def generate(rows, cols=None, seed=None, scale=48, density=1.0, biomes=BIOMES, thresholds=THRESHOLDS):
+    """density scales every biome's foliage and object odds, the same seed and arguments give the same level"""
+    cols = rows if cols is None else cols
+    rng = np.random.default_rng(seed)
+    biome = np.digitize(value_noise(rng, rows, cols, scale), thresholds).astype(np.uint8)
+
+    tiles = [0]
+    stacks = [0]
+
+    def tile_id(tile):
+        if tile not in tiles:
+            tiles.append(tile)
+        return tiles.index(tile)
+
+    def stack_id(tile):
+        tile_id(tile)   # The binary table stores stacks as tile ids
+        if [tile] not in stacks:
+            stacks.append([tile])
+        return stacks.index([tile])
+
+    base_ids = np.array([tile_id(b.base) for b in biomes], np.uint32)
+    foliage_ids = np.array([tile_id(b.foliage[0]) for b in biomes], np.uint32)
+    object_ids = np.array([stack_id(b.objects[0]) for b in biomes], np.uint32)
+    foliage_odds = np.array([b.foliage[1] for b in biomes], np.float32) * density
+    object_odds = np.array([b.objects[1] for b in biomes], np.float32) * density
+
+    # Foliage grows in clumps, so the per biome odds are shaped by a finer noise field
+    clumps = value_noise(rng, rows, cols, max(scale / 4, 2), octaves=2) * 2
+    foliage = np.where(rng.random((rows, cols), dtype=np.float32) < foliage_odds[biome] * clumps,
+                       foliage_ids[biome], 0)
+    objects = np.where(rng.random((rows, cols), dtype=np.float32) < object_odds[biome], object_ids[biome], 0)
+    return GeneratedLevel(tiles, stacks, base_ids[biome], foliage, objects,
+                          walkable=objects == 0, tilted=np.zeros((rows, cols), bool), biome=biome)
+
+
+def main():
+    out = sys.argv[1]
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    start = perf_counter()
+    level = generate(size, seed=seed)
+    generated = perf_counter()
+    if out.endswith('.lvl'):
+        level.save(out)
+    else:
+        level.write_world(out)
+    print('%dx%d seed %d, generated in %.2fs, written in %.2fs' % (size, size, seed, generated - start,
+                                                                   perf_counter() - generated))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,29 @@
 import json
-import random
+import os
 
 
-from PyQt5.QtCore import QPointF, Qt, QTimer
-from PyQt5.QtGui import (QColor, QLinearGradient, QPainter, QPixmap)
+from PyQt5.QtCore import QPointF, Qt
+from PyQt5.QtGui import (QColor, QLinearGradient, QPainter)
 from PyQt5.QtWidgets import (QApplication, QFrame, QGraphicsScene, QGraphicsView)
+import level_format
+from chunks import ChunkRenderer
+from game_loop import get_loop
+from generator import ORE, generate
+from logs import configure_logging
+from spatial import SpatialIndex
+from texture_cache import get_pix
+from world import WorldStore
 
 TILE_SIZE = 64
 TILE_COUNT = 64
 WINDOW_WIDTH = 800
 WINDOW_HEIGHT = 600
+BINARY_EXT = '.lvl'
+LAYERS = level_format.TILE_LAYERS + level_format.STACK_LAYERS + level_format.BIT_LAYERS
+DIRTY_SIZE = 16     # Tiles per side of the blocks save_changes() appends
+COMPACT = 2         # save_changes() rewrites the file once appending has grown it this many times over
+JOURNAL_LIMIT = 256
+EDIT_FILE = 'level_edit.lvl'     # Where the map explorer saves its edits
 
 class Tile:
     def __init__(self, sheet=None, x=0, y=0, x_shift=TILE_SIZE, y_shift=TILE_SIZE):
@@ -18,7 +32,7 @@ class Tile:
         self.y = y
         self.x_shift = x_shift
         self.y_shift = y_shift
-        self.pix = QPixmap(self.sheet).copy(self.x, self.y, self.x_shift, self.y_shift)
+        self.pix = get_pix(self.sheet, self.x, self.y, self.x_shift, self.y_shift)
 
     def get_pix(self):
         return self.pix
@@ -27,52 +41,199 @@ class Tile:
         return [self.sheet, self.x, self.y, self.x_shift, self.y_shift]
 
 
+class Journal:
+    """Undo and redo for a Level's edits, each keeps its rect before and after as binary level bytes"""
+
+    def __init__(self, level, limit=JOURNAL_LIMIT):
+        self.level = level
+        self.limit = limit
+        self.done = []      # (i0, j0, before, after), newest last
+        self.undone = []
+        level.journal = self
+
+    def record(self, i0, j0, before, after):
+        self.done.append((i0, j0, level_format.encode(before), level_format.encode(after)))
+        del self.done[:-self.limit]
+        self.undone.clear()
+
+    def _apply(self, i0, j0, data):
+        with level_format.BinaryLevel(data=data) as cells:
+            self.level.paste(i0, j0, cells.to_dict(), journal=False)
+
+    def undo(self):
+        if not self.done:
+            return False
+        i0, j0, before, after = self.done.pop()
+        self._apply(i0, j0, before)
+        self.undone.append((i0, j0, before, after))
+        return True
+
+    def redo(self):
+        if not self.undone:
+            return False
+        i0, j0, before, after = self.undone.pop()
+        self._apply(i0, j0, after)
+        self.done.append((i0, j0, before, after))
+        return True
+
+
 class Level:
     def __init__(self, parent=None, fp=None, size=64, level=None):
         self.parent = parent
         self.fp = fp
         self.size = size
         self.level = level
-        if fp is not None and level is None:    # We have a file path, but aren't provided a level, we need to load one
+        self.renderer = None
+        self.world = None
+        self.index = None
+        self.listeners = []     # listener(i0, j0, i1, j1) after tiles in that rect changed
+        self.journal = None     # Journal recording edits for undo
+        self.dirty = set()      # (i, j) DIRTY_SIZE blocks edited since the last save
+        self.saved_size = 0     # File size after the last full save or load
+        if fp is not None and level is None and os.path.isdir(fp):     # A region directory, streamed in around the view
+            self.world = WorldStore(fp, on_loaded=self.region_loaded)
+        elif fp is not None and level is None:    # We have a file path, but aren't provided a level, we need to load one
             self.level = self.load()
         elif fp is not None:                    # We have a file path and a level, we save our level
             self.save()
+        elif level is not None:                 # Just a level, keep it in memory
+            pass
         else:                                   # We don't have a file path or a level, we load the default level
             self.fp = 'assets/level.txt'
             self.level = self.load()
-        self.draw()
+        self.index = SpatialIndex(self, tile_size=TILE_SIZE, populate=self.world is None)
+        self.loaded_view = False
+        if getattr(parent, 'm_scene', None) is not None:   # Without a scene we only hold data (headless)
+            self.draw()
 
     def save(self):
-        with open(self.fp, 'w') as file:
-            json.dump(self.level, file)
+        if self.fp.endswith(BINARY_EXT):
+            level_format.save(self.level, self.fp)
+        else:
+            tmp = self.fp + '.tmp'
+            with open(tmp, 'w') as file:
+                json.dump(self.level, file)
+            os.replace(tmp, self.fp)
+        self.dirty.clear()
+        self.saved_size = os.path.getsize(self.fp)
+
+    def save_changes(self):
+        """Append the blocks edited since the last save to a binary level file instead of rewriting all of it"""
+        if not self.dirty:
+            return
+        if (not self.fp.endswith(BINARY_EXT) or not os.path.exists(self.fp)
+                or os.path.getsize(self.fp) > self.saved_size * COMPACT):
+            self.save()
+            return
+        patches = []
+        for bi, bj in sorted(self.dirty):
+            i0, j0 = bi * DIRTY_SIZE, bj * DIRTY_SIZE
+            patches.append((i0, j0, level_format.encode(self.copy(i0, j0, i0 + DIRTY_SIZE, j0 + DIRTY_SIZE))))
+        level_format.append(self.fp, patches)
+        self.dirty.clear()
 
     def load(self):
+        self.saved_size = os.path.getsize(self.fp)
+        if level_format.is_binary(self.fp):
+            return level_format.load(self.fp)
         with open(self.fp, 'r') as file:
             return json.load(file)
 
-    def draw(self):
-        for i, row in enumerate(self.level['base']):
-            for j, tile in enumerate(row):
-                if isinstance(tile, list):
-                    #print(64*j, 64*i, tile[0], tile[1], tile[2], tile[3], tile[4])
-                    pix = self.parent.m_scene.addPixmap(QPixmap(tile[0]).copy(tile[1], tile[2], tile[3], tile[4]))
-                    pix.setPos(64*j, 64*i)
-                    pix.setZValue(0)
-        for i, row in enumerate(self.level['foliage']):
-            for j, tile in enumerate(row):
-                if isinstance(tile, list):
-                    #print(64*j, 64*i, tile[0], tile[1], tile[2], tile[3], tile[4])
-                    pix = self.parent.m_scene.addPixmap(QPixmap(tile[0]).copy(tile[1], tile[2], tile[3], tile[4]))
-                    pix.setPos(64*j, 64*i)
-                    pix.setZValue(1)
-        for i, row in enumerate(self.level['object']):
-            for j, tile in enumerate(row):
-                if isinstance(tile, list):
-                    for obj in tile:
-                        #print(64*j, 64*i, obj[0], obj[1], obj[2], obj[3], obj[4])
-                        pix = self.parent.m_scene.addPixmap(QPixmap(obj[0]).copy(obj[1], obj[2], obj[3], obj[4]))
-                        pix.setPos(64*j, 64*i)
-                        pix.setZValue(2)
+    def rows(self):
+        if self.world is not None:
+            return self.world.rows()
+        return len(self.level['base'])
+
+    def cols(self):
+        if self.world is not None:
+            return self.world.cols()
+        return len(self.level['base'][0]) if self.level['base'] else 0
+
+    def width(self):
+        return self.cols() * TILE_SIZE
+
+    def height(self):
+        return self.rows() * TILE_SIZE
+
+    def cell(self, layer, i, j):
+        if self.world is not None:
+            return self.world.cell(layer, i, j)
+        return self.level[layer][i][j]
+
+    def copy(self, i0, j0, i1, j1):
+        """Every layer of the cells in [i0, i1) x [j0, j1) as a level dict, for paste() or level_format.encode()"""
+        i0, j0, i1, j1 = max(i0, 0), max(j0, 0), min(i1, self.rows()), min(j1, self.cols())
+        return {layer: [[self.cell(layer, i, j) for j in range(j0, j1)] for i in range(i0, i1)] for layer in LAYERS}
+
+    def paste(self, i0, j0, cells, journal=True):
+        """Write cells, a level dict of any of the layers, with its first cell at (i0, j0)
+
+        The rect is clipped to the map, cells that fall off it are dropped. Only what the rect touches is redrawn
+        and re-indexed. journal=False keeps the edit out of the undo journal, for restoring state rather than
+        editing it.
+        """
+        if self.world is not None:
+            raise ValueError('A streamed world is read only, edit the level it was written from')
+        first = next(iter(cells.values()))
+        if not first or not first[0]:
+            return
+        # Rows and columns of cells that lie above or left of the map
+        top, left = max(-i0, 0), max(-j0, 0)
+        i1, j1 = min(i0 + len(first), self.rows()), min(j0 + len(first[0]), self.cols())
+        i0, j0 = i0 + top, j0 + left
+        if i0 >= i1 or j0 >= j1:
+            return
+        before = self.copy(i0, j0, i1, j1) if journal and self.journal is not None else None
+        for layer, block in cells.items():
+            target = self.level[layer]
+            for i in range(i0, i1):
+                target[i][j0:j1] = block[i - i0 + top][left:left + j1 - j0]
+        if before is not None:
+            self.journal.record(i0, j0, before, self.copy(i0, j0, i1, j1))
+        self.dirty.update((bi, bj) for bi in range(i0 // DIRTY_SIZE, (i1 - 1) // DIRTY_SIZE + 1)
+                          for bj in range(j0 // DIRTY_SIZE, (j1 - 1) // DIRTY_SIZE + 1))
+        self.changed(i0, j0, i1, j1)
+
+    def set_tile(self, layer, i, j, tile):
+        """tile is [sheet, x, y, w, h] or 0 for empty, a list of those for 'object' and a bool for 'walkable'"""
+        self.paste(i, j, {layer: [[tile]]})
+
+    def fill_rect(self, layer, i0, j0, i1, j1, tile):
+        self.paste(i0, j0, {layer: [[tile] * (j1 - j0) for _ in range(i1 - i0)]})
+
+    def region_loaded(self, ri, rj):
+        size = self.world.region_size
+        self.changed(ri * size, rj * size, (ri + 1) * size, (rj + 1) * size)
+
+    def changed(self, i0, j0, i1, j1):
+        """Tiles in [i0, i1) x [j0, j1) are new, bring the index, the scene and every listener up to date"""
+        if self.index is not None:
+            self.index.refresh(i0, j0, i1, j1)
+        if self.renderer is not None:
+            self.renderer.invalidate(i0, j0, i1, j1)
+        for listener in self.listeners:
+            listener(i0, j0, i1, j1)
+
+    def attach(self, parent):
+        """Give a data only level (say one built on a loader thread) a view to draw into"""
+        self.parent = parent
+        self.draw()
+
+    def draw(self, x=None, y=None):
+        if self.renderer is not None:
+            self.renderer.clear()
+        self.renderer = ChunkRenderer(self.parent.m_scene, self, tile_size=TILE_SIZE,
+                                      view_width=self.parent.width(), view_height=self.parent.height())
+        if x is not None and y is not None:     # Otherwise chunks are paged in on the first update_view
+            self.renderer.update(x, y)
+
+    def update_view(self, x, y, scale=None):
+        if self.world is not None:
+            # Block only until the regions around the first view are in, after that they stream in the background
+            self.world.update(x, y, wait=not self.loaded_view)
+        self.loaded_view = True
+        if self.renderer is not None:
+            self.renderer.update(x, y, scale)
 
 
 class Demo(QGraphicsView):
@@ -92,13 +253,13 @@ class Demo(QGraphicsView):
         self.centerOn(self.view_center[0], self.view_center[1])
         #print(self.view_center)
 
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.animate)
-        self.timer.setInterval(30)
-        self.timer.start()
+        self.loop = get_loop()
+        self.loop.add_render(self.animate)
 
         self.setRenderHint(QPainter.Antialiasing)
         self.setFrameStyle(QFrame.NoFrame)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setCacheMode(QGraphicsView.CacheBackground)
 
         self.mouse_down = False
         self.setMouseTracking(True)
@@ -106,14 +267,35 @@ class Demo(QGraphicsView):
         self.key_pressed = False
         self.shift = False
 
-        ran_foliage = lambda x: 0 if x < .75 else ['assets/tree.png', 0, 0, 128, 128]
-        ran_obj = lambda x: 0 if x < .9 else [['assets/ore.png', 0, 0, 128, 128]]
-        level = {'base': [[['assets/grass.png', 0, 0, 128, 128] for i in range(128)] for j in range(128)],
-                 'foliage': [[ran_foliage(random.uniform(0, 1)) for i in range(128)] for j in range(128)],
-                 'object': [[ran_obj(random.uniform(0, 1)) for i in range(128)] for j in range(128)],
-                 'tilted': [[0 for i in range(128)] for j in range(128)],
-                 'walkable': [[True for i in range(128)] for j in range(128)]}
-        self.level = Level(self, fp='assets/level_test.txt', level=level)
+        self.level = None
+        self.loader = None
+        self.seed = 0
+        self.load_level()
+
+    def load_level(self):
+        # Built and baked on the loader's threads, a new map can be asked for while the last one still loads
+        from loader import LevelLoader     # loader imports this module
+        if self.loader is not None:
+            self.loader.cancel()
+        if self.level is not None and self.level.renderer is not None:
+            self.level.renderer.clear()
+        self.level = None
+        seed = self.seed
+        # Kept in memory, ctrl S writes it to EDIT_FILE
+        self.loader = LevelLoader(self, level=lambda: generate(128, seed=seed).to_dict(),
+                                  spawn=self.view_center)
+        self.loader.progress.connect(self.load_progress)
+        self.loader.finished.connect(self.level_loaded)
+        self.loader.start()
+
+    def load_progress(self, done, total):
+        self.setWindowTitle('Demo Map Explorer - loading %d/%d' % (done, total))
+
+    def level_loaded(self, level):
+        self.level = level
+        self.loader = None
+        Journal(level)
+        self.setWindowTitle('Demo Map Explorer')
 
     def setup_scene(self):
         self.m_scene.setSceneRect(0, 0, 4096, 4096)
@@ -123,9 +305,10 @@ class Demo(QGraphicsView):
         linear_grad.setColorAt(1, QColor(192, 192, 255))
         self.setBackgroundBrush(linear_grad)
 
-    def animate(self):
+    def animate(self, alpha=1.0):
+        if self.level is not None:
+            self.level.update_view(self.view_center[0], self.view_center[1])
         self.centerOn(self.view_center[0], self.view_center[1])
-        self.m_scene.update()
 
     def keyPressEvent(self, event):
         key = event.key()
@@ -156,12 +339,35 @@ class Demo(QGraphicsView):
                 self.view_center = [self.view_center[0] + 50, self.view_center[1]]
             else:
                 self.view_center = [self.view_center[0] + 10, self.view_center[1]]
+        if key == Qt.Key_R:
+            self.seed += 1
+            self.load_level()
+        if self.level is not None:
+            self.edit(key, event.modifiers())
         if key == Qt.Key_Space:
             print('view_x: %d, view_y: %d' % (self.view_center[0], self.view_center[1]))
         if key == Qt.Key_Escape:
             exit()
         #super(Demo, self).keyPressEvent(event)
 
+    def edit(self, key, modifiers):
+        # P drops an ore rock on the tile in the middle of the view, ctrl Z / Y undo and redo, ctrl S saves
+        if modifiers & Qt.ControlModifier:
+            if key == Qt.Key_Z:
+                self.level.journal.undo()
+            elif key == Qt.Key_Y:
+                self.level.journal.redo()
+            elif key == Qt.Key_S:
+                if self.level.fp is None:
+                    self.level.fp = EDIT_FILE
+                    self.level.save()
+                else:
+                    self.level.save_changes()
+        elif key == Qt.Key_P:
+            i, j = self.level.index.tile_of(*self.view_center)
+            if self.level.index.in_bounds(i, j):
+                self.level.set_tile('object', i, j, [ORE])
+
     def mousePressEvent(self, event):
         mouse_x = int(event.pos().x()/WINDOW_WIDTH*4096)
         mouse_y = int(event.pos().y()/WINDOW_HEIGHT*4096)
@@ -193,6 +399,7 @@ class Demo(QGraphicsView):
 def main():
     import sys
 
+    configure_logging()
     app = QApplication(sys.argv)
 
     demo = Demo()
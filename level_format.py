@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""Compact binary level format
+
+Layout (little endian):
+    header      magic, version, rows, cols, id typecode, tile table length
+    tile table  utf-8 json {'tiles': [[sheet, x, y, w, h], ...], 'stacks': [[tile id, ...], ...]}
+    base        rows * cols ids into tiles, 0 is an empty cell
+    foliage     rows * cols ids into tiles
+    object      rows * cols ids into stacks
+    walkable    rows * cols bits
+    tilted      rows * cols bits
+Every section starts on a 4 byte boundary so the id arrays can be cast straight out of the mmap.
+
+Edits can be appended after the last section instead of rewriting the file, each one a PATCH header (magic,
+i0, j0, length) and a binary level of the cells from (i0, j0) on. load() applies them over the base in order,
+BinaryLevel only reads the base.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b'GPLV'
+VERSION = 1
+HEADER = struct.Struct('<4sHII2sI')
+PATCH_MAGIC = b'GPLP'
+PATCH = struct.Struct('<4sIII')
+TILE_LAYERS = ['base', 'foliage']
+STACK_LAYERS = ['object']
+BIT_LAYERS = ['walkable', 'tilted']
+
+
+def is_binary(fp):
+    try:
+        with open(fp, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
+def _pack_bits(rows):
+    bits = bytearray(_align(-(-sum(len(row) for row in rows) // 8)))
+    n = 0
+    for row in rows:
+        for value in row:
+            if value not in (0, 1):
+                raise ValueError('Bit layers only hold True/False or 0/1, got %r' % (value,))
+            if value:
+                bits[n >> 3] |= 1 << (n & 7)
+            n += 1
+    return bits
+
+
+def encode(level):
+    rows = len(level['base'])
+    cols = len(level['base'][0]) if rows else 0
+    tiles = {}
+    stacks = {}
+
+    def tile_id(tile):
+        key = tuple(tile)
+        if key not in tiles:
+            tiles[key] = len(tiles) + 1
+        return tiles[key]
+
+    def stack_id(stack):
+        key = tuple(tile_id(tile) for tile in stack)
+        if key not in stacks:
+            stacks[key] = len(stacks) + 1
+        return stacks[key]
+
+    ids = {}
+    for layer in TILE_LAYERS:
+        ids[layer] = [tile_id(cell) if isinstance(cell, list) else 0 for row in level[layer] for cell in row]
+    for layer in STACK_LAYERS:
+        ids[layer] = [stack_id(cell) if isinstance(cell, list) else 0 for row in level[layer] for cell in row]
+    for layer in TILE_LAYERS + STACK_LAYERS:
+        if len(ids[layer]) != rows * cols:
+            raise ValueError('Layer %s is not %d x %d' % (layer, rows, cols))
+
+    typecode = 'H' if max(len(tiles), len(stacks)) < 0xFFFF else 'I'
+    raw = {}
+    for layer in TILE_LAYERS + STACK_LAYERS:
+        data = array(typecode, ids[layer])
+        if sys.byteorder != 'little':
+            data.byteswap()
+        raw[layer] = data.tobytes()
+    bits = {layer: _pack_bits(level[layer]) for layer in BIT_LAYERS}
+    return pack(rows, cols, typecode, [list(tile) for tile in tiles], [list(stack) for stack in stacks], raw, bits)
+
+
+def pack(rows, cols, typecode, tiles, stacks, ids, bits):
+    """Lay out already encoded sections, ids are little endian typecode bytes and bits are packed low bit first"""
+    table = json.dumps({'tiles': tiles, 'stacks': stacks}).encode('utf-8')
+    table += b' ' * (_align(len(table)) - len(table))
+
+    out = bytearray(HEADER.pack(MAGIC, VERSION, rows, cols, typecode.encode('ascii').ljust(2), len(table)))
+    out += table
+    for layer in TILE_LAYERS + STACK_LAYERS:
+        raw = bytes(ids[layer])
+        out += raw + bytes(_align(len(raw)) - len(raw))
+    for layer in BIT_LAYERS:
+        raw = bytes(bits[layer])
+        out += raw + bytes(_align(len(raw)) - len(raw))
+    return bytes(out)
+
+
+def save(level, fp):
+    # Written next to fp and swapped in whole, a reader never maps a half written file
+    tmp = fp + '.tmp'
+    with open(tmp, 'wb') as file:
+        file.write(encode(level))
+    os.replace(tmp, fp)
+
+
+def append(fp, patches):
+    """Add (i0, j0, binary level) patches to the end of a level file"""
+    with open(fp, 'ab') as file:
+        for i0, j0, data in patches:
+            file.write(PATCH.pack(PATCH_MAGIC, i0, j0, len(data)))
+            file.write(data + bytes(_align(len(data)) - len(data)))
+
+
+class BinaryLevel:
+    """Read only view over a binary level file, cells are decoded on access straight from the mmap"""
+
+    def __init__(self, fp=None, data=None):
+        self.file = None
+        self.map = None
+        if data is None:
+            self.file = open(fp, 'rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            data = self.map
+        self.data = memoryview(data)
+        magic, version, self.n_rows, self.n_cols, typecode, table_len = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a binary level file')
+        if version != VERSION:
+            raise ValueError('Unsupported binary level version %d' % version)
+        self.typecode = typecode.decode('ascii').strip()
+        offset = HEADER.size
+        table = json.loads(bytes(self.data[offset:offset + table_len]).decode('utf-8'))
+        offset += table_len
+        # Index 0 is the empty cell, tile and stack ids start at 1
+        self.tiles = [0] + table['tiles']
+        self.stacks = [0] + [[self.tiles[tile] for tile in stack] for stack in table['stacks']]
+        self.ids = {}
+        n = self.n_rows * self.n_cols
+        size = array(self.typecode).itemsize * n
+        for layer in TILE_LAYERS + STACK_LAYERS:
+            view = self.data[offset:offset + size]
+            if sys.byteorder != 'little':
+                view = array(self.typecode, view.tobytes())
+                view.byteswap()
+            else:
+                view = view.cast(self.typecode)
+            self.ids[layer] = view
+            offset += _align(size)
+        self.bits = {}
+        size = _align(-(-n // 8))
+        for layer in BIT_LAYERS:
+            self.bits[layer] = self.data[offset:offset + size]
+            offset += size
+        self.end = offset
+        self.patched = offset < len(self.data)    # Edits were appended, see patches()
+
+    def rows(self):
+        return self.n_rows
+
+    def cols(self):
+        return self.n_cols
+
+    def values(self, layer):
+        return self.stacks if layer in STACK_LAYERS else self.tiles
+
+    def cell(self, layer, i, j):
+        n = i * self.n_cols + j
+        if layer in BIT_LAYERS:
+            bit = (self.bits[layer][n >> 3] >> (n & 7)) & 1
+            return bool(bit) if layer == 'walkable' else bit
+        return self.values(layer)[self.ids[layer][n]]
+
+    def row(self, layer, i):
+        start = i * self.n_cols
+        if layer in BIT_LAYERS:
+            bits = self.bits[layer]
+            cast = bool if layer == 'walkable' else int
+            return [cast((bits[n >> 3] >> (n & 7)) & 1) for n in range(start, start + self.n_cols)]
+        values = self.values(layer)
+        return [values[k] for k in self.ids[layer][start:start + self.n_cols]]
+
+    def patches(self):
+        """(i0, j0, binary level) appended after the base, oldest first"""
+        offset = self.end
+        while offset < len(self.data):
+            magic, i0, j0, length = PATCH.unpack_from(self.data, offset)
+            if magic != PATCH_MAGIC:
+                raise ValueError('Bad patch at byte %d' % offset)
+            offset += PATCH.size
+            yield i0, j0, bytes(self.data[offset:offset + length])
+            offset += _align(length)
+
+    def to_dict(self):
+        """Cells that used the same tile share one list, treat them as immutable and replace rather than edit"""
+        return {layer: [self.row(layer, i) for i in range(self.n_rows)]
+                for layer in BIT_LAYERS + TILE_LAYERS + STACK_LAYERS}
+
+    def close(self):
+        # Views have to go before the mmap can be closed
+        self.ids = {}
+        self.bits = {}
+        self.data.release()
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load(fp):
+    with BinaryLevel(fp) as level:
+        out = level.to_dict()
+        patches = list(level.patches())
+    for i0, j0, data in patches:
+        with BinaryLevel(data=data) as patch:
+            for layer, rows in patch.to_dict().items():
+                for i, row in enumerate(rows):
+                    out[layer][i0 + i][j0:j0 + len(row)] = row
+    return out
+
+
+def convert(src, dst):
+    with open(src, 'r') as file:
+        level = json.load(file)
+    save(level, dst)
+    if load(dst) != level:
+        raise ValueError('%s did not survive the round trip to %s' % (src, dst))
+
+
+def main():
+    if len(sys.argv) != 3:
+        print('usage: %s level.txt level.lvl' % sys.argv[0])
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""Point lights and blob shadows composed into one low resolution light map per frame
+
+The light map covers the visible part of the scene at one texel per RESOLUTION scene pixels. Each light adds a
+falloff kernel that is built once per radius, colour and intensity, so a frame costs one array add per visible
+light. Shadows come from the level's foliage and object tiles (the spatial index already flags them) plus any
+dynamic occluders: every texel looks one shadow length back towards the light weighted direction and is
+darkened if something is standing there. The result is drawn over the scene in a single multiply pass.
+"""
+
+from math import ceil, floor, log2
+
+import numpy as np
+
+from PyQt5.QtCore import QRectF, Qt
+from PyQt5.QtGui import QImage, QPainter
+from PyQt5.QtWidgets import QGraphicsItem
+from game_loop import get_loop
+
+RESOLUTION = 8      # Scene pixels per light map texel
+AMBIENT = (.3, .32, .45)
+SHADOW = .55        # How much light a shadow takes away
+REACH = 40          # Shadow length in scene pixels
+BLOB = .35          # Shadow blob radius in tiles
+OFFSET = 64         # Tiles are drawn 128 px from their cell corner, what stands on them is centred about here
+Z = 100             # Above the level and every sprite
+
+
+class Light:
+    def __init__(self, x=0, y=0, radius=256, colour=(255, 220, 160), intensity=1.0):
+        self.x = x
+        self.y = y
+        self.radius = radius
+        self.colour = colour
+        self.intensity = intensity
+
+    def move(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class LightMapItem(QGraphicsItem):
+    """Draws the light map image stretched over its scene rect with multiply blending"""
+
+    def __init__(self):
+        super(LightMapItem, self).__init__()
+        self.rect = QRectF()
+        self.image = QImage()
+        self.setZValue(Z)
+        self.setAcceptedMouseButtons(Qt.NoButton)
+
+    def set_image(self, image, rect):
+        if rect != self.rect:
+            self.prepareGeometryChange()
+            self.rect = rect
+        self.image = image
+        self.update()
+
+    def boundingRect(self):
+        return self.rect
+
+    def paint(self, painter, option, widget=None):
+        painter.setCompositionMode(QPainter.CompositionMode_Multiply)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(self.rect, self.image)
+
+
+class LightMap:
+    def __init__(self, view, index=None, loop=None, resolution=RESOLUTION, ambient=AMBIENT, shadow=SHADOW,
+                 reach=REACH, offset=OFFSET):
+        self.view = view
+        self.index = index      # SpatialIndex whose occupied tiles cast shadows, None for no static shadows
+        self.loop = get_loop() if loop is None else loop
+        self.resolution = resolution
+        self.ambient = np.array(ambient, np.float32)
+        self.shadow = shadow
+        self.reach = reach
+        self.offset = offset
+        self.lights = []
+        self.occluders = []     # occluder() -> (x, y, radius) in scene pixels, for things that move
+        self.kernels = {}       # (res, radius, colour, intensity) -> (rgb, weight, unit x, unit y)
+        self.static = None      # (window, occupancy) for the last window, static shadows only change with it
+        self.pixels = None
+        self.item = LightMapItem()
+        self.enabled = False
+
+    def add_light(self, light):
+        self.lights.append(light)
+        return light
+
+    def remove_light(self, light):
+        self.lights.remove(light)
+
+    def add_occluder(self, occluder):
+        self.occluders.append(occluder)
+
+    def invalidate(self, *rect):
+        """Tiles changed, hook to Level.listeners"""
+        self.static = None
+
+    def toggle(self):
+        if self.enabled:
+            self.view.scene().removeItem(self.item)
+            self.loop.remove_render(self.frame)
+        else:
+            self.view.scene().addItem(self.item)
+            self.loop.add_render(self.frame)
+            self.pixels = None
+        self.enabled = not self.enabled
+
+    def kernel(self, light, res):
+        key = (res, light.radius, tuple(light.colour), light.intensity)
+        kernel = self.kernels.get(key)
+        if kernel is None:
+            r = ceil(light.radius / res)
+            y, x = np.mgrid[-r:r + 1, -r:r + 1].astype(np.float32)
+            distance = np.hypot(x, y)
+            weight = np.clip(1 - distance / max(r, 1), 0, 1) ** 2 * light.intensity
+            rgb = weight[..., None] * (np.array(light.colour, np.float32) / 255)
+            distance[r, r] = 1
+            kernel = self.kernels[key] = (rgb, weight, weight * x / distance, weight * y / distance)
+        return kernel
+
+    def occupancy(self, ty0, tx0, h, w, res):
+        window = (ty0, tx0, h, w, res)
+        if self.static is not None and self.static[0] == window:
+            return self.static[1].copy()
+        occupancy = np.zeros((h, w), np.float32)
+        if self.index is not None:
+            tile = self.index.tile_size
+            # Texel centres in tiles, shifted to where the things standing on a cell are drawn
+            fy = ((ty0 + np.arange(h) + .5) * res - self.offset) / tile
+            fx = ((tx0 + np.arange(w) + .5) * res - self.offset) / tile
+            i, j = np.floor(fy).astype(np.intp), np.floor(fx).astype(np.intp)
+            inside = ((i >= 0) & (i < self.index.rows))[:, None] & ((j >= 0) & (j < self.index.cols))[None, :]
+            occupied = self.index.occupied[np.clip(i, 0, self.index.rows - 1)][:, np.clip(j, 0, self.index.cols - 1)]
+            # One round blob per occupied cell, with a texel of soft edge
+            distance = np.hypot((fy - i - .5)[:, None], (fx - j - .5)[None, :])
+            blob = np.clip((BLOB - distance) * tile / res, 0, 1)
+            occupancy[:] = blob * ((occupied > 0) & inside)
+        self.static = (window, occupancy)
+        return occupancy.copy()
+
+    def compose(self, x0, y0, x1, y1, res=None):
+        """RGBX bytes of the light map over the scene rect, and the texel aligned rect they cover"""
+        res = self.resolution if res is None else res
+        tx0, ty0 = floor(x0 / res), floor(y0 / res)
+        w, h = ceil(x1 / res) - tx0, ceil(y1 / res) - ty0
+        light = np.zeros((h, w, 3), np.float32)
+        total = np.zeros((h, w), np.float32)
+        dir_x = np.zeros((h, w), np.float32)
+        dir_y = np.zeros((h, w), np.float32)
+        for source in self.lights:
+            rgb, weight, unit_x, unit_y = self.kernel(source, res)
+            r = weight.shape[0] // 2
+            cx, cy = round(source.x / res) - tx0, round(source.y / res) - ty0
+            a0, a1 = max(cy - r, 0), min(cy + r + 1, h)
+            b0, b1 = max(cx - r, 0), min(cx + r + 1, w)
+            if a0 >= a1 or b0 >= b1:
+                continue
+            k = (slice(a0 - cy + r, a1 - cy + r), slice(b0 - cx + r, b1 - cx + r))
+            light[a0:a1, b0:b1] += rgb[k]
+            total[a0:a1, b0:b1] += weight[k]
+            dir_x[a0:a1, b0:b1] += unit_x[k]
+            dir_y[a0:a1, b0:b1] += unit_y[k]
+
+        occupancy = self.occupancy(ty0, tx0, h, w, res)
+        for occluder in self.occluders:
+            x, y, radius = occluder()
+            cx, cy, r = (x / res) - tx0, (y / res) - ty0, max(radius / res, 1)
+            a0, a1 = max(int(cy - r), 0), min(int(cy + r) + 2, h)
+            b0, b1 = max(int(cx - r), 0), min(int(cx + r) + 2, w)
+            if a0 < a1 and b0 < b1:
+                yy, xx = np.mgrid[a0:a1, b0:b1]
+                disc = np.clip(r + .5 - np.hypot(xx - cx, yy - cy), 0, 1)
+                np.maximum(occupancy[a0:a1, b0:b1], disc, out=occupancy[a0:a1, b0:b1])
+
+        # Look back towards the lights, a texel is in shadow when an occluder stands there
+        lit = total > 1e-4
+        norm = np.where(lit, total, 1)
+        reach = self.reach / res
+        rows = np.arange(h)[:, None] - np.rint(dir_y / norm * reach).astype(np.intp)
+        cols = np.arange(w)[None, :] - np.rint(dir_x / norm * reach).astype(np.intp)
+        shade = occupancy[np.clip(rows, 0, h - 1), np.clip(cols, 0, w - 1)] * lit
+        # Occluders do not shadow themselves
+        shade *= 1 - occupancy
+        light *= (1 - shade * self.shadow)[..., None]
+
+        pixels = np.empty((h, w, 4), np.uint8)
+        pixels[..., :3] = np.clip(self.ambient + light, 0, 1) * 255
+        pixels[..., 3] = 255
+        return pixels, QRectF(tx0 * res, ty0 * res, w * res, h * res)
+
+    def frame(self, alpha=1.0):
+        rect = self.view.mapToScene(self.view.viewport().rect()).boundingRect()
+        # Zoomed out the texels grow with the view so a frame costs about the same at any zoom
+        res = self.resolution << max(0, floor(log2(1 / self.view.transform().m11())))
+        pixels, rect = self.compose(rect.left(), rect.top(), rect.right(), rect.bottom(), res)
+        # Nothing moved, the light map on screen is still right and the scene needs no repaint
+        if self.pixels is not None and rect == self.item.rect and np.array_equal(pixels, self.pixels):
+            return
+        self.pixels = pixels
+        h, w = pixels.shape[:2]
+        image = QImage(pixels.data, w, h, w * 4, QImage.Format_RGBX8888).copy()
+        self.item.set_image(image, rect)
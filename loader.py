@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""Loads a level off the GUI thread and fills the scene a few chunks per frame, nearest the spawn first
+
+Parsing, building the spatial index and baking chunk QImages all happen on a worker pool. The GUI thread only
+turns finished images into pixmaps and adds them to the scene, and never for longer than budget seconds a
+frame, so a map switch (cancel() the old loader, start a new one) does not stall input.
+"""
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from game_loop import get_loop
+from level import Level
+from logs import get_log
+
+WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+FRAME_BUDGET = 0.004    # Seconds of GUI thread work per frame
+
+LOG = get_log('loader')
+
+
+class LevelLoader(QObject):
+    progress = pyqtSignal(int, int)     # chunks in the scene, chunks to load
+    finished = pyqtSignal(object)       # the Level, drawing into the view
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, view, fp=None, level=None, spawn=None, workers=WORKERS, budget=FRAME_BUDGET, loop=None):
+        """level may be a dict or a callable returning one, called on the worker. spawn defaults to the middle"""
+        super(LevelLoader, self).__init__()
+        self.view = view
+        self.fp = fp
+        self.source = level
+        self.spawn = spawn
+        self.budget = budget
+        self.loop = get_loop() if loop is None else loop
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.results = queue.Queue()
+        self.stop = threading.Event()
+        self.futures = []
+        self.level = None
+        self.done = 0
+        self.total = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.futures.append(self.pool.submit(self._parse))
+        self.loop.add_render(self.pump)
+        return self
+
+    def cancel(self):
+        if not self.running:
+            return
+        self._finish()
+        for future in self.futures:
+            future.cancel()
+        if self.level is not None and self.level.renderer is not None:
+            self.level.renderer.clear()
+        if self.level is not None and self.level.world is not None:
+            self.level.world.close()
+        self.level = None
+        self.cancelled.emit()
+
+    def _finish(self):
+        self.running = False
+        self.stop.set()
+        self.loop.remove_render(self.pump)
+        self.pool.shutdown(wait=False)
+
+    def _parse(self):
+        try:
+            level = self.source() if callable(self.source) else self.source
+            level = Level(fp=self.fp, level=level)
+            x, y = self.spawn if self.spawn is not None else (level.width() / 2, level.height() / 2)
+            if level.world is not None and not self.stop.is_set():
+                level.world.update(x, y, wait=True)
+            if self.stop.is_set():
+                if level.world is not None:
+                    level.world.close()
+                return
+            self.results.put(('parsed', (level, x, y)))
+        except Exception as error:
+            self.results.put(('failed', error))
+
+    def _bake(self, renderer, ci, cj):
+        if self.stop.is_set():
+            return
+        try:
+            self.results.put(('baked', (ci, cj, renderer.bake_images(ci, cj))))
+        except Exception as error:
+            self.results.put(('failed', error))
+
+    def pump(self, alpha=1.0):
+        """Render callback, moves finished work into the scene until this frame's budget is spent"""
+        deadline = perf_counter() + self.budget
+        while self.running and perf_counter() < deadline:
+            try:
+                kind, payload = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'parsed':
+                self._parsed(*payload)
+            elif kind == 'baked':
+                self.level.renderer.provide(*payload)
+                self.done += 1
+                self.progress.emit(self.done, self.total)
+            else:
+                LOG.warning('failed', 'Loading %s failed: %s', self.fp, payload)
+                self._finish()
+                self.failed.emit(str(payload))
+                return
+            if self.level is not None and self.done == self.total:
+                self._finish()
+                self.finished.emit(self.level)
+
+    def _parsed(self, level, x, y):
+        self.level = level
+        level.attach(self.view)
+        renderer = level.renderer
+        renderer.center = center = renderer.chunk_of(x, y)
+        keys = sorted(renderer.wanted(*center), key=lambda k: abs(k[0] - center[0]) + abs(k[1] - center[1]))
+        self.total = len(keys)
+        self.progress.emit(0, self.total)
+        for ci, cj in keys:
+            self.futures.append(self.pool.submit(self._bake, renderer, ci, cj))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+"""Levelled logging for hot paths, a disabled level costs one isEnabledFor check and nothing is formatted
+
+Importing this sets nothing up, the scripts' main() calls configure_logging() so a host program keeps its own.
+"""
+
+import logging
+from time import monotonic
+
+
+def configure_logging(level=logging.WARNING):
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s', level=level)
+
+
+class RateLimitedLog:
+    """Wraps a logger so each message key is emitted at most once per interval seconds"""
+
+    def __init__(self, name, interval=1.0):
+        self.log = logging.getLogger(name)
+        self.interval = interval
+        self.last = {}
+
+    def _emit(self, level, key, msg, args):
+        if not self.log.isEnabledFor(level):
+            return
+        now = monotonic()
+        if now - self.last.get(key, -self.interval) < self.interval:
+            return
+        self.last[key] = now
+        self.log.log(level, msg, *args)
+
+    def debug(self, key, msg, *args):
+        self._emit(logging.DEBUG, key, msg, args)
+
+    def info(self, key, msg, *args):
+        self._emit(logging.INFO, key, msg, args)
+
+    def warning(self, key, msg, *args):
+        self._emit(logging.WARNING, key, msg, args)
+
+
+def get_log(name, interval=1.0):
+    return RateLimitedLog(name, interval)
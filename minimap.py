@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""Overview of the whole level in a corner of the view
+
+One sampled cell per minimap pixel, coloured with the average colour of its tiles, so the cost and memory only
+depend on the minimap size and never on the size of the world. Rows are sampled a few per frame and resampled
+when the level reports a change, a streamed world fills in as its regions load.
+"""
+
+from math import ceil
+from time import perf_counter
+
+import numpy as np
+
+from PyQt5.QtCore import QRectF, Qt
+from PyQt5.QtGui import QColor, QImage, QPainter, QPen, QPixmap
+from PyQt5.QtWidgets import QLabel
+from chunks import LAYERS, TILE_SIZE, cell_tiles
+from texture_cache import get_pix
+
+SIZE = 192
+FRAME_BUDGET = 0.002
+
+
+class Minimap:
+    def __init__(self, view, level, loop, size=SIZE, budget=FRAME_BUDGET):
+        self.view = view
+        self.level = level
+        self.loop = loop
+        self.budget = budget
+        self.step = max(1, ceil(max(level.rows(), level.cols()) / size))
+        self.w = ceil(level.cols() / self.step)
+        self.h = ceil(level.rows() / self.step)
+        self.pixels = np.zeros((self.h, self.w, 4), np.uint8)     # RGBA, premultiplied
+        self.pending = set(range(self.h))
+        self.colours = {}   # tile -> premultiplied RGBA floats
+        self.camera = None
+        self.label = QLabel(view)
+        self.label.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.label.setStyleSheet('background-color: rgba(0, 0, 0, 160); padding: 2px;')
+        self.label.hide()
+        level.listeners.append(self.invalidate)
+
+    def toggle(self):
+        if self.label.isVisible():
+            self.label.hide()
+            self.loop.remove_render(self.frame)
+        else:
+            self.label.show()
+            self.loop.add_render(self.frame)
+            self.redraw()
+
+    def invalidate(self, i0, j0, i1, j1):
+        self.pending.update(range(i0 // self.step, min(ceil(i1 / self.step), self.h)))
+
+    def colour(self, tile):
+        key = tuple(tile)
+        colour = self.colours.get(key)
+        if colour is None:
+            # Smooth scaling down to one pixel averages the whole tile
+            pixel = get_pix(*tile).toImage().scaled(1, 1, Qt.IgnoreAspectRatio, Qt.SmoothTransformation).pixelColor(0, 0)
+            alpha = pixel.alphaF()
+            colour = np.array([pixel.red() * alpha, pixel.green() * alpha, pixel.blue() * alpha, alpha * 255])
+            self.colours[key] = colour
+        return colour
+
+    def sample(self, r):
+        i = r * self.step
+        for c in range(self.w):
+            j = c * self.step
+            out = np.zeros(4)
+            for layer, _ in LAYERS:
+                for tile in cell_tiles(layer, self.level.cell(layer, i, j)):
+                    colour = self.colour(tile)
+                    out = out * (1 - colour[3] / 255) + colour
+            self.pixels[r, c] = out
+
+    def frame(self, alpha):
+        changed = False
+        deadline = perf_counter() + self.budget
+        while self.pending and perf_counter() < deadline:
+            self.sample(self.pending.pop())
+            changed = True
+        camera = self.view.mapToScene(self.view.viewport().rect()).boundingRect()
+        camera = tuple(round(v / (TILE_SIZE * self.step)) for v in
+                       (camera.x(), camera.y(), camera.width(), camera.height()))
+        if changed or camera != self.camera:
+            self.camera = camera
+            self.redraw()
+
+    def redraw(self):
+        image = QImage(self.pixels.data, self.w, self.h, self.w * 4, QImage.Format_RGBA8888_Premultiplied)
+        pix = QPixmap.fromImage(image)
+        if self.camera is not None:
+            painter = QPainter(pix)
+            painter.setPen(QPen(QColor(255, 255, 255), 1))
+            painter.drawRect(QRectF(*self.camera))
+            painter.end()
+        self.label.setPixmap(pix)
+        self.label.adjustSize()
+        corner = self.view.viewport().geometry().bottomRight()
+        self.label.move(corner.x() - self.label.width() - 8, corner.y() - self.label.height() - 8)
@@ -0,0 +1,631 @@
+#!/usr/bin/env python3
+
+"""Authoritative server for a HeadlessWorld over asyncio, the player Demo's client end and bots for load tests
+
+Clients only send input, one controls.Command per tick, and the server applies it through the same Controller
+the Demo uses locally. After every tick each client gets one batch: the level chunks near its player it has not
+had yet and a delta of the entities near it. A row that enters the client's area, or whose bounds change, goes
+out once as a whole snapshot.ENTITY record. After that only a MOTION record (float32 position and velocity)
+is sent, on ticks they changed, with a STATE record after it when speed or stamina changed too, plus the rows
+that left its area, so a client costs what is happening around it rather than what is in the world. The
+client's copy is at most a float32 rounding off, prev_pos it keeps itself. Rows are bucketed into a coarse
+grid once a tick, which keeps the per client query to a few slices.
+
+The Demo predicts its own player with its input and only moves it to the server's position when the two differ
+at the last command the server applied. Everything else it is sent is stored as is.
+
+Frames are a kind byte and a uint32 length, then the payload:
+    HELLO       utf-8 json {'x': spawn x, 'y': spawn y}, both optional
+    WELCOME     utf-8 json {'row', 'x', 'y', 'tick', 'sim_rate', 'rows', 'cols', 'tile_size'}
+    COMMAND     one Command, as save_log writes it
+    UPDATE      UPDATE_HEADER, removed rows (uint32), entered rows (uint32), their ENTITY records,
+                MOTION records, STATE records for the MOTION records flagged with STATE_FOLLOWS
+    CHUNK       CHUNK_HEADER, binary level of the chunk
+"""
+
+import asyncio
+import json
+import queue
+import struct
+import sys
+import threading
+from collections import deque
+from math import ceil, floor, isfinite
+from time import perf_counter
+
+import numpy as np
+
+from controls import WAYS, Command, Controller, decode_command, encode_command
+from logs import configure_logging, get_log
+from pathfinding import Pathfinder
+from snapshot import ENTITY, apply_patch, patch
+from world import EMPTY
+
+PORT = 7777
+RADIUS = 1024           # Scene pixels either side of a player that its client is sent entities for
+CELL = 256              # Interest grid cell in scene pixels
+CHUNK = 16              # Tiles per side of a level chunk
+CHUNKS_PER_TICK = 4     # Level chunks a client is sent per tick at most, nearest first
+MAX_BUFFERED = 1 << 20  # Bytes queued on a socket before its client skips ticks, the next delta catches it up
+MAX_LAG = 0.25          # Seconds the server may fall behind before it stops trying to catch up
+SNAP = 2.0              # Scene pixels the predicted player may be off the server's before it is moved
+MAX_COMMANDS = 8        # Commands queued per client, older ones are dropped so input lag cannot pile up
+TIMEOUT = 10
+
+FRAME = struct.Struct('<BI')
+HELLO, WELCOME, COMMAND, UPDATE, CHUNK_DATA = range(5)
+# tick, tick of the last command applied (-1 none), removed, entered, moved and state records
+UPDATE_HEADER = struct.Struct('<QqIIII')
+MOTION = np.dtype([('row', '<u4'), ('pos', '<f4', (2,)), ('vel', '<f4', (2,)), ('flags', 'u1')])
+STATE = np.dtype([('speed', '<f4'), ('stamina', '<f4')])
+STATE_FOLLOWS = 1       # MOTION flag, the row's speed or stamina changed and a STATE record has them
+# ENTITY fields by how they are sent, each part has its own tick it last changed on
+PARTS = {'motion': ('pos', 'vel'), 'state': ('speed', 'stamina'),
+         'static': ('alive', 'min_pos', 'max_pos', 'stamina_fade')}
+CHUNK_HEADER = struct.Struct('<II')         # i0, j0
+LAYERS = ['base', 'foliage', 'object', 'walkable', 'tilted']
+LOG = get_log('network')
+
+
+def frame(kind, payload):
+    return FRAME.pack(kind, len(payload)) + payload
+
+
+async def read_frame(reader):
+    kind, length = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return kind, await reader.readexactly(length)
+
+
+def checked(command):
+    """command, after making sure the Controller can apply it, a bad one would fail the whole server tick"""
+    def point(value):
+        return value is None or (isinstance(value, tuple) and len(value) == 2 and
+                                 all(isinstance(v, (int, float)) and isfinite(v) for v in value))
+
+    if not (isinstance(command.tick, int) and isinstance(command.ways, tuple) and
+            all(way in WAYS for way in command.ways) and point(command.pointer) and point(command.goal) and
+            isinstance(command.drag, bool) and isinstance(command.sprint, bool) and
+            isinstance(command.actions, tuple) and all(isinstance(action, str) for action in command.actions)):
+        raise ValueError('Bad command %r' % (command,))
+    return command
+
+
+def blank_level(rows, cols):
+    """An in memory level of nothing, for a client to fill in with chunks as they come"""
+    return {layer: [[EMPTY.get(layer, 0)] * cols for _ in range(rows)] for layer in LAYERS}
+
+
+def decode_update(payload):
+    """(tick, ack, removed rows, entered rows, their ENTITY records, MOTION records, STATE records)
+
+    Arrays are views into payload.
+    """
+    tick, ack, removed, entered, moved, states = UPDATE_HEADER.unpack_from(payload)
+    offset = UPDATE_HEADER.size
+    out = [tick, ack]
+    for dtype, count in [('<u4', removed), ('<u4', entered), (ENTITY, entered), (MOTION, moved), (STATE, states)]:
+        out.append(np.frombuffer(payload, dtype, count, offset))
+        offset += count * np.dtype(dtype).itemsize
+    return tuple(out)
+
+
+class Interest:
+    """Live store rows sorted by the CELL square they are in, redone once a tick and shared by every client"""
+
+    def __init__(self, width, height, cell=CELL):
+        self.cell = cell
+        self.rows = max(1, ceil(height / cell))
+        self.cols = max(1, ceil(width / cell))
+        self.store = None
+        self.members = np.empty(0, np.int64)
+        self.keys = np.empty(0, np.int64)
+
+    def update(self, store):
+        self.store = store
+        alive = np.flatnonzero(store.alive[:store.count])
+        pos = store.pos[alive]
+        i = np.clip(np.floor(pos[:, 1] / self.cell), 0, self.rows - 1).astype(np.int64)
+        j = np.clip(np.floor(pos[:, 0] / self.cell), 0, self.cols - 1).astype(np.int64)
+        keys = i * self.cols + j
+        order = np.argsort(keys, kind='stable')
+        self.members = alive[order]
+        self.keys = keys[order]
+
+    def near(self, x, y, radius):
+        """Sorted rows within radius of (x, y) on either axis"""
+        j0 = min(max(floor((x - radius) / self.cell), 0), self.cols - 1)
+        j1 = min(max(floor((x + radius) / self.cell), 0), self.cols - 1)
+        i0 = min(max(floor((y - radius) / self.cell), 0), self.rows - 1)
+        i1 = min(max(floor((y + radius) / self.cell), 0), self.rows - 1)
+        # Each grid row of the box is one run of keys
+        bands = np.arange(i0, i1 + 1) * self.cols
+        lo = np.searchsorted(self.keys, bands + j0, 'left')
+        hi = np.searchsorted(self.keys, bands + j1, 'right')
+        rows = np.concatenate([self.members[a:b] for a, b in zip(lo.tolist(), hi.tolist())])
+        pos = self.store.pos[rows]
+        rows = rows[(np.abs(pos[:, 0] - x) <= radius) & (np.abs(pos[:, 1] - y) <= radius)]
+        rows.sort()
+        return rows
+
+
+class Session:
+    """One connected client on the server: its player, the input it sent and what it has been sent so far"""
+
+    def __init__(self, writer, player):
+        self.writer = writer
+        self.player = player
+        self.controller = None
+        self.commands = deque(maxlen=MAX_COMMANDS)
+        self.last = None                    # Last command applied, its held keys carry on while input is late
+        self.ack = -1
+        self.rows = np.empty(0, np.int64)   # Rows the client has, sorted
+        self.tick = -1                      # Tick of the last update it was sent
+        self.chunks = set()                 # (ci, cj) the client has
+        self.sent = 0
+        self.ticks = 0
+
+    def sample(self, tick):
+        if self.commands:
+            self.last = self.commands.popleft()
+            self.ack = self.last.tick
+            return self.last
+        if self.last is None:
+            return Command(tick, (), None, False, False, ())
+        return Command(tick, self.last.ways, None, self.last.drag, self.last.sprint, ())
+
+    def update(self, tick, rows, records, modified):
+        """Batch for rows, whole records for the ones the client does not have and motion for what changed since"""
+        # Both row lists are sorted, so matching them up is a search each way
+        known = np.zeros(len(rows), bool)
+        removed = self.rows
+        if len(self.rows):
+            at = np.minimum(np.searchsorted(self.rows, rows), len(self.rows) - 1)
+            known = self.rows[at] == rows
+            if len(rows):
+                at = np.minimum(np.searchsorted(rows, self.rows), len(rows) - 1)
+                removed = self.rows[rows[at] != self.rows]
+        since = self.tick
+        self.rows = rows
+        self.tick = tick
+        entered = ~known | (modified['static'][rows] > since)
+        state = ~entered & (modified['state'][rows] > since)
+        moved = state | ~entered & (modified['motion'][rows] > since)
+        new, rows = rows[entered], rows[moved]
+        motion = np.empty(len(rows), MOTION)
+        motion['row'] = rows
+        motion['pos'] = records['pos'][rows]
+        motion['vel'] = records['vel'][rows]
+        motion['flags'] = np.where(state[moved], STATE_FOLLOWS, 0)
+        rows = rows[state[moved]]
+        states = np.empty(len(rows), STATE)
+        states['speed'] = records['speed'][rows]
+        states['stamina'] = records['stamina'][rows]
+        return b''.join([UPDATE_HEADER.pack(tick, self.ack, len(removed), len(new), len(motion), len(states)),
+                         removed.astype('<u4').tobytes(), new.astype('<u4').tobytes(), records[new].tobytes(),
+                         motion.tobytes(), states.tobytes()])
+
+
+class Server:
+    def __init__(self, world, host='127.0.0.1', port=PORT, radius=RADIUS, chunk=CHUNK):
+        self.world = world
+        self.level = world.level
+        self.host = host
+        self.port = port
+        self.radius = radius
+        self.chunk = chunk
+        self.interest = Interest(world.width(), world.height())
+        self.records = np.empty(0, ENTITY)      # Every store row as of the last tick
+        # Tick each row's PARTS last changed on
+        self.modified = {part: np.empty(0, np.int64) for part in PARTS}
+        self.sessions = []
+        self.pathfinder = Pathfinder(self.level.index, world.scheduler)
+        self.level.listeners.append(self.pathfinder.invalidate)
+        # A streamed world reports regions coming in, not edits
+        if self.level.world is None:
+            self.level.listeners.append(self.changed)
+        self.server = None
+        self.task = None
+        self.running = False
+        self.tick_time = 0.0    # Seconds per tick, simulation and sending, smoothed
+
+    def changed(self, i0, j0, i1, j1):
+        """Tiles were edited, send the chunks holding them again"""
+        stale = {(ci, cj) for ci in range(i0 // self.chunk, (i1 - 1) // self.chunk + 1)
+                 for cj in range(j0 // self.chunk, (j1 - 1) // self.chunk + 1)}
+        for session in self.sessions:
+            session.chunks -= stale
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.connected, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.running = True
+        self.task = asyncio.ensure_future(self.run())
+        LOG.info('server', 'Listening on %s:%d', self.host, self.port)
+        return self
+
+    async def stop(self):
+        self.running = False
+        self.server.close()
+        await self.server.wait_closed()
+        for session in list(self.sessions):
+            session.writer.close()
+        await self.task
+        self.pathfinder.close()
+
+    async def connected(self, reader, writer):
+        session = None
+        try:
+            kind, payload = await read_frame(reader)
+            if kind != HELLO:
+                return
+            hello = json.loads(payload.decode('utf-8'))
+            x, y = hello.get('x', self.world.width() / 2), hello.get('y', self.world.height() / 2)
+            session = Session(writer, self.world.add_player(x, y))
+            session.controller = Controller(session.player, session, self.world.scheduler,
+                                            pathfinder=self.pathfinder)
+            self.sessions.append(session)
+            index = self.level.index
+            writer.write(frame(WELCOME, json.dumps({
+                'row': session.player.row, 'x': x, 'y': y, 'tick': self.world.scheduler.ticks,
+                'sim_rate': round(1 / self.world.scheduler.sim_dt), 'rows': index.rows, 'cols': index.cols,
+                'tile_size': index.tile_size}).encode('utf-8')))
+            while True:
+                kind, payload = await read_frame(reader)
+                if kind == COMMAND:
+                    session.commands.append(checked(decode_command(payload.decode('utf-8'))))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, TypeError) as error:
+            # A frame that does not decode, the client is dropped rather than trusted with the next one
+            LOG.warning('malformed', 'Dropping client, malformed frame: %s', error)
+        finally:
+            if session is not None:
+                self.drop(session)
+            writer.close()
+
+    def drop(self, session):
+        self.sessions.remove(session)
+        session.controller.stop()
+        player = session.player
+        self.world.players.remove(player)
+        player.loop.remove_render(player.render)
+        player.store.remove(player.row)
+
+    async def run(self):
+        clock = asyncio.get_running_loop().time
+        due = clock()
+        while self.running:
+            self.tick()
+            due += self.world.scheduler.sim_dt
+            wait = due - clock()
+            if wait < -MAX_LAG:
+                due = clock()
+            await asyncio.sleep(max(wait, 0))
+
+    def tick(self):
+        start = perf_counter()
+        self.world.step()
+        self.broadcast()
+        self.tick_time += (perf_counter() - start - self.tick_time) * 0.1
+
+    def broadcast(self):
+        store = self.world.store
+        tick = self.world.scheduler.ticks
+        self.interest.update(store)
+        self.capture(tick)
+        for session in self.sessions:
+            if session.writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+                continue
+            x, y = store.pos[session.player.row].tolist()
+            batch = [frame(CHUNK_DATA, data) for data in self.chunks(session, x, y)]
+            rows = self.interest.near(x, y, self.radius)
+            batch.append(frame(UPDATE, session.update(tick, rows, self.records, self.modified)))
+            data = b''.join(batch)
+            session.writer.write(data)
+            session.sent += len(data)
+            session.ticks += 1
+
+    def capture(self, tick):
+        """Records of every row, and which parts of them changed, once for all clients"""
+        store = self.world.store
+        n = store.count
+        records = np.empty(n, ENTITY)
+        for name in ENTITY.names:
+            records[name] = getattr(store, name)[:n]
+        m = min(n, len(self.records))
+        for part, names in PARTS.items():
+            # Compared on the store's own arrays, a field by field compare of structured arrays is far slower
+            same = np.ones(m, bool)
+            for name in names:
+                equal = getattr(store, name)[:m] == self.records[name][:m]
+                same &= equal.all(1) if equal.ndim > 1 else equal
+            modified = np.full(n, tick, np.int64)
+            modified[:m][same] = self.modified[part][:m][same]
+            self.modified[part] = modified
+        self.records = records
+
+    def chunks(self, session, x, y):
+        """Chunks around (x, y) the client has not had, nearest first"""
+        size = self.chunk * self.level.index.tile_size
+        reach = ceil(self.radius / size)
+        rows, cols = self.level.rows(), self.level.cols()
+        ci, cj = floor(y / size), floor(x / size)
+        wanted = [(i, j) for i in range(max(ci - reach, 0), min(ci + reach, (rows - 1) // self.chunk) + 1)
+                  for j in range(max(cj - reach, 0), min(cj + reach, (cols - 1) // self.chunk) + 1)
+                  if (i, j) not in session.chunks]
+        wanted.sort(key=lambda key: abs(key[0] - ci) + abs(key[1] - cj))
+        out = []
+        for i, j in wanted:
+            if len(out) == CHUNKS_PER_TICK:
+                break
+            i0, j0 = i * self.chunk, j * self.chunk
+            if self.level.world is not None and not self.level.world.is_loaded(i0, j0):
+                continue
+            _, _, data = patch(self.level, i0, j0, i0 + self.chunk, j0 + self.chunk)
+            out.append(CHUNK_HEADER.pack(i0, j0) + data)
+            session.chunks.add((i, j))
+        return out
+
+
+class Client:
+    """The Demo's end, the socket lives on its own thread and the game loop pumps in what arrived once a tick
+
+    As the Controller's source it passes on the InputBuffer's commands and sends each one to the server.
+    """
+
+    def __init__(self, host='127.0.0.1', port=PORT, spawn=None):
+        self.host = host
+        self.port = port
+        self.spawn = spawn
+        self.source = None      # InputBuffer whose commands are sent, and applied locally as a prediction
+        self.inbox = queue.SimpleQueue()
+        self.welcome = None
+        self.ready = threading.Event()
+        self.thread = None
+        self.aio = None
+        self.writer = None
+        self.player = None
+        self.level = None
+        self.rows = {}          # server row -> local store row
+        self.history = {}       # command tick -> predicted player position once it was applied
+        self.previous = None    # Tick of the last command sent
+        self.received = 0
+
+    def connect(self, timeout=TIMEOUT):
+        """Blocks until the server's welcome and returns it"""
+        self.thread = threading.Thread(target=asyncio.run, args=(self._run(),), daemon=True)
+        self.thread.start()
+        if not self.ready.wait(timeout) or self.welcome is None:
+            raise ConnectionError('No welcome from %s:%d' % (self.host, self.port))
+        return self.welcome
+
+    async def _run(self):
+        self.aio = asyncio.get_running_loop()
+        try:
+            reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            hello = {} if self.spawn is None else {'x': self.spawn[0], 'y': self.spawn[1]}
+            self.writer.write(frame(HELLO, json.dumps(hello).encode('utf-8')))
+            kind, payload = await read_frame(reader)
+            if kind == WELCOME:
+                self.welcome = json.loads(payload.decode('utf-8'))
+            self.ready.set()
+            while True:
+                self.inbox.put(await read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as error:
+            LOG.warning('client', 'Connection to %s:%d closed: %s', self.host, self.port, error)
+        finally:
+            # Commands from here on are only applied locally
+            self.writer = None
+            self.ready.set()
+
+    def attach(self, player, level, loop):
+        """Start mirroring the server into player's store and level, player becomes the welcome's row"""
+        self.player = player
+        self.level = level
+        player.store.pos[player.row] = player.store.prev_pos[player.row] = (self.welcome['x'], self.welcome['y'])
+        self.rows[self.welcome['row']] = player.row
+        # Ahead of the Controller, the command sampled this tick sees the latest server state
+        loop.add_simulation(self.pump, first=True)
+
+    def close(self):
+        writer = self.writer
+        if writer is not None:
+            self.aio.call_soon_threadsafe(writer.close)
+
+    def sample(self, tick):
+        store, row = self.player.store, self.player.row
+        if self.previous is not None:
+            self.history[self.previous] = store.pos[row].copy()
+        command = self.source.sample(tick)
+        self.previous = tick
+        writer = self.writer
+        if writer is not None:
+            self.aio.call_soon_threadsafe(writer.write, frame(COMMAND, encode_command(command).encode('utf-8')))
+        return command
+
+    def pump(self):
+        while True:
+            try:
+                kind, payload = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            self.received += FRAME.size + len(payload)
+            if kind == UPDATE:
+                self.update(payload)
+            elif kind == CHUNK_DATA:
+                i0, j0 = CHUNK_HEADER.unpack_from(payload)
+                apply_patch(self.level, i0, j0, payload[CHUNK_HEADER.size:])
+
+    def local(self, rows):
+        """Local store rows for server rows, added to the store the first time they are seen"""
+        out = []
+        for row in rows.tolist():
+            local = self.rows.get(row)
+            if local is None:
+                local = self.rows[row] = self.player.store.add()
+            out.append(local)
+        return np.array(out, np.int64)
+
+    def update(self, payload):
+        tick, ack, removed, rows, records, motion, states = decode_update(payload)
+        store = self.player.store
+        mine = self.player.row
+        for row in removed.tolist():
+            local = self.rows.pop(row, None)
+            if local is not None and local != mine:
+                store.remove(local)
+        targets = self.local(rows)
+        movers = self.local(motion['row'])
+        stated = movers[(motion['flags'] & STATE_FOLLOWS) != 0]
+
+        own = targets == mine
+        if own.any():
+            record = records[own][0]
+            store.min_pos[mine] = record['min_pos']
+            store.max_pos[mine] = record['max_pos']
+        server = records['pos'][own] if own.any() else motion['pos'][movers == mine]
+        if len(server):
+            # Compare with where we had the player after the same command, not where it is now
+            predicted = self.history.get(ack)
+            if predicted is not None:
+                error = server[0] - predicted
+                if np.hypot(*error) > SNAP:
+                    store.pos[mine] += error
+                    store.prev_pos[mine] += error
+                    for key in self.history:
+                        self.history[key] += error
+        for key in [key for key in self.history if key <= ack]:
+            del self.history[key]
+        targets, records = targets[~own], records[~own]
+        for name in ENTITY.names:
+            getattr(store, name)[targets] = records[name]
+        others = movers != mine
+        movers, motion = movers[others], motion[others]
+        store.prev_pos[movers] = store.pos[movers]
+        store.pos[movers] = motion['pos']
+        store.vel[movers] = motion['vel']
+        others = stated != mine
+        stated, states = stated[others], states[others]
+        store.speed[stated] = states['speed']
+        store.stamina[stated] = states['stamina']
+
+
+class Bot:
+    """A simulated client for load tests, wanders on random keys and counts what it is sent"""
+
+    def __init__(self, host='127.0.0.1', port=PORT, spawn=None, sim_rate=None, seed=None):
+        self.host = host
+        self.port = port
+        self.spawn = spawn
+        self.sim_rate = sim_rate
+        self.rng = np.random.default_rng(seed)
+        self.rows = set()
+        self.received = 0
+        self.updates = 0
+        self.visible = 0    # Rows known, summed over updates
+        self.chunks = 0
+
+    async def run(self, seconds):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        hello = {} if self.spawn is None else {'x': self.spawn[0], 'y': self.spawn[1]}
+        writer.write(frame(HELLO, json.dumps(hello).encode('utf-8')))
+        kind, payload = await read_frame(reader)
+        welcome = json.loads(payload.decode('utf-8'))
+        dt = 1 / (self.sim_rate or welcome['sim_rate'])
+        receiving = asyncio.ensure_future(self.receive(reader))
+        clock = asyncio.get_running_loop().time
+        ways = ()
+        due = clock()
+        for tick in range(round(seconds / dt)):
+            if self.rng.random() < dt:
+                ways = tuple(self.rng.choice(['up', 'down', 'left', 'right'], self.rng.integers(0, 3), replace=False))
+            writer.write(frame(COMMAND, encode_command(Command(tick, ways, None, False, False, ())).encode('utf-8')))
+            due += dt
+            await asyncio.sleep(max(due - clock(), 0))
+        writer.close()
+        receiving.cancel()
+
+    async def receive(self, reader):
+        try:
+            while True:
+                kind, payload = await read_frame(reader)
+                self.received += FRAME.size + len(payload)
+                if kind == UPDATE:
+                    _, _, removed, rows, _, _, _ = decode_update(payload)
+                    self.rows.difference_update(removed.tolist())
+                    self.rows.update(rows.tolist())
+                    self.updates += 1
+                    self.visible += len(self.rows)
+                elif kind == CHUNK_DATA:
+                    self.chunks += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+
+async def load_test(world, bots, seconds, seed=0):
+    """Serve world on a free localhost port to bots simulated clients for seconds, and report on it"""
+    server = await Server(world, port=0).start()
+    rng = np.random.default_rng(seed)
+    clients = []
+    while len(clients) < bots:
+        x, y = rng.uniform(0, world.width()), rng.uniform(0, world.height())
+        if world.level.world is not None or world.level.index.is_walkable(x, y):
+            clients.append(Bot(port=server.port, spawn=(x, y), seed=len(clients)))
+    ticks = world.scheduler.ticks
+    start = perf_counter()
+    await asyncio.gather(*[bot.run(seconds) for bot in clients])
+    elapsed = perf_counter() - start
+    ticks = world.scheduler.ticks - ticks
+    await server.stop()
+    updates = sum(bot.updates for bot in clients) or 1
+    print('%d clients, %d entities: %.0f ticks/s, %.2f ms per tick, %.0f bytes and %.1f entities per client tick, '
+          '%d chunks per client' % (bots, world.store.count, ticks / elapsed, server.tick_time * 1000,
+                                    sum(bot.received for bot in clients) / updates,
+                                    sum(bot.visible for bot in clients) / updates,
+                                    sum(bot.chunks for bot in clients) / max(bots, 1)))
+
+
+def main():
+    # python network.py serve [level] [entities] [port]
+    # python network.py bots [count] [host:port] [seconds]
+    # python network.py test [count] [level] [entities] [seconds]
+    from engine import HeadlessWorld   # engine imports player, which imports this module
+    configure_logging()
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'test'
+    args = sys.argv[2:]
+    if mode == 'serve':
+        world = HeadlessWorld(fp=args[0] if args else 'assets/level_test.lvl')
+        world.spawn(int(args[1]) if len(args) > 1 else 1000, seed=0)
+        server = Server(world, port=int(args[2]) if len(args) > 2 else PORT)
+
+        async def serve():
+            await server.start()
+            await server.task
+
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        world.close()
+    elif mode == 'bots':
+        host, _, port = (args[1] if len(args) > 1 else '127.0.0.1:%d' % PORT).partition(':')
+        seconds = float(args[2]) if len(args) > 2 else 10
+
+        bots = [Bot(host, int(port), seed=k) for k in range(int(args[0]) if args else 10)]
+
+        async def wander():
+            await asyncio.gather(*[bot.run(seconds) for bot in bots])
+
+        asyncio.run(wander())
+        updates = sum(bot.updates for bot in bots) or 1
+        print('%d clients: %.0f bytes and %.1f entities per client tick' % (
+            len(bots), sum(bot.received for bot in bots) / updates, sum(bot.visible for bot in bots) / updates))
+    else:
+        world = HeadlessWorld(fp=args[1] if len(args) > 1 else 'assets/level_test.lvl')
+        world.spawn(int(args[2]) if len(args) > 2 else 1000, seed=0)
+        asyncio.run(load_test(world, int(args[0]) if args else 10, float(args[3]) if len(args) > 3 else 5))
+        world.close()
+
+
+if __name__ == '__main__':
+    main()
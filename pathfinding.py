@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+
+"""Paths and flow fields over the spatial index's walkable grid, cached and searched off the simulation thread
+
+find_path() is A* on the 8 connected tile grid (no cutting corners past a blocked tile) with the result pulled
+tight into straight waypoints. A flow field is one distance map around a goal that every agent heading there
+reads its direction from, the way to move hundreds of NPCs at the same spot for the price of one search.
+
+Both are cached. An A* search only ever looks at tiles inside the box it expanded, so an edit outside that box
+cannot change its answer, and invalidate() (a Level listener) drops just the paths and fields whose box the
+edited rect touches. request_path() and request_field() run the search on a worker thread and hand the result
+to the callback from pump(), which the loop runs at the start of each simulation tick. Without a callback
+request_path() returns the Future instead, for callers that need the path on a tick of their choosing.
+"""
+
+import heapq
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from math import floor, hypot, sqrt
+
+import numpy as np
+
+from game_loop import get_loop
+from logs import get_log
+
+DIAGONAL = sqrt(2)
+# (di, dj, cost), the diagonal ones last so a flow field prefers straight steps on ties
+NEIGHBOURS = [(-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0),
+              (-1, -1, DIAGONAL), (-1, 1, DIAGONAL), (1, -1, DIAGONAL), (1, 1, DIAGONAL)]
+INF = float('inf')
+# Whole number A* step costs, 14/10 is close enough to sqrt(2) and equal paths tie exactly, so the tie break
+# below can keep the search on one of them instead of opening every one
+STRAIGHT = 10
+STEP_COST = (STRAIGHT, 14)
+MAX_EXPANDED = 200000   # Tiles one search may expand before it gives up
+FIELD_RADIUS = 64       # Tiles around the goal a flow field covers
+RELABEL_MARGINS = (2, 16, 64)    # Windows around an edit relabel() looks for a way around it in
+MAX_EDITS = 256         # Edits held for the next snapshot() before it starts over from the whole grid
+
+LOG = get_log('pathfinding')
+
+
+def runs(walkable):
+    """Start and length of every horizontal run of walkable, or of blocked, tiles in walkable.ravel()"""
+    open_ = walkable.ravel()
+    edge = np.ones(open_.size, bool)
+    edge[1:] = open_[1:] != open_[:-1]
+    edge[::walkable.shape[1]] = True
+    starts = np.flatnonzero(edge)
+    return starts, np.diff(np.append(starts, open_.size))
+
+
+def label_regions(walkable):
+    """Number every 4 connected region of walkable tiles, with walkable.size for blocked ones
+
+    Diagonal moves never cut a corner, so they connect nothing 4 connectivity does not.
+    """
+    blocked = walkable.size
+    rows = runs(walkable)
+    cols = runs(walkable.T)
+    labels = np.where(walkable, np.arange(walkable.size).reshape(walkable.shape), blocked)
+    jump = np.empty(blocked + 1, labels.dtype)
+    jump[blocked] = blocked
+    while True:
+        # Every row run, then every column run, takes the smallest label in it
+        new = np.repeat(np.minimum.reduceat(labels.ravel(), rows[0]), rows[1])
+        new = np.repeat(np.minimum.reduceat(new.reshape(walkable.shape).T.ravel(), cols[0]), cols[1])
+        new = new.reshape(walkable.T.shape).T
+        # Labels are tiles of the same region, jumping to that tile's label spreads the smallest one further
+        jump[:blocked] = new.ravel()
+        new = jump[jump[new]]
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def relabel(walkable, labels, changed):
+    """Region labels for walkable from labels, the ones from before the changed tiles flipped
+
+    Only the regions around the flipped tiles are looked at. Opened tiles join or merge the regions next to them.
+    A region that lost tiles is checked in growing windows around the edit, and only relabelled whole when the
+    largest still leaves it in more than one piece that runs out of the window. Labels only tell regions apart,
+    they need not be the ones label_regions would pick.
+    """
+    if not changed.any():
+        return labels
+    blocked = walkable.size
+    lost = changed & ~walkable
+    near = np.zeros_like(lost)
+    near[1:] |= lost[:-1]
+    near[:-1] |= lost[1:]
+    near[:, 1:] |= lost[:, :-1]
+    near[:, :-1] |= lost[:, 1:]
+    split = np.unique(labels[lost]).tolist()
+    labels = labels.copy()
+    labels[lost] = blocked
+    fresh = labels.max() + 1
+    i, j = np.nonzero(changed)
+
+    def around(margin):
+        return (slice(max(i.min() - margin, 0), i.max() + margin + 1),
+                slice(max(j.min() - margin, 0), j.max() + margin + 1))
+
+    for region in split:
+        # Every piece left of the region has tiles next to the lost ones. Pieces that close up inside a window are
+        # whole, the region is only relabelled from scratch when more than one still runs out of every window
+        for margin in RELABEL_MARGINS:
+            window = around(margin)
+            inside = labels[window] == region
+            parts = label_regions(inside)
+            edge = np.unique(np.concatenate([parts[0], parts[-1], parts[:, 0], parts[:, -1]]))
+            pieces = np.unique(parts[near[window] & inside])
+            if np.isin(pieces, edge).sum() <= 1:
+                for piece in pieces[~np.isin(pieces, edge)].tolist():
+                    labels[window][parts == piece] = fresh
+                    fresh += 1
+                break
+        else:
+            mask = labels == region
+            rows, cols = np.nonzero(mask)
+            window = slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1)
+            parts = label_regions(mask[window])
+            inside = parts != parts.size
+            labels[window][inside] = parts[inside] + fresh
+            fresh += parts.size
+    window = around(1)
+    local = label_regions(walkable[window])
+    opened = changed[window] & walkable[window]
+    kept = walkable[window] & ~changed[window]
+    for part in np.unique(local[opened]).tolist():
+        tiles = local == part
+        regions = np.unique(labels[window][tiles & kept]).tolist()
+        target = regions[0] if regions else fresh
+        fresh += not regions
+        for region in regions[1:]:
+            labels[labels == region] = target
+        labels[window][tiles & opened] = target
+    return labels
+
+
+class FlowField:
+    def __init__(self, goal, i0, j0, dist, vx, vy, tile_size):
+        self.goal = goal
+        self.i0 = i0
+        self.j0 = j0
+        self.dist = dist        # Path length in tiles to the goal, inf where it cannot be reached
+        self.vx = vx            # Unit step towards the goal per tile, 0 at the goal and where unreachable
+        self.vy = vy
+        self.tile_size = tile_size
+
+    def box(self):
+        return self.i0, self.j0, self.i0 + self.dist.shape[0], self.j0 + self.dist.shape[1]
+
+    def direction(self, x, y):
+        i, j = floor(y / self.tile_size) - self.i0, floor(x / self.tile_size) - self.j0
+        if 0 <= i < self.dist.shape[0] and 0 <= j < self.dist.shape[1]:
+            return float(self.vx[i, j]), float(self.vy[i, j])
+        return 0.0, 0.0
+
+    def steer(self, store, rows, speed=None):
+        """Set store.vel for rows (an index array) towards the goal, rows outside the field head straight for it"""
+        pos = store.pos[rows]
+        speed = store.speed[rows] if speed is None else speed
+        i = np.floor(pos[:, 1] / self.tile_size).astype(np.intp) - self.i0
+        j = np.floor(pos[:, 0] / self.tile_size).astype(np.intp) - self.j0
+        h, w = self.dist.shape
+        inside = (i >= 0) & (i < h) & (j >= 0) & (j < w)
+        ic, jc = np.clip(i, 0, h - 1), np.clip(j, 0, w - 1)
+        vel = np.stack([self.vx[ic, jc], self.vy[ic, jc]], axis=1).astype(np.float64)
+        outside = ~inside
+        if outside.any():
+            gx, gy = (self.goal[1] + .5) * self.tile_size, (self.goal[0] + .5) * self.tile_size
+            away = np.array([gx, gy]) - pos[outside]
+            vel[outside] = away / np.maximum(np.hypot(away[:, 0], away[:, 1]), 1e-9)[:, None]
+        store.vel[rows] = vel * np.asarray(speed)[..., None]
+
+
+class Pathfinder:
+    def __init__(self, index, loop=None, workers=1, cache_paths=256, cache_fields=16, limit=MAX_EXPANDED):
+        self.index = index
+        self.limit = limit
+        self.cache_paths = cache_paths
+        self.cache_fields = cache_fields
+        self.paths = OrderedDict()      # (start tile, goal tile) -> (waypoints or None, box)
+        self.fields = OrderedDict()     # (goal tile, radius) -> FlowField
+        self.lock = threading.Lock()
+        self.generation = 0             # Bumped by invalidate(), results of older searches are not cached
+        self.grid = None                # (generation, walkable bytes, region labels), see snapshot()
+        self.edits = []                 # (generation, rect) of every edit since, for snapshot() to patch in
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.results = queue.Queue()
+        self.loop = get_loop() if loop is None else loop
+        self.loop.add_simulation(self.pump, first=True)
+
+    def close(self):
+        self.loop.remove_simulation(self.pump)
+        self.pool.shutdown(wait=False)
+
+    def tile(self, x, y):
+        i, j = self.index.tile_of(x, y)
+        return min(max(i, 0), self.index.rows - 1), min(max(j, 0), self.index.cols - 1)
+
+    def centre(self, i, j):
+        size = self.index.tile_size
+        return (j + .5) * size, (i + .5) * size
+
+    # Paths
+
+    def find_path(self, x0, y0, x1, y1):
+        """Waypoints in scene pixels from (x0, y0) to (x1, y1), ending on the goal itself, or None"""
+        start, goal = self.tile(x0, y0), self.tile(x1, y1)
+        key = (start, goal)
+        with self.lock:
+            hit = self.paths.get(key)
+            if hit is not None:
+                self.paths.move_to_end(key)
+            generation = self.generation
+        if hit is None:
+            hit = self.search(start, goal)
+            with self.lock:
+                # Giving up is not an answer, a later search may get further
+                if generation == self.generation and hit[1] is not None:
+                    self.paths[key] = hit
+                    while len(self.paths) > self.cache_paths:
+                        self.paths.popitem(last=False)
+        tiles = hit[0]
+        if tiles is None:
+            return None
+        return self.smooth((x0, y0), tiles[1:-1]) + [(x1, y1)]
+
+    def request_path(self, x0, y0, x1, y1, callback=None):
+        """find_path on a worker, callback(waypoints or None) is called from pump(), or a Future without one"""
+        if callback is None:
+            return self.pool.submit(self._find, x0, y0, x1, y1)
+        return self.pool.submit(self._run, callback, self.find_path, x0, y0, x1, y1)
+
+    def snapshot(self):
+        """(padded walkable bytes, region labels) for the current generation, searches never see a half edit
+
+        After edits only their rects are copied in, and regions are only relabelled when walkability changed. The
+        patch goes into a copy, a search on another worker may still be reading the old grid.
+        """
+        with self.lock:
+            grid = self.grid
+            generation = self.generation
+            edits = [rect for edited, rect in self.edits if grid is not None and edited > grid[0]]
+        if grid is None:
+            walkable = np.zeros((self.index.rows + 2, self.index.cols + 2), bool)
+            walkable[1:-1, 1:-1] = self.index.walkable
+            grid = (generation, walkable.tobytes(), label_regions(walkable).ravel())
+        elif grid[0] != generation:
+            grid = (generation,) + self.patch(grid[1], grid[2], edits)
+        with self.lock:
+            if self.grid is None or self.grid[0] < grid[0]:
+                self.grid = grid
+                self.edits = [edit for edit in self.edits if edit[0] > grid[0]]
+        return grid[1], grid[2]
+
+    def patch(self, grid, regions, edits):
+        """grid and regions with the edited rects read again from the index"""
+        rows, cols = self.index.rows, self.index.cols
+        old = np.frombuffer(grid, bool).reshape(rows + 2, cols + 2)
+        walkable = old.copy()
+        for i0, j0, i1, j1 in edits:
+            i0, j0, i1, j1 = max(i0, 0), max(j0, 0), min(i1, rows), min(j1, cols)
+            walkable[i0 + 1:i1 + 1, j0 + 1:j1 + 1] = self.index.walkable[i0:i1, j0:j1]
+        changed = walkable != old
+        if not changed.any():
+            return grid, regions
+        return walkable.tobytes(), relabel(walkable, regions.reshape(old.shape), changed).ravel()
+
+    def search(self, start, goal):
+        """A* between tiles, (tiles or None, box) where box bounds every tile the search looked at
+
+        box is None when the search gave up at the expansion limit, there may still be a path.
+        """
+        rows, cols = self.index.rows, self.index.cols
+        grid, regions = self.snapshot()
+        # Flat indices into the grid padded by a blocked border, so no neighbour needs a bounds check
+        width = cols + 2
+        s = (start[0] + 1) * width + start[1] + 1
+        g = (goal[0] + 1) * width + goal[1] + 1
+        if not grid[g] or (grid[s] and regions[s] != regions[g]):
+            # Nowhere to go, and any edit could open a way
+            return None, (0, 0, rows, cols)
+        moves = [(di * width + dj, STEP_COST[bool(di and dj)], dj if di and dj else 0, di * width if di and dj else 0)
+                 for di, dj, _ in NEIGHBOURS]
+        gi, gj = divmod(g, width)
+        lo_i, lo_j, hi_i, hi_j = min(s, g) // width, min(s % width, gj), max(s, g) // width, max(s % width, gj)
+        came = {s: -1}
+        cost = {s: 0}
+        heap = [(0, 0, s)]
+        expanded = 0
+        found = False
+        while heap:
+            _, c, node = heapq.heappop(heap)
+            c = -c
+            if node == g:
+                found = True
+                break
+            if c > cost[node]:
+                continue
+            expanded += 1
+            if expanded > self.limit:
+                break
+            i, j = divmod(node, width)
+            if i < lo_i:
+                lo_i = i
+            elif i > hi_i:
+                hi_i = i
+            if j < lo_j:
+                lo_j = j
+            elif j > hi_j:
+                hi_j = j
+            for offset, step, side_a, side_b in moves:
+                n = node + offset
+                # A diagonal step needs both tiles it passes between open
+                if not grid[n] or (side_a and not (grid[node + side_a] and grid[node + side_b])):
+                    continue
+                nc = c + step
+                if nc < cost.get(n, INF):
+                    cost[n] = nc
+                    came[n] = node
+                    # Octile distance, exact on an open grid so it never overestimates
+                    ni, nj = divmod(n, width)
+                    dy = ni - gi if ni > gi else gi - ni
+                    dx = nj - gj if nj > gj else gj - nj
+                    h = STRAIGHT * (dx + dy) + (STEP_COST[1] - 2 * STRAIGHT) * (dx if dx < dy else dy)
+                    # Ties go to the node further along, it is usually closer to the goal
+                    heapq.heappush(heap, (nc + h, -nc, n))
+        # Padded coordinates, grown by one for the neighbours that were looked at, a tile opening next to the
+        # expanded ones can change the answer
+        box = (max(lo_i - 2, 0), max(lo_j - 2, 0), min(hi_i + 1, rows), min(hi_j + 1, cols))
+        if not found:
+            return None, box if expanded <= self.limit else None
+        tiles = []
+        node = g
+        while node != -1:
+            i, j = divmod(node, width)
+            tiles.append((i - 1, j - 1))
+            node = came[node]
+        tiles.reverse()
+        return tiles, box
+
+    def smooth(self, start, tiles):
+        """Centres of the tiles that cannot be skipped by walking straight from the last waypoint to a later one"""
+        points = [self.centre(i, j) for i, j in tiles]
+        waypoints = []
+        anchor = start
+        for k in range(len(points) - 1):
+            if not self.index.walkable_move(anchor[0], anchor[1], *points[k + 1]):
+                anchor = points[k]
+                waypoints.append(anchor)
+        if points:
+            waypoints.append(points[-1])
+        return waypoints
+
+    # Flow fields
+
+    def flow_field(self, x, y, radius=FIELD_RADIUS):
+        """FlowField towards (x, y) covering radius tiles around it"""
+        goal = self.tile(x, y)
+        key = (goal, radius)
+        with self.lock:
+            field = self.fields.get(key)
+            if field is not None:
+                self.fields.move_to_end(key)
+                return field
+            generation = self.generation
+        field = self.build_field(goal, radius)
+        with self.lock:
+            if generation == self.generation:
+                self.fields[key] = field
+                while len(self.fields) > self.cache_fields:
+                    self.fields.popitem(last=False)
+        return field
+
+    def request_field(self, x, y, callback, radius=FIELD_RADIUS):
+        return self.pool.submit(self._run, callback, self.flow_field, x, y, radius)
+
+    def build_field(self, goal, radius):
+        gi, gj = goal
+        i0, j0 = max(gi - radius, 0), max(gj - radius, 0)
+        i1, j1 = min(gi + radius + 1, self.index.rows), min(gj + radius + 1, self.index.cols)
+        walkable = self.index.walkable[i0:i1, j0:j1].copy()
+        h, w = walkable.shape
+        # Padded by a blocked border so every neighbour is a plain slice
+        open_ = np.zeros((h + 2, w + 2), bool)
+        open_[1:-1, 1:-1] = walkable
+        dist = np.full((h + 2, w + 2), np.inf, np.float32)
+        goal_at = (gi - i0 + 1, gj - j0 + 1)
+        if open_[goal_at]:
+            dist[goal_at] = 0
+        inner = (slice(1, -1), slice(1, -1))
+
+        def shifted(array, di, dj):
+            return array[1 + di:h + 1 + di, 1 + dj:w + 1 + dj]
+
+        # A diagonal step needs both tiles it passes between open
+        allowed = [shifted(open_, di, dj) & shifted(open_, di, 0) & shifted(open_, 0, dj) if di and dj
+                   else shifted(open_, di, dj) for di, dj, _ in NEIGHBOURS]
+        candidate = np.empty((h, w), np.float32)
+        # Relax the whole window at once until nothing improves, one ring of tiles per pass
+        while True:
+            best = dist[inner].copy()
+            for (di, dj, step), ok in zip(NEIGHBOURS, allowed):
+                np.add(shifted(dist, di, dj), step, out=candidate)
+                candidate[~ok] = np.inf
+                np.minimum(best, candidate, out=best)
+            best[~walkable] = np.inf
+            if np.array_equal(best, dist[inner]):
+                break
+            dist[inner] = best
+
+        # Each tile points at its cheapest neighbour, the goal and unreachable tiles stay at rest
+        best = np.where(dist[inner] > 0, np.inf, -np.inf).astype(np.float32)
+        vx = np.zeros((h, w), np.float32)
+        vy = np.zeros((h, w), np.float32)
+        for (di, dj, step), ok in zip(NEIGHBOURS, allowed):
+            candidate = np.where(ok, shifted(dist, di, dj) + step, np.inf)
+            better = candidate < best
+            best[better] = candidate[better]
+            length = hypot(di, dj)
+            vx[better] = dj / length
+            vy[better] = di / length
+        return FlowField(goal, i0, j0, dist[inner], vx, vy, self.index.tile_size)
+
+    # Cache upkeep
+
+    def invalidate(self, i0, j0, i1, j1):
+        """Tiles in [i0, i1) x [j0, j1) changed, hook to Level.listeners"""
+        def touches(box):
+            return box[0] < i1 and i0 < box[2] and box[1] < j1 and j0 < box[3]
+
+        with self.lock:
+            self.generation += 1
+            if self.grid is not None:
+                self.edits.append((self.generation, (i0, j0, i1, j1)))
+            if len(self.edits) > MAX_EDITS:
+                self.grid = None
+                self.edits = []
+            for key in [key for key, (_, box) in self.paths.items() if touches(box)]:
+                del self.paths[key]
+            for key in [key for key, field in self.fields.items() if touches(field.box())]:
+                del self.fields[key]
+
+    def _find(self, *args):
+        try:
+            return self.find_path(*args)
+        except Exception as error:
+            LOG.warning('failed', 'Search find_path%s failed: %s', args, error)
+            return None
+
+    def _run(self, callback, fn, *args):
+        try:
+            result = fn(*args)
+        except Exception as error:
+            LOG.warning('failed', 'Search %s%s failed: %s', fn.__name__, args, error)
+            result = None
+        self.results.put((callback, result))
+
+    def pump(self):
+        """Hand finished searches to their callbacks, on the loop's thread"""
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except queue.Empty:
+                return
+            callback(result)
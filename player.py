@@ -2,75 +2,149 @@
 
 """Note to self Sprite(object) and Sprite() are the same in python 3"""
 
+import os
+
 from PyQt5.QtCore import QRect, QPointF, Qt, QTimer
 from PyQt5.QtGui import (QBrush, QColor, QLinearGradient, QPen, QPainter,
-                         QPixmap, QRadialGradient)
+                         QPixmap, QRadialGradient, QTransform)
 from PyQt5.QtWidgets import (QLabel, QGraphicsItem, QApplication, QFrame, QGraphicsDropShadowEffect,
                              QGraphicsEllipseItem, QGraphicsRectItem, QGraphicsScene, QGraphicsView,
                              QGraphicsPixmapItem)
-from sprite import Link
+from controls import Controller, InputBuffer, Replay, load_log
+from entities import get_store
+from game_loop import get_loop
 from level import Level
+from lighting import Light, LightMap
+from sprite import Link
+from loader import LevelLoader
+from logs import configure_logging, get_log
+from minimap import Minimap
+from network import PORT, Client, blank_level
+from pathfinding import Pathfinder
 from position import Position
+from profiler import PROFILER, ProfilerOverlay
+from snapshot import Recorder
 
 WINDOW_WIDTH = 1200
 WINDOW_HEIGHT = 800
 MAP_WIDTH = 8192
 MAP_HEIGHT = 8192
+LOG = get_log('player')
+TRACE_FILE = 'trace.json'
+REPLAY_FILE = 'replay.jsonl'
+QUICKSAVE_FILE = 'quicksave.snap'
+MIN_ZOOM = 1 / 8
+MAX_ZOOM = 2
+ZOOM_STEP = 1.25    # Per wheel notch
+TORCH_SPACING = 16  # Tiles between the demo's static lights
 
 
 class Player:
+    """A thin view onto one row of an EntityStore, the store integrates every entity's motion in one step"""
+
     def __init__(self, parent=None, x=400, y=300, sprite=None,
                  level_max_x=MAP_WIDTH-WINDOW_WIDTH, level_max_y=MAP_HEIGHT-WINDOW_HEIGHT,
-                 level_min_x=WINDOW_WIDTH/2, level_min_y=WINDOW_HEIGHT/2):
+                 level_min_x=WINDOW_WIDTH/2, level_min_y=WINDOW_HEIGHT/2, loop=None, store=None):
         self.parent = parent
-        self.pos = Position(pos=[x, y])
-        self.vel = Position(pos=[0, 0])
-        self.speed = 1
+        self.store = get_store() if store is None else store
+        self.row = self.store.add(x, y, min_pos=(level_min_x, level_min_y), max_pos=(level_max_x, level_max_y))
         self.sprite = sprite
-        self.max_pos = Position(level_max_x, level_max_y)
-        self.min_pos = Position(level_min_x, level_min_y)
-        self.stamina = 100
-        self.stamina_fade = 0
         if sprite is not None:
             self.sprite.move_sprite(self.pos)
 
-        self.delay = 8
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.simulate)
-        self.timer.setInterval(self.delay)
-        self.timer.start()
+        self.loop = get_loop() if loop is None else loop
+        self.store.attach(self.loop)
+        self.loop.add_render(self.render)
+
+    @property
+    def pos(self):
+        return Position(*self.store.pos[self.row].tolist())
+
+    @pos.setter
+    def pos(self, pos):
+        self.store.pos[self.row] = (pos.x(), pos.y())
+
+    @property
+    def prev_pos(self):
+        return Position(*self.store.prev_pos[self.row].tolist())
+
+    @property
+    def vel(self):
+        return Position(*self.store.vel[self.row].tolist())
+
+    @vel.setter
+    def vel(self, vel):
+        self.store.vel[self.row] = (vel.x(), vel.y())
+
+    @property
+    def min_pos(self):
+        return Position(*self.store.min_pos[self.row].tolist())
+
+    @min_pos.setter
+    def min_pos(self, pos):
+        self.store.min_pos[self.row] = (pos.x(), pos.y())
+
+    @property
+    def max_pos(self):
+        return Position(*self.store.max_pos[self.row].tolist())
+
+    @max_pos.setter
+    def max_pos(self, pos):
+        self.store.max_pos[self.row] = (pos.x(), pos.y())
+
+    @property
+    def speed(self):
+        return float(self.store.speed[self.row])
+
+    @speed.setter
+    def speed(self, speed):
+        self.store.speed[self.row] = speed
+
+    @property
+    def stamina(self):
+        return float(self.store.stamina[self.row])
+
+    @stamina.setter
+    def stamina(self, stamina):
+        self.store.stamina[self.row] = stamina
+
+    @property
+    def stamina_fade(self):
+        return float(self.store.stamina_fade[self.row])
+
+    @stamina_fade.setter
+    def stamina_fade(self, fade):
+        self.store.stamina_fade[self.row] = fade
 
     def set_state(self, state):
         self.sprite.set_state(state)
 
+    def send(self, event):
+        return self.sprite.send(event)
+
     def state(self):
         return self.sprite.state
 
     def mov(self):
-        print('Stamina : %s' % round(self.stamina, 2))
-        self.stamina += self.stamina_fade
-        if self.stamina > 100:
-            self.stamina = 100
-        if self.stamina < 0:
-            self.stamina = 0
-            self.speed = 1
-        self.pos = self.pos + self.vel
-        if self.pos.x() < self.min_pos.x():
-            self.pos.x(self.min_pos.x() + self.speed)
-        if self.pos.y() < self.min_pos.y():
-            self.pos.y(self.min_pos.y() + self.speed)
-        if self.pos.x() > self.max_pos.x():
-            self.pos.x(self.max_pos.x() - self.speed)
-        if self.pos.y() > self.max_pos.y():
-            self.pos.y(self.max_pos.y() - self.speed)
+        LOG.debug('stamina', 'Stamina : %.2f', self.store.stamina[self.row])
+        self.store.step(self.row)
 
     def simulate(self):
-        self.sprite.move_sprite(self.pos)
+        """Steps just this entity, the loop steps the whole store at once instead"""
+        self.store.prev_pos[self.row] = self.store.pos[self.row]
         self.mov()
 
+    def render(self, alpha):
+        # Draw between the last two simulated positions so motion stays smooth at any frame rate
+        if self.sprite is not None:
+            prev = self.store.prev_pos[self.row]
+            pos = self.store.pos[self.row]
+            self.sprite.move_sprite((prev + (pos - prev) * alpha).tolist())
+
 
 class Demo(QGraphicsView):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, replay=None, server=None, record=False):
+        """server is a network.Client to play on instead of loading the level here, record writes REPLAY_FILE"""
         super(Demo, self).__init__(parent)
         #   Setup scene
         self.m_scene = QGraphicsScene()
@@ -79,24 +153,75 @@ class Demo(QGraphicsView):
         self.setFixedSize(WINDOW_WIDTH, WINDOW_HEIGHT)
 
         #   Set up entities (not attached to this term, but basically things like light sources, level, npcs)
+        #   The level loads in the background, the player shows up once the chunks around the spawn are in
         self.m_lightSource = None
-        self.level = Level(self, fp='assets/level_test.txt')
-        self.player = Player(self, MAP_WIDTH/2, MAP_HEIGHT/2, Link(parent=self))
+        self.level = None
+        self.player = None
+        self.minimap = None
+        self.light_map = None
+        self.loader = None
 
-        #   Setup animation timer
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.animate)
-        self.timer.setInterval(30)
-        self.timer.start()
+        #   Hook into the shared game loop, the player simulates and renders through it as well
+        self.loop = get_loop()
+        self.loop.add_render(self.animate)
+        self.overlay = ProfilerOverlay(self, self.loop)
 
         #   Render settings
         self.setRenderHint(QPainter.Antialiasing)
         self.setFrameStyle(QFrame.NoFrame)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setCacheMode(QGraphicsView.CacheBackground)
 
         #   Input management
-        self.mouse_down = False
+        self.zoom = 1.0
         self.setMouseTracking(True)
-        self.key_pressed = False
+        self.input = InputBuffer(self)
+        self.controller = None
+        self.pathfinder = None
+        self.replay = replay    # Command log to play back instead of live input
+        self.record = open(REPLAY_FILE, 'w') if record else None
+        self.recorder = None
+        self.client = server
+        if server is None:
+            self.loader = LevelLoader(self, fp='assets/world_test')
+            self.loader.progress.connect(self.load_progress)
+            self.loader.finished.connect(self.level_loaded)
+            self.loader.start()
+        else:
+            # The server sends the level a chunk at a time around the player, start from an empty one
+            welcome = server.connect()
+            self.level_loaded(Level(self, level=blank_level(welcome['rows'], welcome['cols'])))
+
+    def load_progress(self, done, total):
+        self.setWindowTitle('Demo Player - loading %d/%d' % (done, total))
+
+    def level_loaded(self, level):
+        self.level = level
+        map_width, map_height = level.width(), level.height()
+        self.m_scene.setSceneRect(0, 0, map_width, map_height)
+        self.player = Player(self, map_width/2, map_height/2, Link(parent=self),
+                             level_max_x=map_width-WINDOW_WIDTH, level_max_y=map_height-WINDOW_HEIGHT)
+        self.player.store.index = level.index
+        self.pathfinder = Pathfinder(level.index, self.loop)
+        level.listeners.append(self.pathfinder.invalidate)
+        source = self.input if self.replay is None else Replay(self.replay)
+        if self.client is not None:
+            self.client.source = source
+            source = self.client
+        self.controller = Controller(self.player, source, record=self.record, pathfinder=self.pathfinder)
+        if self.client is not None:
+            self.client.attach(self.player, level, self.loop)
+        else:
+            self.recorder = Recorder(self.player.store, [self.player], level)
+        self.minimap = Minimap(self, level, self.loop)
+        self.light_map = LightMap(self, level.index, self.loop)
+        level.listeners.append(self.light_map.invalidate)
+        self.lamp = self.light_map.add_light(Light(radius=384))
+        tile = map_width // level.cols()
+        for i in range(TORCH_SPACING // 2, level.rows(), TORCH_SPACING):
+            for j in range(TORCH_SPACING // 2, level.cols(), TORCH_SPACING):
+                self.light_map.add_light(Light(j * tile, i * tile, radius=320, colour=(255, 150, 60)))
+        self.setWindowTitle('Demo Player')
 
     def setup_scene(self):
         self.m_scene.setSceneRect(0, 0, MAP_WIDTH, MAP_HEIGHT)
@@ -106,137 +231,112 @@ class Demo(QGraphicsView):
         linear_grad.setColorAt(1, QColor(192, 192, 255))
         self.setBackgroundBrush(linear_grad)
 
-    def animate(self):
-        self.centerOn(self.player.pos.x(), self.player.pos.y())
-        self.m_scene.update()
-
-    def get_angle(self, event):
-        mouse_pos = Position(x=event.pos().x(), y=event.pos().y())
-        mouse_pos = mouse_pos + self.player.pos - Position(WINDOW_WIDTH/2, WINDOW_HEIGHT/2)
-        # print('Player : %s' % self.player.pos)
-        # print('Mouse : %s' % mouse_pos)
-        # print('Angle : %f' % (self.player.pos < mouse_pos))
-        return self.player.pos < mouse_pos
+    def animate(self, alpha=1.0):
+        if self.player is None:
+            return
+        camera = self.player.sprite.pos
+        self.level.update_view(camera.x(), camera.y(), self.zoom)
+        self.centerOn(camera.x(), camera.y())
+        self.lamp.move(camera.x(), camera.y() - 30)
+
+    def paintEvent(self, event):
+        with PROFILER.phase('paint'):
+            super(Demo, self).paintEvent(event)
+
+    def closeEvent(self, event):
+        if self.record is not None:
+            # The loop is shared and may tick on after the window is gone
+            if self.controller is not None:
+                self.controller.record = None
+            self.record.close()
+            self.record = None
+        super(Demo, self).closeEvent(event)
 
     def keyPressEvent(self, event):
+        if self.player is None:
+            return
         key = event.key()
-        if key == Qt.Key_Shift:
-            self.player.speed = 3
-            self.player.stamina_fade = -.1
-        if event.isAutoRepeat() or self.mouse_down:
+        if event.isAutoRepeat() or self.input.key_press(key):
             return
-        self.key_pressed = True
-        if key == Qt.Key_Up or key == Qt.Key_W:
-            self.player.set_state('up')
-            self.player.vel = Position(0, -self.player.speed)
-        if key == Qt.Key_Down or key == Qt.Key_S:
-            self.player.set_state('down')
-            self.player.vel = Position(0, self.player.speed)
-        if key == Qt.Key_Left or key == Qt.Key_A:
-            self.player.set_state('left')
-            self.player.vel = Position(-self.player.speed, 0)
-        if key == Qt.Key_Right or key == Qt.Key_D:
-            self.player.set_state('right')
-            self.player.vel = Position(self.player.speed, 0)
-        if key == Qt.Key_Space:
-            if self.player.state() == 'static':
-                self.player.set_state('blink')
+        if key == Qt.Key_M:
+            self.minimap.toggle()
+        if key == Qt.Key_L:
+            self.light_map.toggle()
+        if key == Qt.Key_F3:
+            self.overlay.toggle()
+        if key == Qt.Key_F4:
+            # First press starts a trace, the second writes it out for chrome://tracing
+            if PROFILER.tracing:
+                PROFILER.export(TRACE_FILE)
+                LOG.info('trace', 'Wrote %s', TRACE_FILE)
+                if self.overlay.label.isVisible():
+                    PROFILER.enable()
+                else:
+                    PROFILER.disable()
             else:
-                self.player.set_state('static')
+                PROFILER.reset()
+                PROFILER.enable(tracing=True)
+        if key == Qt.Key_F5:
+            if self.record is not None:
+                self.record.flush()
+                LOG.info('replay', 'Input so far is in %s', REPLAY_FILE)
+            else:
+                LOG.info('replay', 'Not recording, start with --record')
+        if key == Qt.Key_F9 and self.recorder is not None:
+            with open(QUICKSAVE_FILE, 'wb') as file:
+                file.write(self.recorder.keyframe(self.loop.ticks))
+            LOG.info('snapshot', 'Saved tick %d to %s', self.loop.ticks, QUICKSAVE_FILE)
+        if key == Qt.Key_F10 and self.recorder is not None and os.path.exists(QUICKSAVE_FILE):
+            with open(QUICKSAVE_FILE, 'rb') as file:
+                snapshot = self.recorder.restore(file.read())
+            self.controller.route = []
+            LOG.info('snapshot', 'Loaded tick %d from %s', snapshot.tick, QUICKSAVE_FILE)
         if key == Qt.Key_Escape:
             exit()
         # super(Demo, self).keyPressEvent(event)
 
     def keyReleaseEvent(self, event):
-        key = event.key()
-        if key == Qt.Key_Shift:
-            self.player.speed = 1
-            self.player.stamina_fade = .1
-        if event.isAutoRepeat() or self.mouse_down:
-            return
-        self.player.vel = Position(0, 0)
-        if self.player.state() == 'left' and (key == Qt.Key_Left or key == Qt.Key_A):
-            self.key_pressed = False
-            self.player.set_state('left_static')
-        if self.player.state() == 'right' and (key == Qt.Key_Right or key == Qt.Key_D):
-            self.key_pressed = False
-            self.player.set_state('right_static')
-        if self.player.state() == 'down' and (key == Qt.Key_Down or key == Qt.Key_S):
-            self.key_pressed = False
-            self.player.set_state('static')
-        if self.player.state() == 'up' and (key == Qt.Key_Up or key == Qt.Key_W):
-            self.key_pressed = False
-            self.player.set_state('up_static')
+        if not event.isAutoRepeat():
+            self.input.key_release(event.key())
+
+    def focusOutEvent(self, event):
+        self.input.clear()
+        super(Demo, self).focusOutEvent(event)
 
     def wheelEvent(self, event):
-        "Don't want the scoll wheel to do anything yet."
+        # Zoom about the player, the level swaps to coarser mip levels as the view shrinks
+        zoom = self.zoom * ZOOM_STEP ** (event.angleDelta().y() / 120)
+        self.zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        self.setTransform(QTransform.fromScale(self.zoom, self.zoom))
 
+    # The handlers only note what happened, the controller turns it into one command per simulation tick
     def mousePressEvent(self, event):
-        # print('Pressed mouse? : <%d, %d>' % (event.pos().x(), event.pos().y()))
-        # print('Sprite Pos : <%d, %d>' % (self.player.pos.x(), self.player.pos.y()))
-        self.mouse_down = True
-        angle = self.get_angle(event)
-        mouse_pos = Position(event.pos().x(), event.pos().y())
-        mouse_pos = mouse_pos + self.player.pos - Position(WINDOW_WIDTH/2, WINDOW_HEIGHT/2)
-        vel = self.player.pos.get_unit(mouse_pos, self.player.speed)
-        self.player.vel = vel
-        print('Player : %s, Mouse : %s, Angle : %s' % (self.player.pos, mouse_pos, round(angle, 2)))
-        print('Velocity : %s' % vel)
-        if 240 < angle < 300 and self.player.state() != 'left':
-            self.player.set_state('left')
-        elif 60 < angle < 120 and self.player.state() != 'right':
-            self.player.set_state('right')
-        elif 120 <= angle <= 240 and self.player.state() != 'up':
-            self.player.set_state('up')
-        elif (angle >= 300 or angle <= 60) and self.player.state() != 'down':
-            self.player.set_state('down')
+        self.input.mouse_press(event.pos(), event.button())
 
     def mouseMoveEvent(self, event):
-        if self.key_pressed:
-            return
-        angle = self.get_angle(event)
-        if self.mouse_down:
-            mouse_pos = Position(event.pos().x(), event.pos().y())
-            mouse_pos = mouse_pos + self.player.pos - Position(WINDOW_WIDTH/2, WINDOW_HEIGHT/2)
-            vel = self.player.pos.get_unit(mouse_pos, self.player.speed)
-            self.player.vel = vel
-            if 240 < angle < 300 and self.player.state() != 'left':
-                self.player.set_state('left')
-            elif 60 < angle < 120 and self.player.state() != 'right':
-                self.player.set_state('right')
-            elif 120 <= angle <= 240 and self.player.state() != 'up':
-                self.player.set_state('up')
-            elif (angle >= 300 or angle <= 60) and self.player.state() != 'down':
-                self.player.set_state('down')
-        else:
-            if 240 < angle < 300 and self.player.state() != 'left_static':
-                self.player.set_state('left_static')
-            elif 60 < angle < 120 and self.player.state() != 'right_static':
-                self.player.set_state('right_static')
-            elif 120 <= angle <= 240 and self.player.state() != 'up_static':
-                self.player.set_state('up_static')
-            elif (angle >= 300 or angle <= 60) and self.player.state() != 'static':
-                self.player.set_state('static')
+        self.input.mouse_move(event.pos())
 
     def mouseReleaseEvent(self, event):
-        self.mouse_down = False
-        self.player.vel = Position(0, 0)
-        if self.player.state() == 'left':
-            self.player.set_state('left_static')
-        if self.player.state() == 'right':
-            self.player.set_state('right_static')
-        if self.player.state() == 'down':
-            self.player.set_state('static')
-        if self.player.state() == 'up':
-            self.player.set_state('up_static')
+        self.input.mouse_release(event.pos(), event.button())
 
 
 def main():
     import sys
 
+    configure_logging()
     app = QApplication(sys.argv)
 
-    demo = Demo()
+    # python player.py replay.jsonl plays back input written with --record
+    # python player.py --connect host:port plays on a network.py server
+    # --record with either or neither writes every tick of input to replay.jsonl
+    args = [arg for arg in sys.argv[1:] if arg != '--record']
+    server = replay = None
+    if len(args) > 1 and args[0] == '--connect':
+        host, _, port = args[1].partition(':')
+        server = Client(host, int(port) if port else PORT)
+    elif args:
+        replay = load_log(args[0])
+    demo = Demo(replay=replay, server=server, record=len(args) < len(sys.argv) - 1)
     demo.setWindowTitle("Demo Player")
     demo.show()
 
@@ -2,74 +2,215 @@ from math import atan2, sin, cos, pi, sqrt
 
 
 class Position:
+    __slots__ = ('_x', '_y')
+
     def __init__(self, x=0.0, y=0.0, pos=None):
-        assert type(x) is int or float
-        assert type(y) is int or float
         if pos is None:
-            self.pos = [x, y]
+            self._x = float(x)
+            self._y = float(y)
+        elif type(pos) is Position:
+            self._x = pos._x
+            self._y = pos._y
         else:
-            if type(pos) is Position:
-                self.pos = [pos.x(), pos.y()]
-            else:
-                self.pos = pos
+            self._x = float(pos[0])
+            self._y = float(pos[1])
+
+    @property
+    def pos(self):
+        """Copy of the old list layout, kept for callers that still index .pos"""
+        return [self._x, self._y]
+
+    @pos.setter
+    def pos(self, pos):
+        self.set(pos)
 
     def x(self, x=None):
         if x is None:
-            return self.pos[0]
+            return self._x
         else:
-            self.pos[0] = x
+            self._x = float(x)
 
     def y(self, y=None):
         if y is None:
-            return self.pos[1]
+            return self._y
         else:
-            self.pos[1] = y
+            self._y = float(y)
 
     def set(self, pos=None):
+        # Copies the values, the caller keeps ownership of whatever it passed in
         if pos is not None:
             if type(pos) is Position:
-                self.pos = [pos.x(), pos.y()]
+                self._x = pos._x
+                self._y = pos._y
             else:
-                self.pos = pos
+                self._x = float(pos[0])
+                self._y = float(pos[1])
+
+    def set_xy(self, x, y):
+        self._x = x
+        self._y = y
+        return self
+
+    def iadd(self, other):
+        self._x += other._x
+        self._y += other._y
+        return self
+
+    def isub(self, other):
+        self._x -= other._x
+        self._y -= other._y
+        return self
+
+    def scale(self, k):
+        self._x *= k
+        self._y *= k
+        return self
+
+    __iadd__ = iadd
+    __isub__ = isub
 
     def get_unit(self, direct, mag):
-        angle = self < direct
-        ret = Position(0.0, 0.0)
-        # print('Angle : %f' % (angle % 90))
-        if 0 <= angle < 90:
-            ret.x(round(mag * abs(sin(angle / 180 * pi)), 2))
-            ret.y(round(mag * abs(cos(angle / 180 * pi)), 2))
-        elif 90 <= angle < 180:
-            ret.x(round(mag * abs(sin((angle / 180 * pi) % 90)), 2))
-            ret.y(round(-mag * abs(cos((angle / 180 * pi) % 90)), 2))
-        elif 180 <= angle < 270:
-            ret.x(round(-mag * abs(sin((angle / 180 * pi) % 90)), 2))
-            ret.y(round(-mag * abs(cos((angle / 180 * pi) % 90)), 2))
-        else:
-            ret.x(round(-mag * abs(sin((angle / 180 * pi) % 90)), 2))
-            ret.y(round(mag * abs(cos((angle / 180 * pi) % 90)), 2))
-        return ret
+        dx = direct._x - self._x
+        dy = direct._y - self._y
+        length = sqrt(dx * dx + dy * dy)
+        if length == 0:
+            return Position(0.0, 0.0)
+        k = mag / length
+        return Position(dx * k, dy * k)
+
+    def direction(self, other, ways=16):
+        """Which of left/right/up/down other lies in, from a precomputed sector table instead of trig"""
+        return DIRECTION_NAMES[ways][direction_index(other._x - self._x, other._y - self._y, ways)]
 
     def __add__(self, other):
-        return Position(pos=[self.pos[0] + other.pos[0], self.pos[1] + other.pos[1]])
+        return Position(self._x + other._x, self._y + other._y)
 
     def __sub__(self, other):
-        return Position(pos=[self.pos[0] - other.pos[0], self.pos[1] - other.pos[1]])
+        return Position(self._x - other._x, self._y - other._y)
 
     def __mul__(self, other):
-        return self.pos[0] * other.pos[0] + self.pos[1] * other.pos[1]
+        return self._x * other._x + self._y * other._y
 
     def __lt__(self, other):
-        diff_x = other.pos[0] - self.pos[0]
-        diff_y = other.pos[1] - self.pos[1]
+        diff_x = other._x - self._x
+        diff_y = other._y - self._y
         angle = atan2(diff_x, diff_y) * 180 / pi
         if angle < 0:
             angle += 360
         return angle
 
     def __str__(self):
-        # print(str(self.pos))
-        return '<' + str(round(self.pos[0], 2)) + ', ' + str(round(self.pos[1], 2)) + '>'
+        return '<' + str(round(self._x, 2)) + ', ' + str(round(self._y, 2)) + '>'
+
+
+def _sector_thresholds(ways):
+    # Sector k is centred on k * 360 / ways degrees, measured like __lt__ (0 is +y, 90 is +x)
+    step = 2 * pi / ways
+    return [sin((k + 0.5) * step) / cos((k + 0.5) * step) for k in range(ways // 4)]
+
+
+def _sector_name(angle):
+    # Same ranges the Demo views used to test the angle against
+    if 240 < angle < 300:
+        return 'left'
+    if 60 < angle < 120:
+        return 'right'
+    if 120 <= angle <= 240:
+        return 'up'
+    return 'down'
+
+
+SECTOR_THRESHOLDS = {ways: _sector_thresholds(ways) for ways in (8, 16)}
+DIRECTION_NAMES = {ways: [_sector_name(k * 360 / ways) for k in range(ways)] for ways in (8, 16)}
+
+
+def direction_index(dx, dy, ways=16):
+    """Sector of the vector (dx, dy), 0 pointing along +y and counting towards +x"""
+    quarter = 0
+    # Rotate back by 90 degrees until we sit in the first quadrant (dx >= 0, dy > 0)
+    while not (dx >= 0 and dy > 0) and quarter < 4:
+        if dx == 0 and dy == 0:
+            return 0
+        dx, dy = -dy, dx
+        quarter += 1
+    k = 0
+    for threshold in SECTOR_THRESHOLDS[ways]:
+        if dx > threshold * dy:
+            k += 1
+    return (quarter * ways // 4 + k) % ways
+
+
+def get_units(sources, targets, mag):
+    """get_unit for many pairs, targets may also be a single Position shared by every source"""
+    if type(targets) is Position:
+        targets = [targets] * len(sources)
+    units = []
+    for src, dst in zip(sources, targets):
+        dx = dst._x - src._x
+        dy = dst._y - src._y
+        length = sqrt(dx * dx + dy * dy)
+        k = mag / length if length else 0.0
+        units.append(Position(dx * k, dy * k))
+    return units
+
+
+class PositionPool:
+    """Reusable scratch positions for hot loops, release what you acquire once you are done with it"""
+
+    def __init__(self, size=64):
+        self.free = [Position() for _ in range(size)]
+
+    def acquire(self, x=0.0, y=0.0):
+        if self.free:
+            return self.free.pop().set_xy(x, y)
+        return Position(x, y)
+
+    def release(self, *positions):
+        self.free.extend(positions)
+
+
+POOL = PositionPool()
+
+
+def iadd_all(positions, deltas):
+    """positions[k] += deltas[k] in place, deltas may also be a single Position applied to all"""
+    if type(deltas) is Position:
+        dx, dy = deltas._x, deltas._y
+        for pos in positions:
+            pos._x += dx
+            pos._y += dy
+    else:
+        for pos, delta in zip(positions, deltas):
+            pos._x += delta._x
+            pos._y += delta._y
+    return positions
+
+
+def scale_all(positions, k):
+    for pos in positions:
+        pos._x *= k
+        pos._y *= k
+    return positions
+
+
+def pack(positions, out=None):
+    """Flatten to [x0, y0, x1, y1, ...], e.g. into an array('d') or a NumPy buffer"""
+    if out is None:
+        out = [0.0] * (2 * len(positions))
+    for n, pos in enumerate(positions):
+        out[2 * n] = pos._x
+        out[2 * n + 1] = pos._y
+    return out
+
+
+def unpack(flat, positions=None):
+    """Inverse of pack, fills positions in place when given so nothing is allocated"""
+    if positions is None:
+        return [Position(flat[n], flat[n + 1]) for n in range(0, len(flat), 2)]
+    for n, pos in enumerate(positions):
+        pos._x = flat[2 * n]
+        pos._y = flat[2 * n + 1]
+    return positions
 
 
 def main():
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""Per frame phase timing with rolling percentiles, counters, Chrome trace export and an optional in view overlay
+
+Everything is off until enable() is called, a disabled phase() hands back one shared no-op context manager.
+Load an exported trace in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import json
+import os
+from collections import deque
+from time import perf_counter
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QFont
+from PyQt5.QtWidgets import QLabel
+from texture_cache import TEXTURES
+
+SAMPLES = 600           # Rolling window per phase, 10 s of frames at 60 Hz
+TRACE_EVENTS = 200000   # Cap so a forgotten trace cannot eat all memory
+
+
+class _NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NO_PHASE = _NoPhase()
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, self.start, perf_counter())
+        return False
+
+
+class Profiler:
+    def __init__(self, samples=SAMPLES):
+        self.enabled = False
+        self.tracing = False
+        self.samples = samples
+        self.times = {}         # phase -> deque of durations in seconds
+        self.counters = {}      # name -> latest value
+        self.events = []
+        self.origin = perf_counter()
+
+    def enable(self, tracing=False):
+        self.enabled = True
+        self.tracing = tracing
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def phase(self, name):
+        if not self.enabled:
+            return NO_PHASE
+        return _Phase(self, name)
+
+    def record(self, name, start, end):
+        times = self.times.get(name)
+        if times is None:
+            times = self.times[name] = deque(maxlen=self.samples)
+        times.append(end - start)
+        if self.tracing and len(self.events) < TRACE_EVENTS:
+            self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6})
+
+    def count(self, name, value):
+        if not self.enabled:
+            return
+        self.counters[name] = value
+        if self.tracing and len(self.events) < TRACE_EVENTS:
+            self.events.append({'name': name, 'ph': 'C', 'pid': os.getpid(), 'tid': 0,
+                                'ts': (perf_counter() - self.origin) * 1e6, 'args': {'value': value}})
+
+    def percentiles(self, name, points=(50, 95, 99)):
+        """Milliseconds at each percentile over the rolling window"""
+        times = sorted(self.times.get(name, ()))
+        if not times:
+            return {point: 0.0 for point in points}
+        return {point: times[min(len(times) - 1, len(times) * point // 100)] * 1000 for point in points}
+
+    def report(self):
+        lines = []
+        for name in self.times:
+            p = self.percentiles(name)
+            lines.append('%-9s p50 %6.2f  p95 %6.2f  p99 %6.2f ms' % (name, p[50], p[95], p[99]))
+        for name, value in self.counters.items():
+            lines.append('%-9s %s' % (name, value))
+        return '\n'.join(lines)
+
+    def export(self, fp):
+        with open(fp, 'w') as file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, file)
+
+    def reset(self):
+        self.times = {}
+        self.counters = {}
+        self.events = []
+        self.origin = perf_counter()
+
+
+PROFILER = Profiler()
+
+
+class ProfilerOverlay:
+    """Text box in the corner of a QGraphicsView, refreshed from the game loop a few times a second while shown"""
+
+    def __init__(self, view, loop, profiler=PROFILER, interval=0.25):
+        self.view = view
+        self.loop = loop
+        self.profiler = profiler
+        self.interval = interval
+        self.elapsed = 0.0
+        self.label = QLabel(view)
+        self.label.setFont(QFont('monospace', 9))
+        self.label.setStyleSheet('background-color: rgba(0, 0, 0, 160); color: white; padding: 4px;')
+        self.label.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.label.move(8, 8)
+        self.label.hide()
+
+    def toggle(self, tracing=False):
+        if self.label.isVisible():
+            self.label.hide()
+            self.loop.remove_render(self.frame)
+            # A trace in progress keeps recording until it is written out
+            if not self.profiler.tracing:
+                self.profiler.disable()
+        else:
+            self.profiler.enable(tracing=tracing or self.profiler.tracing)
+            self.label.show()
+            self.loop.add_render(self.frame)
+
+    def frame(self, alpha):
+        self.elapsed += self.loop.frame_time
+        if self.elapsed >= self.interval:
+            self.elapsed = 0.0
+            self.refresh()
+
+    def refresh(self):
+        self.profiler.count('items', len(self.view.scene().items()))
+        stats = TEXTURES.stats()
+        for name in ('hits', 'misses', 'evictions'):
+            self.profiler.count('pix ' + name, stats[name])
+        self.profiler.count('fps', round(self.loop.fps(), 1))
+        self.label.setText(self.profiler.report())
+        self.label.adjustSize()
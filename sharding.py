@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+"""An EntityStore simulated by worker processes, each owning one vertical strip of the world
+
+Every array of the store lives in one shared memory block, so the workers step their rows in place and the
+GUI process reads positions straight out of it to draw, with no copying or pickling per tick. A tick releases
+all workers at once and waits for them, each steps the live rows it owns with the same rules as
+EntityStore.step, then hands any row that left its strip to the neighbour by rewriting the row's owner. Only
+the owner ever writes a row during a tick, so the workers need no locks, and since the rules are per row the
+result is the same as stepping the whole store in one process. Owners are double buffered by tick parity, a
+row handed over mid tick must not be picked up again by a worker that has not looked yet.
+
+Nothing here imports Qt, the workers are spawned fresh and only load NumPy and the store.
+
+Every tick pays for two barrier round trips, and the spatial hash is still re-synced serially in this process,
+which the in-process EntityStore never does. Measured, that made the sharded store slower at every size up to 60k
+entities, and no size has been shown to win yet. HeadlessWorld(workers=N) still shards when asked, but logs a
+warning when worth_sharding() is false: fewer than MIN_WORKERS workers, fewer than MIN_ENTITIES entities or
+fewer cores than workers. Without a world size (no index and no width) rows are dealt to the workers round
+robin and never handed over.
+"""
+
+import multiprocessing
+import os
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from entities import EntityStore
+from spatial import TILE_SIZE, SpatialIndex
+
+WORKERS = max(1, (os.cpu_count() or 2) - 1)
+CAPACITY = 65536
+TIMEOUT = 10        # Seconds to wait on the workers before giving up on a tick
+MIN_WORKERS = 2
+MIN_ENTITIES = 250000
+
+# name, shape after the row count, dtype
+ARRAYS = [('alive', (), bool), ('pos', (2,), np.float64), ('prev_pos', (2,), np.float64),
+          ('vel', (2,), np.float64), ('speed', (), np.float64), ('stamina', (), np.float64),
+          ('stamina_fade', (), np.float64), ('min_pos', (2,), np.float64), ('max_pos', (2,), np.float64),
+          ('owners', (2,), np.int32)]
+COUNT, STOP, PARITY = 0, 1, 2   # Header slots
+
+
+def worth_sharding(workers, entities):
+    """Whether workers processes can be expected to beat one for this many entities, a guess rather than a measurement"""
+    return workers >= MIN_WORKERS and entities >= MIN_ENTITIES and (os.cpu_count() or 1) >= workers
+
+
+def layout(capacity, rows, cols):
+    """(name, shape, dtype, offset) for every array in the block, and the block's size"""
+    out = []
+    offset = 0
+    for name, shape, dtype in [('header', None, np.int64)] + ARRAYS + [('walkable', None, bool)]:
+        if name == 'header':
+            shape = (3,)
+        elif name == 'walkable':
+            shape = (rows, cols)
+        else:
+            shape = (capacity,) + shape
+        out.append((name, shape, dtype, offset))
+        offset += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+    return out, max(offset, 8)
+
+
+def views(buf, arrays):
+    return {name: np.ndarray(shape, dtype, buf, offset) for name, shape, dtype, offset in arrays}
+
+
+class Grid:
+    """Just the size of a level, enough for a SpatialIndex whose walkable grid is filled in from outside"""
+
+    def __init__(self, rows, cols):
+        self._rows = rows
+        self._cols = cols
+
+    def rows(self):
+        return self._rows
+
+    def cols(self):
+        return self._cols
+
+
+def work(name, arrays, shard, shards, strip, tile_size, start, done):
+    memory = SharedMemory(name=name)
+    try:
+        shared = views(memory.buf, arrays)
+        store = EntityStore(capacity=1)
+        for array, *_ in ARRAYS:
+            setattr(store, array, shared[array])
+        walkable = shared['walkable']
+        if walkable.size:
+            store.index = SpatialIndex(Grid(*walkable.shape), tile_size, populate=False)
+            store.index.walkable = walkable
+        header = shared['header']
+        owners = shared['owners']
+        while True:
+            start.wait()
+            if header[STOP]:
+                break
+            n = int(header[COUNT])
+            parity = int(header[PARITY])
+            rows = np.flatnonzero(store.alive[:n] & (owners[:n, parity] == shard))
+            if len(rows):
+                store.prev_pos[rows] = store.pos[rows]
+                store.step(rows)
+                # Rows that crossed into another strip belong to its worker from the next tick on
+                if strip is None:
+                    owners[rows, 1 - parity] = shard
+                else:
+                    owners[rows, 1 - parity] = np.clip(np.floor(store.pos[rows, 0] / strip), 0, shards - 1)
+            done.wait()
+        # Views into the block have to go before it can close
+        del shared, walkable, header, owners, store
+    finally:
+        memory.close()
+
+
+class ShardedStore(EntityStore):
+    def __init__(self, capacity=CAPACITY, workers=WORKERS, index=None, width=None, tile_size=None):
+        """index gives the walkable grid and world size, width (scene pixels) the size without one"""
+        super().__init__(capacity=1)
+        self.workers = workers
+        self.index = index
+        rows, cols = (index.rows, index.cols) if index is not None else (0, 0)
+        self.tile_size = index.tile_size if index is not None else tile_size or TILE_SIZE
+        if width is None and index is not None:
+            width = cols * self.tile_size
+        self.strip = None if width is None else width / workers
+        self.arrays, size = layout(capacity, rows, cols)
+        self.memory = SharedMemory(create=True, size=size)
+        shared = views(self.memory.buf, self.arrays)
+        for name, *_ in ARRAYS:
+            setattr(self, name, shared[name])
+        self.header = shared['header']
+        self.walkable = shared['walkable']
+        self.header[:] = 0
+        self.alive[:] = False
+        if index is not None:
+            self.walkable[:] = index.walkable
+        self.processes = []
+        self.start_barrier = None
+        self.done_barrier = None
+
+    def _grow(self):
+        raise ValueError('ShardedStore is full, capacity %d' % self.capacity())
+
+    def shard_of(self, x, row=0):
+        if self.strip is None:
+            return row % self.workers
+        return min(max(int(x // self.strip), 0), self.workers - 1)
+
+    def owner(self, row):
+        return int(self.owners[row, self.header[PARITY]])
+
+    def add(self, x=0.0, y=0.0, *args, **kwargs):
+        row = super().add(x, y, *args, **kwargs)
+        self.owners[row] = self.shard_of(x, row)
+        return row
+
+    def place(self):
+        """Hand every row to the worker of its strip, after positions were written from outside"""
+        n = self.count
+        if self.strip is None:
+            self.owners[:n] = (np.arange(n) % self.workers)[:, None]
+        else:
+            self.owners[:n] = np.clip(np.floor(self.pos[:n, 0] / self.strip), 0, self.workers - 1)[:, None]
+
+    def invalidate(self, i0, j0, i1, j1):
+        """Tiles changed, hook to Level.listeners. Copied between ticks, the workers are waiting then"""
+        if self.index is not None:
+            self.walkable[i0:i1, j0:j1] = self.index.walkable[i0:i1, j0:j1]
+
+    def start(self):
+        if self.processes:
+            return self
+        context = multiprocessing.get_context('spawn')
+        self.start_barrier = context.Barrier(self.workers + 1)
+        self.done_barrier = context.Barrier(self.workers + 1)
+        for shard in range(self.workers):
+            process = context.Process(target=work, daemon=True,
+                                      args=(self.memory.name, self.arrays, shard, self.workers, self.strip,
+                                            self.tile_size, self.start_barrier, self.done_barrier))
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def simulate(self):
+        if not self.processes:
+            self.start()
+        self.header[COUNT] = self.count
+        self.start_barrier.wait(TIMEOUT)
+        self.done_barrier.wait(TIMEOUT)
+        self.header[PARITY] ^= 1
+        if self.index is not None:
+            self.index.sync(self)
+
+    def step(self, rows=None):
+        """In this process, for the odd single row (Player.mov), ticks go through simulate()"""
+        super().step(rows)
+        if self.strip is not None and rows is not None and not isinstance(rows, slice):
+            self.owners[rows] = np.clip(np.floor(self.pos[rows, 0] / self.strip), 0, self.workers - 1)
+
+    def close(self):
+        if self.processes:
+            self.header[STOP] = 1
+            try:
+                self.start_barrier.wait(TIMEOUT)
+            except Exception:
+                pass
+            for process in self.processes:
+                process.join(TIMEOUT)
+                if process.is_alive():
+                    process.terminate()
+            self.processes = []
+        for name, *_ in ARRAYS:
+            setattr(self, name, None)
+        self.header = self.walkable = None
+        self.memory.close()
+        self.memory.unlink()
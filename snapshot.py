@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""Binary snapshots of the world state, and per tick deltas between two of them
+
+A snapshot holds every EntityStore row as one fixed size little endian record, the animation state of the
+players' sprites, and the level as the file it came from plus the edits made since. Each edited block of
+tiles is a small binary level patch of its latest cells, so a quicksave does not re-encode a whole map. The full
+level can be embedded as well. Restoring puts every rect edited since the level was loaded back the way it was
+loaded, then applies the patches.
+
+A delta against an earlier snapshot carries only the entity rows whose record changed, the sprite table and
+the patches that changed. Encoding is a handful of array copies and decoding maps the records straight out of the
+bytes, so both stay in the low milliseconds for tens of thousands of entities. The same state always gives
+the same bytes.
+
+Layout (little endian), after the header every section is a uint32 length and the data, padded to 8 bytes:
+    header      magic, version, kind (full or delta), tick, base tick (deltas), entity count
+    meta        utf-8 json {'states': [...], 'source': fp or null, 'patches': [[i0, j0], ...]}
+    rows        uint32 row per record, deltas only
+    entities    ENTITY records
+    sprites     SPRITE records
+    level       binary level, or empty
+    patches     binary level per patch, one section each
+"""
+
+import json
+import struct
+
+import numpy as np
+
+import level_format
+
+MAGIC = b'GPSN'
+VERSION = 1
+FULL, DELTA = 0, 1
+HEADER = struct.Struct('<4sHHQQI')
+SECTION = struct.Struct('<I')
+BLOCK = 16          # Tiles per side of the blocks a Recorder patches
+ENTITY = np.dtype([('alive', '?'), ('pos', '<f8', (2,)), ('prev_pos', '<f8', (2,)), ('vel', '<f8', (2,)),
+                   ('speed', '<f8'), ('stamina', '<f8'), ('stamina_fade', '<f8'),
+                   ('min_pos', '<f8', (2,)), ('max_pos', '<f8', (2,))])
+SPRITE = np.dtype([('row', '<u4'), ('state', '<u2'), ('step', '<u2'), ('elapsed', '<f8')])
+
+
+def patch(level, i0, j0, i1, j1):
+    """(i0, j0, binary level) for the level's cells in [i0, i1) x [j0, j1)"""
+    return i0, j0, level_format.encode(level.copy(i0, j0, i1, j1))
+
+
+def apply_patch(level, i0, j0, data):
+    # Putting back saved state, not an edit to undo
+    with level_format.BinaryLevel(data=data) as cells:
+        level.paste(i0, j0, cells.to_dict(), journal=False)
+
+
+def _load(fp):
+    if level_format.is_binary(fp):
+        return level_format.load(fp)
+    with open(fp, 'r') as file:
+        return json.load(file)
+
+
+def _sections(data, offset):
+    while offset < len(data):
+        length, = SECTION.unpack_from(data, offset)
+        offset += SECTION.size
+        yield data[offset:offset + length]
+        offset += -(-(SECTION.size + length) // 8) * 8 - SECTION.size
+
+
+def _pack(header, sections):
+    out = bytearray(header)
+    out += bytes(-len(out) % 8)
+    for section in sections:
+        out += SECTION.pack(len(section))
+        out += section
+        out += bytes(-(SECTION.size + len(section)) % 8)
+    return bytes(out)
+
+
+class Snapshot:
+    def __init__(self, tick, entities, sprites, states, level=None, source=None, patches=()):
+        self.tick = tick
+        self.entities = entities        # ENTITY record per store row
+        self.sprites = sprites          # SPRITE record per player with a sprite
+        self.states = states            # Sprite state names, SPRITE['state'] indexes this
+        self.level = level              # Binary level bytes, None keeps the level as it is on restore
+        self.source = source            # File or directory the level was loaded from
+        self.patches = list(patches)    # (i0, j0, binary level) edits on top of the level, one per block
+
+    @classmethod
+    def capture(cls, store, players=(), level=None, tick=0, embed_level=False, patches=()):
+        n = store.count
+        entities = np.empty(n, ENTITY)
+        for name in ENTITY.names:
+            entities[name] = getattr(store, name)[:n]
+        states = []
+        sprites = []
+        for player in players:
+            sprite = player.sprite
+            if sprite is None:
+                continue
+            if sprite.state not in states:
+                states.append(sprite.state)
+            sprites.append((player.row, states.index(sprite.state), sprite.step,
+                            sprite.animator.elapsed[sprite.row]))
+        data = None
+        if level is not None and embed_level:
+            data = level_format.encode(level.copy(0, 0, level.rows(), level.cols()))
+        return cls(tick, entities, np.array(sprites, SPRITE), states, data,
+                   None if level is None else level.fp, patches)
+
+    def _meta(self, patches):
+        return json.dumps({'states': self.states, 'source': self.source,
+                           'patches': [[i0, j0] for i0, j0, _ in patches]}, sort_keys=True).encode('utf-8')
+
+    def encode(self):
+        header = HEADER.pack(MAGIC, VERSION, FULL, self.tick, 0, len(self.entities))
+        return _pack(header, [self._meta(self.patches), b'', self.entities.tobytes(), self.sprites.tobytes(),
+                              self.level or b''] + [data for _, _, data in self.patches])
+
+    def delta(self, previous):
+        """Bytes that turn previous into this snapshot, see decode()"""
+        n, m = len(self.entities), min(len(self.entities), len(previous.entities))
+        rows = np.flatnonzero(self.entities[:m] != previous.entities[:m])
+        rows = np.concatenate([rows, np.arange(m, n)]).astype('<u4')
+        sent = {(i0, j0): data for i0, j0, data in previous.patches}
+        patches = [(i0, j0, data) for i0, j0, data in self.patches if sent.get((i0, j0)) != data]
+        header = HEADER.pack(MAGIC, VERSION, DELTA, self.tick, previous.tick, n)
+        return _pack(header, [self._meta(patches), rows.tobytes(), self.entities[rows].tobytes(),
+                              self.sprites.tobytes(), b''] + [data for _, _, data in patches])
+
+    @classmethod
+    def decode(cls, data, base=None):
+        """A full snapshot, or base moved on by a delta. Entity records are read only views into data"""
+        data = memoryview(data)
+        magic, version, kind, tick, base_tick, n = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a snapshot')
+        if version != VERSION:
+            raise ValueError('Unsupported snapshot version %d' % version)
+        meta, rows, entities, sprites, level, *patches = _sections(data, -(-HEADER.size // 8) * 8)
+        meta = json.loads(bytes(meta).decode('utf-8'))
+        entities = np.frombuffer(entities, ENTITY)
+        sprites = np.frombuffer(sprites, SPRITE)
+        patches = [(i0, j0, bytes(patch)) for (i0, j0), patch in zip(meta['patches'], patches)]
+        if kind == FULL:
+            return cls(tick, entities, sprites, meta['states'], bytes(level) or None, meta['source'], patches)
+        if base is None or base.tick != base_tick:
+            raise ValueError('Delta from tick %d needs the snapshot of that tick' % base_tick)
+        records = np.empty(n, ENTITY)
+        m = min(n, len(base.entities))
+        records[:m] = base.entities[:m]
+        records[np.frombuffer(rows, '<u4')] = entities
+        # A block patched again replaces its older patch
+        merged = {(i0, j0): (i0, j0, data) for i0, j0, data in base.patches + patches}
+        return cls(tick, records, sprites, meta['states'], base.level, base.source, list(merged.values()))
+
+    def restore(self, store, players=(), level=None, base=None, touched=()):
+        """Put the captured state back into store, the players' sprites and level
+
+        touched are the (i0, j0, i1, j1) rects of level edited since it was loaded, they go back to base (a level
+        dict, by default loaded from source) before this snapshot's patches are applied.
+        """
+        n = len(self.entities)
+        store.reserve(n)
+        store.alive[n:store.count] = False
+        for name in ENTITY.names:
+            getattr(store, name)[:n] = self.entities[name]
+        store.count = n
+        store.free = np.flatnonzero(~store.alive[:n])[::-1].tolist()
+        # A sharded store has to know which worker each row belongs to now
+        place = getattr(store, 'place', None)
+        if place is not None:
+            place()
+        if store.index is not None:
+            store.index.sync(store)
+
+        by_row = {player.row: player for player in players if player.sprite is not None}
+        for row, state, step, elapsed in self.sprites.tolist():
+            sprite = by_row[row].sprite
+            sprite.set_state(self.states[state])
+            sprite.animator.step[sprite.row] = step
+            sprite.animator.elapsed[sprite.row] = elapsed
+            sprite.show_step(step)
+
+        if level is not None:
+            if self.level is not None:
+                with level_format.BinaryLevel(data=self.level) as cells:
+                    level.level = cells.to_dict()
+                level.changed(0, 0, level.rows(), level.cols())
+            elif touched:
+                if base is None and self.source is None:
+                    raise ValueError('Edits to a level held in memory can only be undone with its base')
+                base = _load(self.source) if base is None else base
+                for i0, j0, i1, j1 in touched:
+                    level.paste(i0, j0, {layer: [row[j0:j1] for row in rows[i0:i1]] for layer, rows in base.items()},
+                                journal=False)
+            for i0, j0, data in self.patches:
+                apply_patch(level, i0, j0, data)
+
+
+class Recorder:
+    """Snapshots of one world, with the level's edits picked up from its listeners as patches
+
+    Edits are kept per BLOCK x BLOCK block of tiles, each with its latest cells, so a snapshot carries the area
+    edited rather than every edit ever made.
+    """
+
+    def __init__(self, store, players=(), level=None):
+        self.store = store
+        self.players = players
+        self.level = level
+        self.blocks = {}        # (bi, bj) -> (i0, j0, binary level) of every block edited since base
+        self.stale = set()      # Blocks edited since their patch was made
+        self.base = None
+        self.last = None
+        self.recording = True
+        # A streamed world reports regions coming in, not edits
+        if level is not None and level.world is None:
+            self.base = self.copy()
+            level.listeners.append(self.changed)
+
+    def copy(self):
+        # Only the row lists, cells are replaced on edit and never changed in place
+        return {layer: [row[:] for row in rows] for layer, rows in self.level.level.items()}
+
+    def changed(self, i0, j0, i1, j1):
+        if self.recording:
+            self.stale.update((bi, bj) for bi in range(i0 // BLOCK, (i1 - 1) // BLOCK + 1)
+                              for bj in range(j0 // BLOCK, (j1 - 1) // BLOCK + 1))
+
+    def patches(self):
+        for bi, bj in self.stale:
+            i0, j0 = bi * BLOCK, bj * BLOCK
+            self.blocks[bi, bj] = patch(self.level, i0, j0, i0 + BLOCK, j0 + BLOCK)
+        self.stale.clear()
+        return [self.blocks[key] for key in sorted(self.blocks)]
+
+    def snapshot(self, tick=0, embed_level=False):
+        # The level bytes already hold every edit so far
+        patches = () if embed_level or self.level is None else self.patches()
+        return Snapshot.capture(self.store, self.players, self.level, tick, embed_level, patches)
+
+    def keyframe(self, tick=0, embed_level=False):
+        self.last = self.snapshot(tick, embed_level)
+        return self.last.encode()
+
+    def delta(self, tick):
+        """Bytes moving the last keyframe or delta on to now, a keyframe if there was none"""
+        if self.last is None:
+            return self.keyframe(tick)
+        snapshot = self.snapshot(tick)
+        data = snapshot.delta(self.last)
+        self.last = snapshot
+        return data
+
+    def restore(self, data, base=None):
+        """Decode and restore a snapshot (or a delta on base), the changes that makes are not edits to record"""
+        snapshot = Snapshot.decode(data, base)
+        touched = [(bi * BLOCK, bj * BLOCK, (bi + 1) * BLOCK, (bj + 1) * BLOCK)
+                   for bi, bj in sorted(set(self.blocks) | self.stale)]
+        self.recording = False
+        try:
+            snapshot.restore(self.store, self.players, self.level, self.base, touched)
+        finally:
+            self.recording = True
+        if snapshot.level is not None and self.level is not None:
+            self.base = self.copy()
+        # From here the level only differs from base where the snapshot's patches went
+        self.blocks = {(i0 // BLOCK, j0 // BLOCK): (i0, j0, data) for i0, j0, data in snapshot.patches}
+        self.stale.clear()
+        self.last = snapshot
+        return snapshot
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+"""Uniform grid index over the level layers plus a spatial hash of moving entities, keyed by tile"""
+
+from math import floor, sqrt
+
+import numpy as np
+
+TILE_SIZE = 64
+FOLIAGE = 1
+OBJECT = 2
+LAYER_FLAGS = {'foliage': FOLIAGE, 'object': OBJECT}
+
+
+class SpatialIndex:
+    def __init__(self, source, tile_size=TILE_SIZE, solid_layers=(), populate=True):
+        self.source = source
+        self.tile_size = tile_size
+        self.rows = source.rows()
+        self.cols = source.cols()
+        self.solid = 0
+        for layer in solid_layers:
+            self.solid |= LAYER_FLAGS[layer]
+        self.walkable = np.zeros((self.rows, self.cols), dtype=bool)
+        self.occupied = np.zeros((self.rows, self.cols), dtype=np.uint8)   # LAYER_FLAGS bits
+        self.cells = {}         # (i, j) -> set of entity ids
+        self.entity_cell = {}   # entity id -> (i, j)
+        self.entity_pos = {}    # entity id -> (x, y), for entities indexed through update()
+        self.store = None       # Set by sync(), its rows are the entity ids and positions come from it
+        self.keys = np.full((0, 2), -1, dtype=np.int64)     # last indexed cell per EntityStore row
+        if populate:    # Streamed worlds start out empty and refresh() each region as it arrives
+            self.refresh(0, 0, self.rows, self.cols)
+
+    def refresh(self, i0, j0, i1, j1):
+        """Re-read the tile rect [i0, i1) x [j0, j1) from the source, after edits or streamed in regions"""
+        cell = self.source.cell
+        for i in range(max(i0, 0), min(i1, self.rows)):
+            for j in range(max(j0, 0), min(j1, self.cols)):
+                flags = 0
+                for layer, flag in LAYER_FLAGS.items():
+                    if isinstance(cell(layer, i, j), list):
+                        flags |= flag
+                self.occupied[i, j] = flags
+                self.walkable[i, j] = bool(cell('walkable', i, j)) and not flags & self.solid
+
+    def tile_of(self, x, y):
+        return floor(y / self.tile_size), floor(x / self.tile_size)
+
+    def in_bounds(self, i, j):
+        return 0 <= i < self.rows and 0 <= j < self.cols
+
+    # Static queries
+
+    def is_walkable(self, x, y):
+        i, j = self.tile_of(x, y)
+        return self.in_bounds(i, j) and bool(self.walkable[i, j])
+
+    def walkable_points(self, xs, ys):
+        """Vectorized is_walkable for arrays of scene coordinates"""
+        i = np.floor(np.asarray(ys) / self.tile_size).astype(np.int64)
+        j = np.floor(np.asarray(xs) / self.tile_size).astype(np.int64)
+        inside = (i >= 0) & (i < self.rows) & (j >= 0) & (j < self.cols)
+        out = np.zeros(inside.shape, dtype=bool)
+        out[inside] = self.walkable[i[inside], j[inside]]
+        return out
+
+    def walkable_move(self, x0, y0, x1, y1):
+        """True when every tile the segment passes through is walkable (grid traversal, no sampling gaps)"""
+        i, j = self.tile_of(x0, y0)
+        i_end, j_end = self.tile_of(x1, y1)
+        dx = x1 - x0
+        dy = y1 - y0
+        step_j = 1 if dx > 0 else -1
+        step_i = 1 if dy > 0 else -1
+        next_x = (j + (step_j > 0)) * self.tile_size
+        next_y = (i + (step_i > 0)) * self.tile_size
+        t_max_x = (next_x - x0) / dx if dx else float('inf')
+        t_max_y = (next_y - y0) / dy if dy else float('inf')
+        t_dx = self.tile_size / abs(dx) if dx else float('inf')
+        t_dy = self.tile_size / abs(dy) if dy else float('inf')
+        while True:
+            if not self.in_bounds(i, j) or not self.walkable[i, j]:
+                return False
+            if i == i_end and j == j_end:
+                return True
+            # The next boundary lies past the end point, only rounding kept us from matching the end tile
+            if t_max_x < t_max_y:
+                if t_max_x > 1:
+                    return True
+                t_max_x += t_dx
+                j += step_j
+            else:
+                if t_max_y > 1:
+                    return True
+                t_max_y += t_dy
+                i += step_i
+
+    def resolve_move(self, x0, y0, x1, y1):
+        """Where a mover from (x0, y0) towards (x1, y1) ends up, sliding along walls when only one axis is blocked"""
+        if self.walkable_move(x0, y0, x1, y1):
+            return x1, y1
+        if self.walkable_move(x0, y0, x1, y0):
+            return x1, y0
+        if self.walkable_move(x0, y0, x0, y1):
+            return x0, y1
+        return x0, y0
+
+    def resolve_moves(self, old, new):
+        """resolve_move for (n, 2) arrays of positions
+
+        A move into a neighbouring tile only needs its end point checked. The few that cross more than one tile
+        edge in a tick (fast, or over a corner) are traced with resolve_move so they cannot hop a wall.
+        """
+        size = self.tile_size
+        cross = np.abs(np.floor(new / size) - np.floor(old / size)).sum(axis=1) > 1
+        ok = self.walkable_points(new[:, 0], new[:, 1])
+        if ok.all() and not cross.any():
+            return new
+        out = new.copy()
+        blocked = ~ok
+        slide_x = blocked & self.walkable_points(new[:, 0], old[:, 1])
+        out[slide_x, 1] = old[slide_x, 1]
+        blocked &= ~slide_x
+        slide_y = blocked & self.walkable_points(old[:, 0], new[:, 1])
+        out[slide_y, 0] = old[slide_y, 0]
+        blocked &= ~slide_y
+        out[blocked] = old[blocked]
+        for row in np.flatnonzero(cross).tolist():
+            out[row] = self.resolve_move(*old[row].tolist(), *new[row].tolist())
+        return out
+
+    def tiles_in_rect(self, x0, y0, x1, y1):
+        i0, j0 = self.tile_of(x0, y0)
+        i1, j1 = self.tile_of(x1, y1)
+        return max(i0, 0), max(j0, 0), min(i1, self.rows - 1), min(j1, self.cols - 1)
+
+    def static_in_rect(self, x0, y0, x1, y1):
+        i0, j0, i1, j1 = self.tiles_in_rect(x0, y0, x1, y1)
+        hits = []
+        block = self.occupied[i0:i1 + 1, j0:j1 + 1]
+        for i, j in zip(*np.nonzero(block)):
+            flags = block[i, j]
+            for layer, flag in LAYER_FLAGS.items():
+                if flags & flag:
+                    hits.append((layer, int(i0 + i), int(j0 + j)))
+        return hits
+
+    def static_in_circle(self, x, y, r):
+        hits = []
+        for layer, i, j in self.static_in_rect(x - r, y - r, x + r, y + r):
+            # Closest point of the tile to the centre
+            cx = min(max(x, j * self.tile_size), (j + 1) * self.tile_size)
+            cy = min(max(y, i * self.tile_size), (i + 1) * self.tile_size)
+            if (cx - x) ** 2 + (cy - y) ** 2 <= r * r:
+                hits.append((layer, i, j))
+        return hits
+
+    # Moving entities
+
+    def update(self, entity, x, y):
+        """(Re)index one entity by its centre, nothing changes unless it moved to another tile"""
+        self.entity_pos[entity] = (x, y)
+        self._move(entity, self.tile_of(x, y))
+
+    def _move(self, entity, key):
+        old = self.entity_cell.get(entity)
+        if old == key:
+            return
+        if old is not None:
+            self._unlink(entity, old)
+        self.entity_cell[entity] = key
+        self.cells.setdefault(key, set()).add(entity)
+
+    def remove(self, entity):
+        old = self.entity_cell.pop(entity, None)
+        self.entity_pos.pop(entity, None)
+        if old is not None:
+            self._unlink(entity, old)
+
+    def _unlink(self, entity, key):
+        members = self.cells[key]
+        members.discard(entity)
+        if not members:
+            del self.cells[key]
+
+    def position(self, entity):
+        if self.store is not None:
+            return self.store.pos[entity].tolist()
+        return self.entity_pos[entity]
+
+    def sync(self, store):
+        """Re-index every live EntityStore row, only rows that crossed a tile boundary touch the hash
+
+        Use either sync() or update() on one index, store rows and hand picked ids would collide.
+        """
+        self.store = store
+        n = store.count
+        if len(self.keys) < n:
+            keys = np.full((len(store.alive), 2), -1, dtype=np.int64)
+            keys[:len(self.keys)] = self.keys
+            self.keys = keys
+        pos = store.pos[:n]
+        keys = np.floor(pos[:, ::-1] / self.tile_size).astype(np.int64)
+        alive = store.alive[:n]
+        changed = np.nonzero(((keys != self.keys[:n]).any(axis=1) & alive) | (~alive & (self.keys[:n, 0] != -1)))[0]
+        for row in changed.tolist():
+            if alive[row]:
+                self._move(row, tuple(keys[row].tolist()))
+                self.keys[row] = keys[row]
+            else:
+                self.remove(row)
+                self.keys[row] = -1
+
+    def entities_in_rect(self, x0, y0, x1, y1):
+        i0, j0 = self.tile_of(x0, y0)
+        i1, j1 = self.tile_of(x1, y1)
+        found = set()
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                members = self.cells.get((i, j))
+                if members:
+                    for entity in members:
+                        ex, ey = self.position(entity)
+                        if x0 <= ex <= x1 and y0 <= ey <= y1:
+                            found.add(entity)
+        return found
+
+    def entities_in_circle(self, x, y, r):
+        found = set()
+        for entity in self.entities_in_rect(x - r, y - r, x + r, y + r):
+            ex, ey = self.position(entity)
+            if sqrt((ex - x) ** 2 + (ey - y) ** 2) <= r:
+                found.add(entity)
+        return found
+
+    def query_rect(self, x0, y0, x1, y1):
+        return self.static_in_rect(x0, y0, x1, y1), self.entities_in_rect(x0, y0, x1, y1)
+
+    def query_circle(self, x, y, r):
+        return self.static_in_circle(x, y, r), self.entities_in_circle(x, y, r)
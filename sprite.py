@@ -10,14 +10,19 @@ from PyQt5.QtGui import (QBrush, QColor, QLinearGradient, QPen, QPainter,
 from PyQt5.QtWidgets import (QLabel, QGraphicsItem, QApplication, QFrame, QGraphicsDropShadowEffect,
                              QGraphicsEllipseItem, QGraphicsRectItem, QGraphicsScene, QGraphicsView,
                              QGraphicsPixmapItem)
+from animation import CLIPS, StateMachine, get_animator
+from game_loop import get_loop
+from logs import configure_logging, get_log
 from position import Position
+from texture_cache import get_pix
 
 WINDOW_WIDTH = 800
 WINDOW_HEIGHT = 600
+LOG = get_log('sprite')
 
 
 class Sprite:
-    def __init__(self, pos=None, sheet=None, parent=None, width=None, height=None):
+    def __init__(self, pos=None, sheet=None, parent=None, width=None, height=None, loop=None):
         if pos is None:
             self.pos = Position(pos=[0, 0])
         else:
@@ -25,22 +30,28 @@ class Sprite:
         self.parent = parent
         self.width = width
         self.height = height
-        self.sheet = QPixmap(sheet)
+        self.sheet_path = None
+        self.sheet = None
+        self.set_sheet(sheet)
         self.pix = None
+        self.shown = None       # cacheKey of the frame on screen
         self.states = {'static':
                            {'pix'   : [],
                             'delay' : 1000}}
         self.state = 'static'
         self.step = 0
+        self.machine = None     # StateMachine for send()
 
-        self.delay = 50
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.animate)
-        self.timer.setInterval(self.delay)
-        self.timer.start()
+        self.loop = get_loop() if loop is None else loop
+        self.animator = get_animator(self.loop)
+        self.row = self.animator.add(self)
 
     def set_sheet(self, sheet):
-        self.sheet = QPixmap(sheet)
+        self.sheet_path = sheet
+        self.sheet = QPixmap() if sheet is None else get_pix(sheet)
+
+    def frame(self, x, y, w, h):
+        return get_pix(self.sheet_path, x, y, w, h)
 
     def set_static(self, pix_pos=None, x_shift=None, y_shift=None, x_offset=0, y_offset=0,
                    z=1, scale=1.0):
@@ -51,87 +62,90 @@ class Sprite:
         if x_shift is None or y_shift is None:
             self.states['static']['pix'].append(self.sheet)
         else:
-            self.states['static']['pix'].append(self.sheet.copy(pix_pos.x(), pix_pos.y(), x_shift, y_shift))
+            self.states['static']['pix'].append(self.frame(pix_pos.x(), pix_pos.y(), x_shift, y_shift))
         self.pix = self.parent.m_scene.addPixmap(self.states['static']['pix'][0])
+        self.shown = self.states['static']['pix'][0].cacheKey()
         self.pix.setPos(self.pos.x(), self.pos.y())
         self.pix.setOffset(x_offset, y_offset)
         self.pix.setZValue(z)
         self.pix.setScale(scale)
 
     def move_sprite(self, pos):
+        # The scene repaints the old and new item rects itself, and only if the position really changed
         self.pos.set(pos)
         self.pix.setPos(self.pos.x(), self.pos.y())
 
+    def show(self, pix):
+        # setPixmap repaints even for the frame already up, held frames and shared clip frames would redraw for nothing
+        key = pix.cacheKey()
+        if key != self.shown:
+            self.shown = key
+            self.pix.setPixmap(pix)
+
     def set_state(self, state):
         self.state = state
-        self.timer.setInterval(self.states[state]['delay'])
-        self.step = 0
-        self.pix.setPixmap(self.states[state]['pix'][self.step])
+        self.animator.set_clip(self.row, len(self.states[state]['pix']), self.states[state]['delay'])
+        self.show_step(0)
+
+    def send(self, event):
+        """Feed an event to the state machine, True if it changed the state"""
+        state = self.machine.next(self.state, event)
+        if state == self.state:
+            return False
+        self.set_state(state)
+        return True
 
     def add_state(self, name, maps=[], delay=50):
         self.states[name] = {}
         self.states[name]['pix'] = maps
         self.states[name]['delay'] = delay
 
+    def show_step(self, step):
+        self.step = step
+        self.show(self.states[self.state]['pix'][step])
+
     def animate(self):
-        self.step += 1
-        if self.step >= len(self.states[self.state]['pix']):
-            self.step = 0
-        #print('step:', self.step)
-        self.pix.setPixmap(self.states[self.state]['pix'][self.step])
+        """Advance one frame now, the animator does this for every sprite on the loop in one go"""
+        step = (self.step + 1) % len(self.states[self.state]['pix'])
+        self.animator.step[self.row] = step
+        self.animator.elapsed[self.row] = 0
+        self.show_step(step)
+
+
+# state -> ((column, row) cells on the 120x130 sheet grid, delay)
+LINK_STATES = {'blink': ([(0, 0)] * 15 + [(1, 0), (2, 0)], 80),
+               'left_static': ([(0, 1)], 80),
+               'up_static': ([(0, 2)], 80),
+               'right_static': ([(0, 3)], 80),
+               'down': ([(i, 4) for i in range(10)], 80),
+               'left': ([(i, 5) for i in range(10)], 80),
+               'up': ([(i, 6) for i in range(10)], 80),
+               'right': ([(i, 7) for i in range(10)], 80)}
+
+# walking state -> the state it stops in
+STANDING = {'left': 'left_static', 'right': 'right_static', 'up': 'up_static', 'down': 'static'}
+
+# event -> {from state: to state}, see StateMachine
+LINK_TRANSITIONS = dict([('walk_' + way, {'*': way}) for way in STANDING] +
+                        [('face_' + way, {'*': state}) for way, state in STANDING.items()] +
+                        [('release_' + way, {way: state}) for way, state in STANDING.items()] +
+                        [('stop', STANDING),
+                         ('blink', {'static': 'blink', '*': 'static'})])
+LINK_MACHINE = StateMachine(['static'] + list(LINK_STATES), LINK_TRANSITIONS)
+
+KEY_WAYS = {Qt.Key_Up: 'up', Qt.Key_W: 'up', Qt.Key_Down: 'down', Qt.Key_S: 'down',
+            Qt.Key_Left: 'left', Qt.Key_A: 'left', Qt.Key_Right: 'right', Qt.Key_D: 'right'}
 
 
 class Link(Sprite):
-    def __init__(self, pos=None, parent=None, width=None, height=None):
-        super().__init__(pos=pos, sheet='assets/linkEdit.png', parent=parent, width=width, height=height)
+    def __init__(self, pos=None, parent=None, width=None, height=None, loop=None):
+        super().__init__(pos=pos, sheet='assets/linkEdit.png', parent=parent, width=width, height=height, loop=loop)
         self.set_static(x_shift=120, y_shift=130, x_offset=-50, y_offset=-110, scale=.5)#-380, -275, scale=1) #-675, -525, scale=.5)
 
-        # Add state blink
-        pix = []
-        for i in range(15):
-            pix.append(self.sheet.copy(0, 0, 120, 130))
-        for i in range(1, 3):
-            pix.append(self.sheet.copy(120 * i, 130 * 0, 120, 130))
-        self.add_state('blink', pix, 80)
-
-        # Add state left_static
-        pix = []
-        pix.append(self.sheet.copy(120 * 0, 130 * 1, 120, 130))
-        self.add_state('left_static', pix, 80)
-
-        # Add state up_static
-        pix = []
-        pix.append(self.sheet.copy(120 * 0, 130 * 2, 120, 130))
-        self.add_state('up_static', pix, 80)
-
-        # Add state right_static
-        pix = []
-        pix.append(self.sheet.copy(120 * 0, 130 * 3, 120, 130))
-        self.add_state('right_static', pix, 80)
-
-        # Add state down
-        pix = []
-        for i in range(10):
-            pix.append(self.sheet.copy(120 * i, 130 * 4, 120, 130))
-        self.add_state('down', pix, 80)
-
-        # Add state left
-        pix = []
-        for i in range(10):
-            pix.append(self.sheet.copy(120 * i, 130 * 5, 120, 130))
-        self.add_state('left', pix, 80)
-
-        # Add state up
-        pix = []
-        for i in range(10):
-            pix.append(self.sheet.copy(120 * i, 130 * 6, 120, 130))
-        self.add_state('up', pix, 80)
-
-        # Add state right
-        pix = []
-        for i in range(10):
-            pix.append(self.sheet.copy(120 * i, 130 * 7, 120, 130))
-        self.add_state('right', pix, 80)
+        # Frames are sliced once for the first Link and shared by every one after it
+        for name, clip in CLIPS.clip_set(self.sheet_path, 120, 130, LINK_STATES).items():
+            self.add_state(name, clip.frames, clip.delay)
+        self.machine = LINK_MACHINE
 
 
 class Demo(QGraphicsView):
@@ -148,13 +162,12 @@ class Demo(QGraphicsView):
         self.setScene(self.m_scene)
         self.setup_scene()
 
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.animate)
-        self.timer.setInterval(30)
-        self.timer.start()
+        self.loop = get_loop()
 
         self.setRenderHint(QPainter.Antialiasing)
         self.setFrameStyle(QFrame.NoFrame)
+        self.setViewportUpdateMode(QGraphicsView.SmartViewportUpdate)
+        self.setCacheMode(QGraphicsView.CacheBackground)
 
         self.mouse_down = False
         self.setMouseTracking(True)
@@ -178,41 +191,20 @@ class Demo(QGraphicsView):
         #self.m_items[0].setBrush(QBrush(Qt.black))
         #self.m_scene.addItem(self.m_items[0])
 
-    def animate(self):
-        #for sprite in self.m_sprites:
-        #    sprite.update()
-        self.m_scene.update()
-
-    def get_angle(self, event):
+    def facing(self, event):
         mouse_pos = Position(x=event.pos().x(), y=event.pos().y())
-        print('sprite : %s' % self.m_sprites[0].pos)
-        print('mouse : %s' % mouse_pos)
-        print('angle : %s' % (self.m_sprites[0].pos < mouse_pos))
-        return self.m_sprites[0].pos < mouse_pos
+        LOG.debug('angle', 'sprite : %s, mouse : %s', self.m_sprites[0].pos, mouse_pos)
+        return self.m_sprites[0].pos.direction(mouse_pos)
 
     def keyPressEvent(self, event):
         key = event.key()
         if event.isAutoRepeat() or self.mouse_down:
             return
         self.key_pressed = True
-        if key == Qt.Key_Up or key == Qt.Key_W:
-            #print('Pressed Up or W?')
-            self.m_sprites[0].set_state('up')
-        if key == Qt.Key_Down or key == Qt.Key_S:
-            #print('Pressed Down or S?')
-            self.m_sprites[0].set_state('down')
-        if key == Qt.Key_Left or key == Qt.Key_A:
-            #print('Pressed Left or A?')
-            self.m_sprites[0].set_state('left')
-        if key == Qt.Key_Right or key == Qt.Key_D:
-            #print('Pressed Right or D?')
-            self.m_sprites[0].set_state('right')
+        if key in KEY_WAYS:
+            self.m_sprites[0].send('walk_' + KEY_WAYS[key])
         if key == Qt.Key_Space:
-            #print('Pressed Space?')
-            if self.m_sprites[0].state == 'static':
-                self.m_sprites[0].set_state('blink')
-            else:
-                self.m_sprites[0].set_state('static')
+            self.m_sprites[0].send('blink')
         if key == Qt.Key_Escape:
             exit()
         super(Demo, self).keyPressEvent(event)
@@ -221,74 +213,29 @@ class Demo(QGraphicsView):
         if event.isAutoRepeat() or self.mouse_down:
             return
         key = event.key()
-        #print('Keyboard released?')
-        if self.m_sprites[0].state == 'left' and (key == Qt.Key_Left or key == Qt.Key_A):
-            self.key_pressed = False
-            self.m_sprites[0].state = 'left_static'
-        if self.m_sprites[0].state == 'right' and (key == Qt.Key_Right or key == Qt.Key_D):
-            self.key_pressed = False
-            self.m_sprites[0].state = 'right_static'
-        if self.m_sprites[0].state == 'down' and (key == Qt.Key_Down or key == Qt.Key_S):
+        if key in KEY_WAYS and self.m_sprites[0].send('release_' + KEY_WAYS[key]):
             self.key_pressed = False
-            self.m_sprites[0].state = 'static'
-        if self.m_sprites[0].state == 'up' and (key == Qt.Key_Up or key == Qt.Key_W):
-            self.key_pressed = False
-            self.m_sprites[0].state = 'up_static'
 
     def mousePressEvent(self, event):
-        print('Pressed mouse? : <%d, %d>' % (event.pos().x(), event.pos().y()))
-        print('Sprite Pos : <%d, %d>' % (self.m_sprites[0].pos.x(), self.m_sprites[0].pos.y()))
+        LOG.debug('press', 'Pressed mouse? : <%d, %d>, Sprite Pos : %s', event.pos().x(), event.pos().y(),
+                  self.m_sprites[0].pos)
         self.mouse_down = True
-        angle = self.get_angle(event)
-        print(angle)
-        if 240 < angle < 300 and self.m_sprites[0].state != 'left':
-            self.m_sprites[0].set_state('left')
-        elif 60 < angle < 120 and self.m_sprites[0].state != 'right':
-            self.m_sprites[0].set_state('right')
-        elif 120 <= angle <= 240 and self.m_sprites[0].state != 'up':
-            self.m_sprites[0].set_state('up')
-        elif (angle >= 300 or angle <= 60) and self.m_sprites[0].state != 'down':
-            self.m_sprites[0].set_state('down')
+        self.m_sprites[0].send('walk_' + self.facing(event))
 
     def mouseMoveEvent(self, event):
         if self.key_pressed:
             return
-        angle = self.get_angle(event)
-        print(angle)
-        if self.mouse_down:
-            if 240 < angle < 300 and self.m_sprites[0].state != 'left':
-                self.m_sprites[0].set_state('left')
-            elif 60 < angle < 120 and self.m_sprites[0].state != 'right':
-                self.m_sprites[0].set_state('right')
-            elif 120 <= angle <= 240 and self.m_sprites[0].state != 'up':
-                self.m_sprites[0].set_state('up')
-            elif (angle >= 300 or angle <= 60) and self.m_sprites[0].state != 'down':
-                self.m_sprites[0].set_state('down')
-        else:
-            if 240 < angle < 300 and self.m_sprites[0].state != 'left_static':
-                self.m_sprites[0].set_state('left_static')
-            elif 60 < angle < 120 and self.m_sprites[0].state != 'right_static':
-                self.m_sprites[0].set_state('right_static')
-            elif 120 <= angle <= 240 and self.m_sprites[0].state != 'up_static':
-                self.m_sprites[0].set_state('up_static')
-            elif (angle >= 300 or angle <= 60) and self.m_sprites[0].state != 'static':
-                self.m_sprites[0].set_state('static')
+        self.m_sprites[0].send(('walk_' if self.mouse_down else 'face_') + self.facing(event))
 
     def mouseReleaseEvent(self, event):
         self.mouse_down = False
-        if self.m_sprites[0].state == 'left':
-            self.m_sprites[0].state = 'left_static'
-        if self.m_sprites[0].state == 'right':
-            self.m_sprites[0].state = 'right_static'
-        if self.m_sprites[0].state == 'down':
-            self.m_sprites[0].state = 'static'
-        if self.m_sprites[0].state == 'up':
-            self.m_sprites[0].state = 'up_static'
+        self.m_sprites[0].send('stop')
 
 
 def main():
     import sys
 
+    configure_logging()
     app = QApplication(sys.argv)
 
     demo = Demo()
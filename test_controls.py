@@ -0,0 +1,37 @@
+import time
+
+from controls import PATH_DELAY, Command, Controller, Replay
+from engine import HeadlessWorld
+from generator import generate
+from pathfinding import Pathfinder
+
+
+def walk(delay):
+    w = HeadlessWorld(level=generate(64, seed=1).to_dict())
+    index = w.level.index
+    tiles = list(zip(*index.walkable.nonzero()))
+    start, goal = [((j + .5) * index.tile_size, (i + .5) * index.tile_size) for i, j in tiles[::997][:2]]
+    player = w.add_player(*start)
+    pathfinder = Pathfinder(index, w.scheduler)
+    find = pathfinder.find_path
+
+    def slow(*args):
+        time.sleep(delay)
+        return find(*args)
+
+    pathfinder.find_path = slow
+    commands = [Command(0, (), None, False, False, (), goal)]
+    commands += [Command(k, (), None, False, False, ()) for k in range(1, 40)]
+    Controller(player, Replay(commands), w.scheduler, pathfinder=pathfinder)
+    track = []
+    for _ in commands:
+        w.step()
+        track.append(tuple(w.store.pos[player.row].tolist()))
+    pathfinder.close()
+    return track
+
+
+def test_route_starts_on_a_fixed_tick():
+    fast, slow = walk(0), walk(.05)
+    assert fast == slow
+    assert fast[PATH_DELAY - 1] == fast[0] != fast[-1]
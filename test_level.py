@@ -0,0 +1,66 @@
+import level_format
+from generator import ORE, generate
+from level import Journal, Level
+
+
+def level(fp=None):
+    return Level(fp=fp, level=generate(40, seed=2).to_dict())
+
+
+def cells(level):
+    return level.copy(0, 0, level.rows(), level.cols())
+
+
+def test_set_tile_and_fill_rect():
+    lv = level()
+    lv.set_tile('object', 3, 4, [ORE])
+    assert lv.cell('object', 3, 4) == [ORE]
+    lv.fill_rect('walkable', 5, 6, 7, 9, False)
+    assert [lv.cell('walkable', i, j) for i in range(5, 7) for j in range(6, 9)] == [False] * 6
+    assert not lv.index.walkable[5:7, 6:9].any()
+
+
+def test_fill_rect_is_clipped_to_the_map():
+    lv = level()
+    rows, cols = lv.rows(), lv.cols()
+    lv.fill_rect('base', -2, -1, 3, 2, 0)
+    assert all(lv.cell('base', i, j) == 0 for i in range(3) for j in range(2))
+    lv.fill_rect('walkable', rows - 1, cols - 2, rows + 5, cols + 5, False)
+    assert [lv.cell('walkable', rows - 1, j) for j in (cols - 2, cols - 1)] == [False, False]
+    before = cells(lv)
+    lv.fill_rect('base', -5, -5, -1, -1, 0)
+    lv.fill_rect('base', rows, 0, rows + 2, 2, 0)
+    assert cells(lv) == before
+
+
+def test_undo_redo():
+    lv = level()
+    Journal(lv)
+    original = cells(lv)
+    lv.set_tile('object', 1, 1, [ORE])
+    lv.fill_rect('walkable', 2, 2, 4, 4, False)
+    edited = cells(lv)
+    assert lv.journal.undo() and lv.journal.undo()
+    assert not lv.journal.undo()
+    assert cells(lv) == original
+    assert bool(lv.index.walkable[3, 3]) == bool(original['walkable'][3][3])
+    assert lv.journal.redo() and lv.journal.redo()
+    assert not lv.journal.redo()
+    assert cells(lv) == edited
+    lv.journal.undo()
+    lv.set_tile('base', 0, 0, 0)
+    assert not lv.journal.redo()
+
+
+def test_save_changes_appends_patches(tmp_path):
+    fp = str(tmp_path / 'level.lvl')
+    lv = level(fp)
+    size = lv.saved_size
+    lv.set_tile('object', 3, 4, [ORE])
+    lv.fill_rect('walkable', 20, 30, 22, 40, False)
+    lv.save_changes()
+    assert (tmp_path / 'level.lvl').stat().st_size > size
+    assert level_format.load(fp) == lv.level
+    lv.set_tile('object', 3, 4, 0)
+    lv.save_changes()
+    assert level_format.load(fp) == lv.level
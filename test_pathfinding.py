@@ -0,0 +1,23 @@
+import numpy as np
+
+from pathfinding import label_regions, relabel
+
+
+def same_regions(a, b):
+    pairs = set(zip(a.ravel().tolist(), b.ravel().tolist()))
+    return len(pairs) == len({x for x, _ in pairs}) == len({y for _, y in pairs})
+
+
+def test_relabel_matches_label_regions():
+    rng = np.random.default_rng(0)
+    walkable = np.zeros((42, 42), bool)
+    walkable[1:-1, 1:-1] = rng.random((40, 40)) < .6
+    labels = label_regions(walkable)
+    for _ in range(300):
+        i, j = rng.integers(1, 38, 2)
+        h, w = rng.integers(1, 4, 2)
+        edited = walkable.copy()
+        edited[i:i + h, j:j + w] = rng.random((h, w)) < .5
+        labels = relabel(edited, labels, edited != walkable)
+        walkable = edited
+        assert same_regions(labels, label_regions(walkable))
@@ -0,0 +1,70 @@
+import numpy as np
+
+from engine import HeadlessWorld
+from generator import ORE, generate
+from level import Level
+from snapshot import BLOCK, Recorder, Snapshot
+
+
+def world(fp=None):
+    level = generate(64, seed=1).to_dict()
+    if fp is not None:
+        Level(fp=fp, level=level)
+        out = HeadlessWorld(fp=fp)
+    else:
+        out = HeadlessWorld(level=level)
+    out.spawn(100, seed=0)
+    return out
+
+
+def cells(level):
+    return level.copy(0, 0, level.rows(), level.cols())
+
+
+def test_restore_undoes_later_edits():
+    w = world()
+    original = cells(w.level)
+    recorder = Recorder(w.store, w.players, w.level)
+    first = recorder.keyframe(w.scheduler.ticks)
+    w.level.set_tile('object', 3, 4, [ORE])
+    saved = cells(w.level)
+    pos = w.store.pos[:w.store.count].copy()
+    key = recorder.keyframe(w.scheduler.ticks)
+
+    w.run(20)
+    w.level.set_tile('object', 3, 4, 0)
+    w.level.fill_rect('walkable', 40, 40, 50, 60, False)
+    recorder.restore(key)
+    assert cells(w.level) == saved
+    assert np.array_equal(w.store.pos[:w.store.count], pos)
+    assert w.level.index.walkable[45, 50] == original['walkable'][45][50]
+
+    recorder.restore(first)
+    assert cells(w.level) == original
+
+
+def test_restore_reloads_source(tmp_path):
+    fp = str(tmp_path / 'level.lvl')
+    w = world(fp)
+    original = cells(w.level)
+    key = Snapshot.capture(w.store, w.players, w.level).encode()
+    w.level.set_tile('object', 5, 5, [ORE])
+    Snapshot.decode(key).restore(w.store, w.players, w.level, touched=[(5, 5, 6, 6)])
+    assert cells(w.level) == original
+
+
+def test_patches_stay_per_block():
+    w = world()
+    recorder = Recorder(w.store, w.players, w.level)
+    recorder.keyframe()
+    for k in range(50):
+        w.level.set_tile('object', 1 + k % 3, 2, [ORE] if k % 2 else 0)
+        recorder.delta(k + 1)
+    snapshot = recorder.snapshot(51)
+    assert len(snapshot.patches) == 1
+    assert snapshot.patches[0][:2] == (0, 0)
+
+    w.level.set_tile('object', BLOCK + 1, 2, [ORE])
+    later = recorder.snapshot(52)
+    data = later.delta(snapshot)
+    assert len(Snapshot.decode(data, snapshot).patches) == 2
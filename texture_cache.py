@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""Process wide pixmap cache, every sheet is decoded from disk once and sub rects are handed out from memory
+
+Pixmaps only exist on the GUI thread. Loader threads get QImages instead through get_image(), which has its
+own lock, byte count and counters so it never touches the pixmap side. Every public lookup counts once, as a
+hit or a miss, stats() adds both sides up.
+"""
+
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtGui import QImage, QPixmap
+
+CACHE_BYTES = 256 * 1024 * 1024
+
+
+class TextureCache:
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.sheets = OrderedDict()     # sheet -> QPixmap of the whole file
+        self.pixmaps = OrderedDict()    # (sheet, x, y, w, h) -> QPixmap
+        self.images = OrderedDict()     # sheet or (sheet, x, y, w, h) -> QImage, guarded by lock
+        self.image_bytes = 0
+        self.image_hits = 0             # The image side's counters, also guarded by lock
+        self.image_misses = 0
+        self.image_evictions = 0
+        self.lock = threading.Lock()
+
+    def sheet(self, sheet):
+        if sheet in self.sheets:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return self._sheet(sheet)
+
+    def _sheet(self, sheet):
+        pix = self.sheets.get(sheet)
+        if pix is not None:
+            self.sheets.move_to_end(sheet)
+            return pix
+        pix = QPixmap(sheet)
+        self.sheets[sheet] = pix
+        self.bytes += self._size(pix)
+        self._evict()
+        return pix
+
+    def get(self, sheet, x=0, y=0, w=None, h=None):
+        if w is None or h is None:
+            return self.sheet(sheet)
+        key = (sheet, int(x), int(y), int(w), int(h))
+        pix = self.pixmaps.get(key)
+        if pix is not None:
+            self.hits += 1
+            self.pixmaps.move_to_end(key)
+            return pix
+        self.misses += 1
+        pix = self._sheet(sheet).copy(*key[1:])
+        self.pixmaps[key] = pix
+        self.bytes += self._size(pix)
+        self._evict()
+        return pix
+
+    def image(self, sheet, x=0, y=0, w=None, h=None):
+        """Thread safe QImage version of get()"""
+        key = sheet if w is None or h is None else (sheet, int(x), int(y), int(w), int(h))
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.image_hits += 1
+                self.images.move_to_end(key)
+                return image
+            self.image_misses += 1
+            if key is sheet:
+                image = QImage(sheet).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+            else:
+                whole = self.images.get(sheet)
+                if whole is None:
+                    whole = self.images[sheet] = QImage(sheet).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+                    self.image_bytes += self._size(whole)
+                image = whole.copy(*key[1:])
+            self.images[key] = image
+            self.image_bytes += self._size(image)
+            while self.image_bytes > self.max_bytes and len(self.images) > 1:
+                _, dropped = self.images.popitem(last=False)
+                self.image_bytes -= self._size(dropped)
+                self.image_evictions += 1
+            return image
+
+    def clear(self):
+        self.sheets.clear()
+        self.pixmaps.clear()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        with self.lock:
+            self.images.clear()
+            self.image_bytes = 0
+            self.image_hits = self.image_misses = self.image_evictions = 0
+
+    def stats(self):
+        return {'hits': self.hits + self.image_hits,
+                'misses': self.misses + self.image_misses,
+                'evictions': self.evictions + self.image_evictions,
+                'sheets': len(self.sheets),
+                'pixmaps': len(self.pixmaps),
+                'images': len(self.images),
+                'bytes': self.bytes + self.image_bytes}
+
+    def _evict(self):
+        # Least recently used sub rects go first, sheets only once nothing else is left to drop
+        while self.bytes > self.max_bytes and self.pixmaps:
+            _, pix = self.pixmaps.popitem(last=False)
+            self.bytes -= self._size(pix)
+            self.evictions += 1
+        while self.bytes > self.max_bytes and len(self.sheets) > 1:
+            _, pix = self.sheets.popitem(last=False)
+            self.bytes -= self._size(pix)
+            self.evictions += 1
+
+    @staticmethod
+    def _size(pix):
+        return pix.width() * pix.height() * 4
+
+
+TEXTURES = TextureCache()
+
+
+def get_pix(sheet, x=0, y=0, w=None, h=None):
+    return TEXTURES.get(sheet, x, y, w, h)
+
+
+def get_image(sheet, x=0, y=0, w=None, h=None):
+    return TEXTURES.image(sheet, x, y, w, h)
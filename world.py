@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""Region based world store, the map is split into fixed size binary level files that are loaded around the player"""
+
+import json
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from math import floor
+
+import level_format
+
+TILE_SIZE = 64
+REGION_SIZE = 64
+META = 'world.json'
+EMPTY = {'walkable': False, 'tilted': 0}
+
+
+def region_path(directory, ri, rj):
+    return os.path.join(directory, 'r_%d_%d%s' % (ri, rj, '.lvl'))
+
+
+def write_world(source, directory, region_size=REGION_SIZE):
+    """Split anything with rows(), cols() and cell(layer, i, j) (Level, BinaryLevel, WorldStore) into regions"""
+    os.makedirs(directory, exist_ok=True)
+    rows = source.rows()
+    cols = source.cols()
+    for ri in range(-(-rows // region_size)):
+        for rj in range(-(-cols // region_size)):
+            write_region(source, directory, ri, rj, region_size)
+    with open(os.path.join(directory, META), 'w') as file:
+        json.dump({'rows': rows, 'cols': cols, 'region_size': region_size}, file)
+
+
+def write_region(source, directory, ri, rj, region_size=REGION_SIZE):
+    i_range = range(ri * region_size, min((ri + 1) * region_size, source.rows()))
+    j_range = range(rj * region_size, min((rj + 1) * region_size, source.cols()))
+    region = {layer: [[source.cell(layer, i, j) for j in j_range] for i in i_range]
+              for layer in level_format.TILE_LAYERS + level_format.STACK_LAYERS + level_format.BIT_LAYERS}
+    level_format.save(region, region_path(directory, ri, rj))
+
+
+class WorldStore:
+    def __init__(self, directory, radius=1, cache_regions=16, tile_size=TILE_SIZE, workers=2, on_loaded=None):
+        self.directory = directory
+        with open(os.path.join(directory, META), 'r') as file:
+            meta = json.load(file)
+        self.n_rows = meta['rows']
+        self.n_cols = meta['cols']
+        self.region_size = meta['region_size']
+        self.region_rows = -(-self.n_rows // self.region_size)
+        self.region_cols = -(-self.n_cols // self.region_size)
+        self.radius = radius
+        self.cache_regions = max(cache_regions, (2 * radius + 1) ** 2)
+        self.tile_size = tile_size
+        self.on_loaded = on_loaded      # Called with (ri, rj) on the thread that calls update()
+        self.regions = OrderedDict()    # (ri, rj) -> BinaryLevel, least recently wanted first
+        self.pending = {}               # (ri, rj) -> Future
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def rows(self):
+        return self.n_rows
+
+    def cols(self):
+        return self.n_cols
+
+    def region_of(self, i, j):
+        return i // self.region_size, j // self.region_size
+
+    def cell(self, layer, i, j):
+        region = self.regions.get((i // self.region_size, j // self.region_size))
+        if region is None:
+            return EMPTY.get(layer, 0)
+        return region.cell(layer, i % self.region_size, j % self.region_size)
+
+    def is_loaded(self, i, j):
+        return self.region_of(i, j) in self.regions
+
+    def wanted(self, x, y):
+        ri, rj = self.region_of(floor(y / self.tile_size), floor(x / self.tile_size))
+        return [(i, j) for i in range(max(ri - self.radius, 0), min(ri + self.radius, self.region_rows - 1) + 1)
+                for j in range(max(rj - self.radius, 0), min(rj + self.radius, self.region_cols - 1) + 1)]
+
+    def update(self, x, y, wait=False):
+        """Queue loads for every region within radius of the scene position, closest first"""
+        wanted = self.wanted(x, y)
+        ri, rj = self.region_of(floor(y / self.tile_size), floor(x / self.tile_size))
+        wanted.sort(key=lambda key: abs(key[0] - ri) + abs(key[1] - rj))
+        for key in wanted:
+            if key in self.regions:
+                self.regions.move_to_end(key)
+            elif key not in self.pending:
+                self.pending[key] = self.pool.submit(level_format.BinaryLevel, region_path(self.directory, *key))
+        if wait:
+            for key in wanted:
+                if key in self.pending:
+                    self.pending[key].result()
+        self.poll()
+        self.evict(set(wanted))
+
+    def poll(self):
+        for key, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[key]
+            self.regions[key] = future.result()
+            if self.on_loaded is not None:
+                self.on_loaded(*key)
+
+    def evict(self, keep):
+        for key in list(self.regions):
+            if len(self.regions) <= self.cache_regions:
+                break
+            if key not in keep:
+                self.regions.pop(key).close()
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pool.shutdown(wait=True)
+        self.pending = {}
+        for region in self.regions.values():
+            region.close()
+        self.regions.clear()
+
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print('usage: %s level.lvl world_dir [region_size]' % sys.argv[0])
+        sys.exit(1)
+    region_size = int(sys.argv[3]) if len(sys.argv) == 4 else REGION_SIZE
+    if level_format.is_binary(sys.argv[1]):
+        with level_format.BinaryLevel(sys.argv[1]) as source:
+            if not source.patched:
+                write_world(source, sys.argv[2], region_size)
+                return
+        # Edits appended to the file only show up once it is loaded whole
+        level = level_format.load(sys.argv[1])
+    else:
+        with open(sys.argv[1], 'r') as file:
+            level = json.load(file)
+    write_world(level_format.BinaryLevel(data=level_format.encode(level)), sys.argv[2], region_size)
+
+
+if __name__ == '__main__':
+    main()